@@ -1,39 +1,202 @@
-# A simple script to dump the CSV results from the RSS DynamoDB table
+# A script to export the blogposts from the RSS DynamoDB table as CSV or JSONL, or to push these directly to Algolia
 # You can use the CSV dump to bulk import blogs into Algolia
+#
+# The table is read with a parallel segmented scan and every page is written straight to the output file, so memory use does not grow with the table.
+# After every page the last evaluated key of the segment and the size of the output file are stored in a checkpoint file, run the same command
+# with --resume to continue an interrupted export. The output file is truncated to the checkpointed size, so no rows are written twice.
 
-import botocore, boto3
+import argparse, botocore, boto3, csv, json, os, threading
 
-region = 'eu-west-1'
-table = '<tablename>'
+from boto3.dynamodb.conditions import Attr
+
+# the attributes to export, the article bodies and tags are never read
 proj_expression = "guid, timest, datestr, blogsource, category, link, description, author, title"
+csv_header = ['ObjectID', 'guid', 'timest', 'datestr', 'blogsource', 'category', 'link', 'description', 'author', 'title']
+
+# the attributes of the small algolia records, like the getfeed function stores these
+algolia_fields = ['objectID', 'timest', 'title', 'description', 'link', 'blogsource', 'author', 'guid']
+
+
+# get an export row of a blogpost with the timestamp as an int
+def get_row(x):
+	row = {k : x.get(k, '') for k in ['guid', 'datestr', 'blogsource', 'category', 'link', 'description', 'author', 'title']}
+	row['timest'] = int(x['timest'])
+	row['objectID'] = x['guid']
+
+	return row
+
+
+# write the rows of the export to a csv or jsonl file and keep the checkpoint of every segment
+class Export:
+
+	def __init__(self, args):
+		self.args = args
+		self.lock = threading.Lock()
+		self.checkpoint = args.checkpoint or (args.output or args.algolia_index) + '.checkpoint'
+		self.segments = {}
+		self.rows = 0
+		self.out = None
+		self.writer = None
+		offset = None
+
+		if args.resume and os.path.exists(self.checkpoint):
+			with open(self.checkpoint) as f:
+				state = json.load(f)
+
+			if state['segments_total'] != args.segments:
+				raise Exception('the checkpoint uses ' + str(state['segments_total']) + ' segments, resume with --segments ' + str(state['segments_total']))
+
+			self.segments = state['segments']
+			self.rows = state['rows']
+			offset = state['offset']
+
+		if args.output is not None:
+			self.open_output(offset)
+
+	# open the output file, a resumed export continues at the checkpointed size and drops the rows written after the last checkpoint
+	def open_output(self, offset):
+		if offset is None:
+			self.out = open(self.args.output, 'w', newline = '', encoding = 'utf-8')
+
+			if self.args.format == 'csv':
+				csv.writer(self.out).writerow(csv_header)
+
+		else:
+			self.out = open(self.args.output, 'r+', newline = '', encoding = 'utf-8')
+			self.out.truncate(offset)
+			self.out.seek(offset)
+
+		if self.args.format == 'csv':
+			self.writer = csv.writer(self.out, quoting = csv.QUOTE_ALL)
+
+	# get the start key of a segment, or None if the segment is done
+	def get_start(self, segment):
+		state = self.segments.get(str(segment), {})
+
+		if state.get('done', False):
+			return None
+
+		return state.get('key', {})
+
+	# write the rows of a scan page and store the checkpoint of the segment, both under one lock so the checkpoint matches the file
+	def write_page(self, segment, rows, lastkey):
+		with self.lock:
+			if self.out is not None:
+				for row in rows:
+					if self.writer is not None:
+						self.writer.writerow([row['objectID'], row['guid'], row['timest'], row['datestr'], row['blogsource'], row['category'], row['link'], row['description'], row['author'], row['title']])
+
+					else:
+						self.out.write(json.dumps(row) + '\n')
+
+				self.out.flush()
+
+			self.rows += len(rows)
+
+			if lastkey is None:
+				self.segments[str(segment)] = {'done' : True}
+
+			else:
+				self.segments[str(segment)] = {'key' : {k : int(v) if k == 'timest' else v for k, v in lastkey.items()}}
+
+			self.save()
+
+	# write the checkpoint to a temporary file first, so an interrupted write keeps the previous checkpoint
+	def save(self):
+		state = {'segments_total' : self.args.segments, 'segments' : self.segments, 'rows' : self.rows, 'offset' : self.out.tell() if self.out is not None else None}
+
+		with open(self.checkpoint + '.tmp', 'w') as f:
+			json.dump(state, f)
+
+		os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+	def close(self):
+		if self.out is not None:
+			self.out.close()
+
+
+# get the algolia index to push the records to
+def get_algolia_index(args):
+	from algoliasearch.search_client import SearchClient
+
+	client = SearchClient.create(args.algolia_app, args.algolia_apikey)
+
+	return client.init_index(args.algolia_index)
+
+
+# export the blogposts of one scan segment, every page holds up to --page-size rows and is pushed to algolia as one batch
+def dump_segment(args, export, segment, algolia, errors):
+	ddb = boto3.resource('dynamodb', region_name = args.region, config = botocore.client.Config(max_pool_connections = 50)).Table(args.table)
+
+	start = export.get_start(segment)
+
+	if start is None:
+		return
+
+	# the counter, feed state and identity rows have a timestamp of 0 or lower
+	scan = {'Segment' : segment, 'TotalSegments' : args.segments, 'Limit' : args.page_size, 'ProjectionExpression' : proj_expression, 'FilterExpression' : Attr('timest').gt(0)}
+
+	if len(start) > 0:
+		scan['ExclusiveStartKey'] = start
+
+	try:
+		while True:
+			res = ddb.scan(**scan)
+			rows = [get_row(x) for x in res['Items']]
+
+			if algolia is not None and len(rows) > 0:
+				algolia.save_objects([{k : row[k] for k in algolia_fields} for row in rows])
+
+			export.write_page(segment, rows, res.get('LastEvaluatedKey'))
+
+			if 'LastEvaluatedKey' not in res:
+				return
+
+			scan['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+	except Exception as e:
+		errors.append(e)
+		print('segment ' + str(segment) + ' failed : ' + str(e))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'export the blogposts of the rss dynamodb table as csv or jsonl, or push these to algolia')
+	parser.add_argument('--table', required = True, help = 'name of the dynamodb table')
+	parser.add_argument('--region', default = 'eu-west-1')
+	parser.add_argument('--output', default = None, help = 'file to write the blogposts to')
+	parser.add_argument('--format', default = 'csv', choices = ['csv', 'jsonl'])
+	parser.add_argument('--segments', type = int, default = 4, help = 'amount of parallel scan segments')
+	parser.add_argument('--page-size', type = int, default = 1000, help = 'maximum amount of items per scan page and algolia batch')
+	parser.add_argument('--checkpoint', default = None, help = 'checkpoint file, defaults to the output file or algolia index name with a .checkpoint suffix')
+	parser.add_argument('--resume', action = 'store_true', help = 'continue the export from the checkpoint file')
+	parser.add_argument('--algolia-app', default = os.environ.get('ALGOLIA_APP'), help = 'algolia app id, defaults to the ALGOLIA_APP variable')
+	parser.add_argument('--algolia-apikey', default = os.environ.get('ALGOLIA_APIKEY'), help = 'algolia api key, defaults to the ALGOLIA_APIKEY variable')
+	parser.add_argument('--algolia-index', default = None, help = 'algolia index to push the blogposts to')
+	args = parser.parse_args()
+
+	if args.output is None and args.algolia_index is None:
+		parser.error('use --output, --algolia-index or both')
 
-ddb = boto3.resource('dynamodb', region_name = region, config = botocore.client.Config(max_pool_connections = 50)).Table(table)
+	if args.algolia_index is not None and (args.algolia_app is None or args.algolia_apikey is None):
+		parser.error('--algolia-app and --algolia-apikey are required for --algolia-index')
 
-def dump_records_to_csv():
+	export = Export(args)
+	algolia = get_algolia_index(args) if args.algolia_index is not None else None
+	errors = []
+	threads = []
 
-	res = []
-	queryres = ddb.scan(ProjectionExpression = proj_expression)
+	for segment in range(args.segments):
+		t = threading.Thread(target = dump_segment, args = (args, export, segment, algolia, errors))
+		t.start()
+		threads.append(t)
 
-	for x in queryres['Items']:
-					
-		if x['timest'] != 0:
-			y = [x['guid'], x['guid'], str(x['timest']), x['datestr'], x['blogsource'], x['category'], x['link'], x['description'], x['author'],x ['title']]
-			res.append('"' + '","'.join(y) + '"')
+	for t in threads:
+		t.join()
 
-	while 'LastEvaluatedKey' in queryres:
+	export.close()
 
-		queryres = ddb.scan(ExclusiveStartKey = queryres['LastEvaluatedKey'], ProjectionExpression = proj_expression)
-		
-		for x in queryres['Items']:
-			
-			if x['timest'] != 0:
-				y = [x['guid'], x['guid'], str(x['timest']), x['datestr'], x['blogsource'], x['category'], x['link'], x['description'], x['author'],x ['title']]
-				res.append('"' + '","'.join(y) + '"')
-		
-	z = open('out.csv', 'w')
-	z.write('ObjectID,guid,timest,datestr,blogsource,category,link,description,author,title\n')
-	for x in res:
-		z.write(x+'\n')
-	z.close()
+	if len(errors) > 0:
+		print('exported ' + str(export.rows) + ' blogposts, ' + str(len(errors)) + ' segments failed, run the same command with --resume to continue')
+		raise SystemExit(1)
 
-dump_records_to_csv()
+	print('exported ' + str(export.rows) + ' blogposts')
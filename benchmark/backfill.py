@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# run the backfill tool with the sqlite store against the local http server with the recorded corpus, for every given amount of extraction processes
+
+import argparse, os, sqlite3, subprocess, sys, tempfile, time
+
+from server import start_server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'benchmark the backfill tool with the sqlite store on the recorded corpus')
+	parser.add_argument('--corpus', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus'))
+	parser.add_argument('--processes', type = int, nargs = '+', default = [1, os.cpu_count()], help = 'amounts of extraction processes to compare')
+	parser.add_argument('--threads', type = int, default = 16, help = 'amount of threads for the article downloads')
+	parser.add_argument('--rate', type = float, default = 0, help = 'maximum requests per second to a host, the corpus is served from one host')
+	parser.add_argument('--days', type = int, default = 3650, help = 'days of history to retrieve')
+	parser.add_argument('--latency', type = float, default = 0.0, help = 'injected http latency in seconds')
+	args = parser.parse_args()
+
+	server = start_server(args.corpus, args.latency)
+	tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools', 'backfill.py')
+
+	for processes in args.processes:
+		with tempfile.TemporaryDirectory() as workdir:
+			feeds = os.path.join(workdir, 'feeds.txt')
+
+			with open(feeds, 'w') as f:
+				for blogsource, url in server.feeds.items():
+					f.write(blogsource + ', ' + url + '\n')
+
+			cmd = [sys.executable, tool, '--store', 'sqlite', '--sqlite', os.path.join(workdir, 'backfill.db'), '--checkpoint', os.path.join(workdir, 'backfill.checkpoint'), '--feeds', feeds, '--days', str(args.days), '--threads', str(args.threads), '--processes', str(processes), '--rate', str(args.rate), '--no-comprehend']
+
+			start = time.perf_counter()
+			res = subprocess.run(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True)
+			seconds = time.perf_counter() - start
+
+			db = sqlite3.connect(os.path.join(workdir, 'backfill.db'))
+			posts = db.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+			db.close()
+
+			print('\n' + str(processes) + ' processes: ' + '%.2f' % seconds + 's, ' + str(posts) + ' blogposts, ' + '%.1f' % (posts / seconds) + ' blogposts per second' + ('' if res.returncode == 0 else ', exit code ' + str(res.returncode)))
+
+			# print the summary of the backfill tool
+			print(res.stdout[res.stdout.rfind('\nbackfilled'):].strip())
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# run the crawl and getfeed handlers in-process against moto backed aws services and a local http server with the recorded corpus
+# the report contains the wall time per stage, aws api call counts and peak memory per feed and per run
+
+import argparse, importlib.util, json, os, sys, threading, time, tracemalloc, uuid
+from types import SimpleNamespace
+
+# set the environment of the lambda functions before they are imported
+bench_env = {
+	'AWS_ACCESS_KEY_ID' : 'testing',
+	'AWS_SECRET_ACCESS_KEY' : 'testing',
+	'AWS_SESSION_TOKEN' : 'testing',
+	'AWS_DEFAULT_REGION' : 'eu-west-1',
+	'AWS_REGION' : 'eu-west-1',
+	'POWERTOOLS_TRACE_DISABLED' : 'true',
+	'POWERTOOLS_SERVICE_NAME' : 'benchmark',
+	'POWERTOOLS_METRICS_NAMESPACE' : 'benchmark',
+	'algolia_app' : '',
+	'algolia_apikey' : '',
+	'algolia_index' : '',
+	'dynamo_region' : 'eu-west-1',
+	'dynamo_table' : 'rssbench',
+	'enable_algolia' : 'n',
+	'index_blogsource' : 'timest-list',
+	'index_visible' : 'visible-list',
+	'from_email' : 'from@example.com',
+	'to_email' : 'to@example.com',
+	's3_bucket' : 'rssbench',
+	'send_mail' : 'n',
+	'storepublics3' : 'y'
+}
+
+# the pipeline functions that are timed per stage, functions that do not exist in the current code are skipped
+stages = {
+	'feed_fetch' : ['get_rss'],
+	'dedup' : ['get_guids', 'get_stored_keys'],
+	'article_fetch' : ['retrieve_url'],
+	'tag' : ['comprehend'],
+	'write' : ['flush_dynamo'],
+	'index' : ['flush_algolia'],
+	'publish' : ['update_json_s3'],
+	'mail' : ['send_bulk']
+}
+
+lambda_context = SimpleNamespace(function_name = 'benchmark', memory_limit_in_mb = 512, invoked_function_arn = 'arn:aws:lambda:eu-west-1:123456789012:function:benchmark', aws_request_id = 'benchmark')
+
+
+# collect the wall time per stage, the api call counts and the emitted metrics per blogsource of the current feed
+class Recorder:
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		self.stages = {}
+		self.calls = {}
+		self.metrics = {}
+
+	def add_stage(self, stage, duration):
+		with self.lock:
+			x = self.stages.setdefault(stage, {'seconds' : 0.0, 'calls' : 0})
+			x['seconds'] += duration
+			x['calls'] += 1
+
+	def add_call(self, name):
+		with self.lock:
+			self.calls[name] = self.calls.get(name, 0) + 1
+
+	# the local metric sink of the functions, it receives the same values as the embedded metric format documents
+	def add_metrics(self, blogsource, values):
+		with self.lock:
+			x = self.metrics.setdefault(blogsource, {})
+
+			for name, metric in values.items():
+				x[name] = x.get(name, 0) + metric['value']
+
+
+# import a lambda function module from its folder
+def load_lambda(name, path):
+	sys.path.insert(0, os.path.dirname(path))
+	spec = importlib.util.spec_from_file_location(name, path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+
+	return module
+
+
+# wrap the stage functions of a module with a timer, the functions call each other through the module globals
+def instrument(module, recorder):
+	for stage, names in stages.items():
+		for name in names:
+			if hasattr(module, name):
+				setattr(module, name, timed(getattr(module, name), stage, recorder))
+
+
+def timed(func, stage, recorder):
+	def wrapper(*args, **kwargs):
+		start = time.perf_counter()
+
+		try:
+			return func(*args, **kwargs)
+
+		finally:
+			recorder.add_stage(stage, time.perf_counter() - start)
+
+	return wrapper
+
+
+# count every aws api call and answer comprehend calls locally, as moto does not implement entity detection
+def register_aws_hooks(recorder):
+	import boto3, botocore.awsrequest
+
+	def count_call(model, **kwargs):
+		recorder.add_call(model.service_model.service_name + '.' + model.name)
+
+	# the params of the before-call event are the serialized request, comprehend uses a json body
+	def comprehend_standin(model, params, **kwargs):
+		params = json.loads(params['body'])
+
+		def entities(text):
+			return [{'Type' : 'ORGANIZATION', 'Text' : x, 'Score' : 0.99, 'BeginOffset' : 0, 'EndOffset' : len(x)} for x in sorted(set(w for w in text.split() if w[:1].isupper()))[:10]]
+
+		if model.name == 'DetectEntities':
+			parsed = {'Entities' : entities(params['Text'])}
+
+		elif model.name == 'BatchDetectEntities':
+			parsed = {'ResultList' : [{'Index' : i, 'Entities' : entities(x)} for i, x in enumerate(params['TextList'])], 'ErrorList' : []}
+
+		else:
+			return None
+
+		return botocore.awsrequest.AWSResponse('https://comprehend.local', 200, {}, None), parsed
+
+	# the moto backends are not thread safe, so the mocked calls are serialized as the functions call aws from several threads
+	from moto.core.botocore_stubber import BotocoreStubber
+	lock = threading.Lock()
+	stub = BotocoreStubber.__call__
+
+	def locked_stub(self, *args, **kwargs):
+		with lock:
+			return stub(self, *args, **kwargs)
+
+	BotocoreStubber.__call__ = locked_stub
+
+	boto3.setup_default_session()
+	boto3.DEFAULT_SESSION.events.register('before-call.*.*', count_call)
+	boto3.DEFAULT_SESSION.events.register('before-call.comprehend.*', comprehend_standin)
+
+
+# the attributes that the '-list' indexes of the sam template project besides the key attributes
+list_attributes = ['title', 'link', 'author', 'description', 'datestr', 'articlecount']
+
+# create the dynamodb table, s3 bucket and ses identity like the sam template does
+def create_resources():
+	import boto3
+
+	boto3.client('dynamodb').create_table(
+		TableName = bench_env['dynamo_table'],
+		BillingMode = 'PAY_PER_REQUEST',
+		AttributeDefinitions = [
+			{'AttributeName' : 'guid', 'AttributeType' : 'S'},
+			{'AttributeName' : 'timest', 'AttributeType' : 'N'},
+			{'AttributeName' : 'visible', 'AttributeType' : 'S'},
+			{'AttributeName' : 'blogsource', 'AttributeType' : 'S'}
+		],
+		KeySchema = [{'AttributeName' : 'guid', 'KeyType' : 'HASH'}, {'AttributeName' : 'timest', 'KeyType' : 'RANGE'}],
+		GlobalSecondaryIndexes = [
+			{'IndexName' : bench_env['index_visible'], 'KeySchema' : [{'AttributeName' : 'visible', 'KeyType' : 'HASH'}, {'AttributeName' : 'timest', 'KeyType' : 'RANGE'}], 'Projection' : {'ProjectionType' : 'INCLUDE', 'NonKeyAttributes' : ['blogsource'] + list_attributes}},
+			{'IndexName' : bench_env['index_blogsource'], 'KeySchema' : [{'AttributeName' : 'blogsource', 'KeyType' : 'HASH'}, {'AttributeName' : 'timest', 'KeyType' : 'RANGE'}], 'Projection' : {'ProjectionType' : 'INCLUDE', 'NonKeyAttributes' : list_attributes}}
+		]
+	)
+
+	boto3.client('s3').create_bucket(Bucket = bench_env['s3_bucket'], CreateBucketConfiguration = {'LocationConstraint' : bench_env['AWS_REGION']})
+	boto3.client('ses').verify_email_identity(EmailAddress = bench_env['from_email'])
+
+
+# move the poll schedule of every feed back in time, so the next run happens as if the given amount of seconds passed
+def age_feed_states(seconds):
+	import boto3
+	from boto3.dynamodb.conditions import Attr
+
+	ddb = boto3.resource('dynamodb').Table(bench_env['dynamo_table'])
+
+	scan = {'FilterExpression' : Attr('timest').eq(-1)}
+
+	while True:
+		res = ddb.scan(**scan)
+
+		for x in res['Items']:
+			values = { ':' + k : int(x[k]) - seconds for k in ['checked', 'nextpoll', 'lastchange'] if k in x }
+
+			if len(values) > 0:
+				ddb.update_item(Key = {'guid' : x['guid'], 'timest' : -1}, UpdateExpression = 'SET ' + ', '.join(k[1:] + ' = ' + k for k in values), ExpressionAttributeValues = values)
+
+		if 'LastEvaluatedKey' not in res:
+			return
+
+		scan['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+
+# create the getfeed event for a crawl result, like the map state of the state machine does with the name of the execution as digest run
+def getfeed_event(crawlres, msg, digest_run):
+	event = {'msg' : msg, 'digest_run' : digest_run}
+
+	for x in ['send_mail', 'mail_mode', 'from_email', 'to_email', 's3_bucket', 'dynamo_table', 'enable_algolia', 'algolia_app', 'algolia_apikey', 'algolia_index', 'storepublics3', 'rebuild']:
+		event[x] = crawlres[x]
+
+	return event
+
+
+# run the crawl function and a getfeed invocation per discovered feed or batch of feeds
+def run_pipeline(crawl, getfeed, recorder, days):
+	run = {'feeds' : {}}
+
+	tracemalloc.start()
+	start = time.perf_counter()
+	recorder.reset()
+
+	crawlres = crawl.handler({'msg' : {'days' : days}}, lambda_context)
+
+	run['crawl'] = {'seconds' : time.perf_counter() - start, 'api_calls' : recorder.calls, 'metrics' : recorder.metrics, 'peak_mb' : tracemalloc.get_traced_memory()[1] / 1048576}
+
+	# the digest entries of the invocations are stored under the name of the run, like the execution name of the state machine
+	digest_run = uuid.uuid4().hex
+
+	for msg in crawlres['results']:
+		tracemalloc.stop()
+		tracemalloc.start()
+		recorder.reset()
+
+		feedstart = time.perf_counter()
+		error = None
+
+		# a batch of feeds is reported under the joined blogsource names
+		msgs = msg if isinstance(msg, list) else [msg]
+		newposts = 0
+
+		try:
+			res = getfeed.handler(getfeed_event(crawlres, msg, digest_run), lambda_context)
+			newposts = sum(len(x['newblogs']) for x in res['results'])
+			errors = [x['blogsource'] + ' ' + x['error'] for x in res['results'] if x['error'] is not None]
+
+			if len(errors) > 0:
+				error = ', '.join(errors)
+
+		except Exception as e:
+			error = str(e)
+
+		run['feeds'][', '.join(x['blogsource'] for x in msgs)] = {
+			'seconds' : time.perf_counter() - feedstart,
+			'new_posts' : newposts,
+			'stages' : recorder.stages,
+			'api_calls' : recorder.calls,
+			'metrics' : recorder.metrics,
+			'peak_mb' : tracemalloc.get_traced_memory()[1] / 1048576,
+			'error' : error
+		}
+
+	tracemalloc.stop()
+
+	# send the digest with the entries of all invocations, like the state machine does after the map state
+	if crawlres['send_mail'] == 'y' and crawlres['mail_mode'] == 'digest':
+		recorder.reset()
+		getfeed.handler({'msg' : 'digest', 'digest_run' : digest_run, 's3_bucket' : crawlres['s3_bucket'], 'send_mail' : 'y', 'from_email' : crawlres['from_email'], 'to_email' : crawlres['to_email']}, lambda_context)
+		run['crawl']['api_calls'].update({ k : run['crawl']['api_calls'].get(k, 0) + v for k, v in recorder.calls.items() })
+
+	# add the totals of the run
+	run['seconds'] = time.perf_counter() - start
+	run['peak_mb'] = max([run['crawl']['peak_mb']] + [x['peak_mb'] for x in run['feeds'].values()])
+	run['new_posts'] = sum(x['new_posts'] for x in run['feeds'].values())
+	run['invocations'] = len(run['feeds'])
+	run['stages'] = {}
+	run['api_calls'] = dict(run['crawl']['api_calls'])
+	run['metrics'] = {}
+
+	# sum the metrics of every blogsource, the report keeps the metrics per blogsource for every feed
+	for x in [run['crawl']] + list(run['feeds'].values()):
+		for values in x['metrics'].values():
+			for name, value in values.items():
+				run['metrics'][name] = run['metrics'].get(name, 0) + value
+
+	for x in run['feeds'].values():
+		for stage, y in x['stages'].items():
+			total = run['stages'].setdefault(stage, {'seconds' : 0.0, 'calls' : 0})
+			total['seconds'] += y['seconds']
+			total['calls'] += y['calls']
+
+		for call, count in x['api_calls'].items():
+			run['api_calls'][call] = run['api_calls'].get(call, 0) + count
+
+	return run
+
+
+# print a summary of a run, optionally compared to a previous report
+def print_run(i, run, previous):
+	print('\nrun ' + str(i + 1) + ': ' + '%.2f' % run['seconds'] + 's, ' + str(run['new_posts']) + ' new posts, peak ' + '%.1f' % run['peak_mb'] + ' MB, ' + str(run['invocations']) + ' getfeed invocations, ' + str(sum(run['api_calls'].values())) + ' api calls, ' + str(run['http']['requests']) + ' http requests over ' + str(run['http']['connections']) + ' connections')
+
+	for stage, x in sorted(run['stages'].items()):
+		line = '  %-14s %8.3fs %6d calls' % (stage, x['seconds'], x['calls'])
+
+		if previous is not None and stage in previous['stages']:
+			line += '  (%+.3fs)' % (x['seconds'] - previous['stages'][stage]['seconds'])
+
+		print(line)
+
+	for call, count in sorted(run['api_calls'].items()):
+		print('  %-40s %6d' % (call, count))
+
+	for name, value in sorted(run['metrics'].items()):
+		print('  metric %-33s %12.1f' % (name, value))
+
+	for blogsource, x in sorted(run['feeds'].items()):
+		if x['error'] is not None:
+			print('  failed ' + blogsource + ' : ' + x['error'])
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'offline benchmark of the crawl and getfeed functions')
+	parser.add_argument('--corpus', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus'))
+	parser.add_argument('--feeds', type = int, default = 0, help = 'limit the amount of feeds, 0 for all')
+	parser.add_argument('--runs', type = int, default = 2, help = 'amount of runs, the first run ingests the corpus and later runs find no new posts')
+	parser.add_argument('--days', type = int, default = 89, help = 'days input for the crawl function in the first run')
+	parser.add_argument('--poll-days', type = int, default = 1, help = 'days input for the crawl function in later runs, like the scheduled state machine')
+	parser.add_argument('--latency', type = float, default = 0.0, help = 'injected http latency in seconds')
+	parser.add_argument('--jitter', type = float, default = 0.0, help = 'random extra http latency in seconds')
+	parser.add_argument('--batch-weight', type = int, default = 1, help = 'batch weight of the crawl function, 1 invokes getfeed per feed')
+	parser.add_argument('--mail-mode', default = None, choices = ['post', 'digest'], help = 'send emails per blogpost or as a digest per run')
+	parser.add_argument('--body-storage', default = 'inline', choices = ['inline', 'zlib', 's3'], help = 'body storage option of the getfeed function')
+	parser.add_argument('--schedule', action = 'store_true', help = 'only poll the feeds that are due according to the poll schedule of the crawl function')
+	parser.add_argument('--tick', type = int, default = 900, help = 'seconds that pass between runs for the poll schedule, like the state machine schedule')
+	parser.add_argument('--output', default = None, help = 'write the json report to this file')
+	parser.add_argument('--compare', default = None, help = 'compare with a previous json report')
+	args = parser.parse_args()
+
+	os.environ.update(bench_env)
+	os.environ['batch_weight'] = str(args.batch_weight)
+	os.environ['body_storage'] = args.body_storage
+	os.environ['poll_schedule'] = 'y' if args.schedule else 'n'
+
+	if args.mail_mode is not None:
+		os.environ['send_mail'] = 'y'
+		os.environ['mail_mode'] = args.mail_mode
+
+	from moto import mock_aws
+	from server import start_server
+
+	server = start_server(args.corpus, args.latency, args.jitter)
+	recorder = Recorder()
+
+	with mock_aws():
+		register_aws_hooks(recorder)
+		create_resources()
+
+		# write a feeds.txt with the local urls in a work folder, the crawl function reads it from the working directory
+		workdir = os.path.join(args.corpus, 'work')
+		os.makedirs(workdir, exist_ok = True)
+		feeds = list(server.feeds.items())
+
+		if args.feeds > 0:
+			feeds = feeds[:args.feeds]
+
+		with open(os.path.join(workdir, 'feeds.txt'), 'w') as f:
+			for blogsource, url in feeds:
+				f.write(blogsource + ', ' + url + '\n')
+
+		os.chdir(workdir)
+
+		root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+		crawl = load_lambda('crawl', os.path.join(root, 'lambda-crawl', 'crawl.py'))
+		getfeed = load_lambda('getfeed', os.path.join(root, 'lambda-getfeed', 'getfeed.py'))
+		instrument(getfeed, recorder)
+
+		# collect the metrics of the functions in the report, besides the embedded metric format documents in the output
+		crawl.metric_sink = recorder.add_metrics
+		getfeed.metric_sink = recorder.add_metrics
+
+		report = {'args' : vars(args), 'started' : int(time.time()), 'runs' : []}
+		previous = None
+
+		if args.compare:
+			with open(args.compare) as f:
+				previous = json.load(f)
+
+		for i in range(args.runs):
+			if i > 0 and args.schedule:
+				age_feed_states(args.tick)
+
+			before = dict(server.stats)
+			run = run_pipeline(crawl, getfeed, recorder, args.days if i == 0 else args.poll_days)
+			run['http'] = { k : server.stats[k] - before[k] for k in before }
+			report['runs'].append(run)
+
+			prevrun = None
+
+			if previous is not None and i < len(previous['runs']):
+				prevrun = previous['runs'][i]
+
+			print_run(i, run, prevrun)
+
+	if args.output:
+		os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok = True)
+
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent = 1)
+
+		print('\nwrote report to ' + args.output)
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# compare the cpu time and peak memory per article of the article extraction in getfeed with the previous readability and beautifulsoup path
+
+import argparse, ast, json, os, re, time, tracemalloc
+
+from bench import bench_env, load_lambda
+
+
+# the previous extraction path, which parsed the readability summary again with the beautifulsoup html.parser
+def extract_bs4(html):
+	import readability
+	from bs4 import BeautifulSoup
+
+	doc = readability.Document(html)
+	rawhtml = doc.summary(html_partial = True)
+
+	soup = BeautifulSoup(rawhtml, 'html.parser')
+	cleantext = soup.get_text().strip('\n').encode('utf-8')
+
+	return str(rawhtml), str(cleantext)
+
+
+# run an extraction function for every article and return the cpu time and peak memory per article
+def measure(func, pages, repeat):
+	cpu = []
+	peak = []
+
+	for html in pages:
+		best = None
+
+		for x in range(repeat):
+			start = time.process_time()
+			func(html)
+			duration = time.process_time() - start
+
+			if best is None or duration < best:
+				best = duration
+
+		cpu.append(best)
+
+		tracemalloc.start()
+		func(html)
+		peak.append(tracemalloc.get_traced_memory()[1])
+		tracemalloc.stop()
+
+	return cpu, peak
+
+
+def summary(name, cpu, peak):
+	cpu = sorted(cpu)
+	peak = sorted(peak)
+
+	print('%-10s cpu per article: mean %6.2f ms, p50 %6.2f ms, max %6.2f ms  peak memory: mean %6.2f MB, max %6.2f MB' % (name, 1000 * sum(cpu) / len(cpu), 1000 * cpu[len(cpu) // 2], 1000 * cpu[-1], sum(peak) / len(peak) / 1048576, peak[-1] / 1048576))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'compare the article extraction paths on the corpus')
+	parser.add_argument('--corpus', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus'))
+	parser.add_argument('--limit', type = int, default = 100, help = 'amount of articles to measure')
+	parser.add_argument('--repeat', type = int, default = 3, help = 'runs per article, the fastest run is kept')
+	args = parser.parse_args()
+
+	os.environ.update(bench_env)
+	getfeed = load_lambda('getfeed', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-getfeed', 'getfeed.py'))
+
+	with open(os.path.join(args.corpus, 'index.json')) as f:
+		index = json.load(f)
+
+	pages = []
+
+	for url, entry in index['urls'].items():
+		if entry['type'].startswith('text/html') and len(pages) < args.limit:
+			with open(os.path.join(args.corpus, 'files', entry['file']), 'rb') as f:
+				pages.append(f.read().decode('utf-8', 'ignore'))
+
+	print('measuring ' + str(len(pages)) + ' articles')
+
+	# check that both paths extract the same text ignoring whitespace, the previous path returned the repr of the utf-8 bytes
+	mismatch = 0
+
+	for html in pages:
+		old = ast.literal_eval(extract_bs4(html)[1]).decode('utf-8')
+
+		if re.sub(r'\s+', '', old) != re.sub(r'\s+', '', getfeed.extract_article(html)[1]):
+			mismatch += 1
+
+	print(str(mismatch) + ' articles with a different text')
+
+	summary('bs4', *measure(extract_bs4, pages, args.repeat))
+	summary('lxml', *measure(getfeed.extract_article, pages, args.repeat))
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# compare the parse time and peak memory of the streaming feed reader in getfeed with a full feedparser parse on the largest feeds
+
+import argparse, email.utils, json, os, random, time, tracemalloc
+
+from bench import bench_env, load_lambda
+
+
+# generate a large rss or atom feed with an entry every few hours, like the 'whats-new' and 'newsblog' feeds
+def synthesize(fmt, entries, seed):
+	rnd = random.Random(seed)
+	now = int(time.time())
+	items = []
+
+	for i in range(entries):
+		ts = now - (i * 4 * 3600) - rnd.randint(0, 3600)
+		text = ' '.join(rnd.choice(['aws', 'lambda', 'amazon', 'region', 'launch', 'support', 'now', 'available']) for x in range(60))
+
+		if fmt == 'rss':
+			items.append('<item><title>post ' + str(i) + '</title><link>https://example.com/post-' + str(i) + '/</link><guid>post-' + str(i) + '</guid>'
+				+ '<pubDate>' + email.utils.formatdate(ts, usegmt = True) + '</pubDate><category>news</category><description>' + text + '</description></item>')
+
+		else:
+			items.append('<entry><title>post ' + str(i) + '</title><link rel="alternate" href="https://example.com/post-' + str(i) + '/"/><id>post-' + str(i) + '</id>'
+				+ '<updated>' + time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts)) + '</updated><author><name>author</name></author><category term="news"/><summary>' + text + '</summary></entry>')
+
+	if fmt == 'rss':
+		return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>synthetic</title>' + ''.join(items) + '</channel></rss>').encode('utf-8')
+
+	return ('<?xml version="1.0" encoding="UTF-8"?><feed xmlns="http://www.w3.org/2005/Atom"><title>synthetic</title>' + ''.join(items) + '</feed>').encode('utf-8')
+
+
+# parse the complete feed with feedparser
+def parse_full(getfeed, body, cutoff):
+	import feedparser
+
+	return feedparser.parse(body)['entries']
+
+
+# parse the feed in chunks like the download in getfeed, until the reader has all entries within the cutoff
+def parse_stream(getfeed, body, cutoff):
+	reader = getfeed.FeedReader(cutoff)
+
+	for i in range(0, len(body), 65536):
+		if not reader.feed(body[i:i + 65536]):
+			break
+
+	if not reader.close():
+		raise Exception('streaming parse failed : ' + str(reader.error))
+
+	return reader.entries
+
+
+# run a parse function and return the fastest cpu time, the peak memory and the guids within the cutoff
+def measure(func, getfeed, body, cutoff, repeat):
+	best = None
+
+	for x in range(repeat):
+		start = time.process_time()
+		entries = func(getfeed, body, cutoff)
+		duration = time.process_time() - start
+
+		if best is None or duration < best:
+			best = duration
+
+	tracemalloc.start()
+	func(getfeed, body, cutoff)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	guids = set(str(x['guid']) for x in entries if time.mktime(x['updated_parsed']) >= cutoff)
+
+	return best, peak, guids, len(entries)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'compare the streaming feed reader with feedparser')
+	parser.add_argument('--corpus', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus'))
+	parser.add_argument('--feeds', type = int, default = 5, help = 'amount of the largest corpus feeds to measure')
+	parser.add_argument('--entries', type = int, default = 500, help = 'entries of the synthetic rss and atom feeds, 0 to skip these')
+	parser.add_argument('--days', type = int, nargs = '+', default = [1, 89], help = 'days to retrieve for the cutoff')
+	parser.add_argument('--repeat', type = int, default = 3, help = 'runs per feed, the fastest run is kept')
+	args = parser.parse_args()
+
+	os.environ.update(bench_env)
+	getfeed = load_lambda('getfeed', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-getfeed', 'getfeed.py'))
+
+	feeds = []
+
+	if os.path.exists(os.path.join(args.corpus, 'index.json')):
+		with open(os.path.join(args.corpus, 'index.json')) as f:
+			index = json.load(f)
+
+		for blogsource, url in index['feeds'].items():
+			with open(os.path.join(args.corpus, 'files', index['urls'][url]['file']), 'rb') as f:
+				feeds.append((blogsource, f.read()))
+
+		feeds = sorted(feeds, key = lambda k: len(k[1]), reverse = True)[:args.feeds]
+
+	if args.entries > 0:
+		feeds.append(('synthetic-rss', synthesize('rss', args.entries, 1)))
+		feeds.append(('synthetic-atom', synthesize('atom', args.entries, 2)))
+
+	# the cpu time, peak memory and parsed entries are listed for feedparser first and the streaming reader second
+	print('%-18s %5s %9s | %9s %9s %8s | %9s %9s %8s | %s' % ('feed', 'days', 'bytes', 'cpu ms', 'peak MB', 'entries', 'cpu ms', 'peak MB', 'entries', 'same guids'))
+
+	for blogsource, body in feeds:
+		for days in args.days:
+			cutoff = int(time.time()) - (86400 * days)
+			full = measure(parse_full, getfeed, body, cutoff, args.repeat)
+			stream = measure(parse_stream, getfeed, body, cutoff, args.repeat)
+
+			print('%-18s %5d %9d | %9.2f %9.2f %8d | %9.2f %9.2f %8d | %s' % (blogsource, days, len(body), 1000 * full[0], full[1] / 1048576, full[3], 1000 * stream[0], stream[1] / 1048576, stream[3], 'yes' if full[2] == stream[2] else 'NO'))
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# measure the import time of the lambda functions with 'python -X importtime', which is the main part of their cold start
+# the result is compared with the stored baseline, so cold start regressions are caught
+# the import times are compared relative to the import of the shared boto3 and powertools dependencies, measured in the same run,
+# as absolute times differ per machine and per run
+
+import argparse, json, os, subprocess, sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# the lambda functions to measure with their folder and module name
+functions = {
+	'crawl' : ('lambda-crawl', 'crawl'),
+	'getfeed' : ('lambda-getfeed', 'getfeed'),
+	'pagecount' : ('lambda-pagecount', 'pagecount')
+}
+
+# the shared dependencies of the lambda functions, their import time is the reference for the import time of the functions
+reference = ['boto3', 'aws_lambda_powertools']
+
+# set the environment variables the lambda functions read at import time
+lambda_env = {
+	'AWS_REGION' : 'eu-west-1',
+	'AWS_DEFAULT_REGION' : 'eu-west-1',
+	'POWERTOOLS_TRACE_DISABLED' : 'true',
+	'dynamo_region' : 'eu-west-1',
+	'dynamo_table' : 'rssbench'
+}
+
+
+# import modules in a fresh interpreter and return their cumulative import time and the time per direct import in microseconds
+def measure(folder, modules):
+	env = dict(os.environ)
+	env.update(lambda_env)
+
+	res = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)], cwd = os.path.join(root, folder), env = env, capture_output = True, text = True)
+
+	if res.returncode != 0:
+		raise Exception('failed to import ' + ', '.join(modules) + ' : ' + res.stderr.strip().splitlines()[-1])
+
+	total = 0
+	imports = {}
+
+	# lines look like 'import time:       self [us] |  cumulative | imported package', nested imports are indented by two spaces per level
+	for line in res.stderr.splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+
+		selftime, cumulative, name = line[len('import time:'):].split('|')
+		level = (len(name) - len(name.lstrip()) - 1) // 2
+
+		if level == 0 and name.strip() in modules:
+			total += int(cumulative)
+
+		elif level == 1:
+			imports[name.strip()] = imports.get(name.strip(), 0) + int(cumulative)
+
+	return total, imports
+
+
+# measure the reference imports and every function in rounds, the relative time of a function is its import time divided by the reference time
+# of the same round, so a machine that gets busier or quieter during the run affects both times. the median of the rounds is kept
+def run(repeat):
+	rounds = {function : [] for function in functions}
+	references = []
+
+	for x in range(repeat):
+		ref = measure(root, reference)[0]
+		references.append(ref)
+
+		for function, (folder, module) in functions.items():
+			total, imports = measure(folder, [module])
+			rounds[function].append((total / float(ref), total, imports))
+
+	result = {'reference_us' : sorted(references)[len(references) // 2]}
+
+	for function, x in rounds.items():
+		relative, total, imports = sorted(x, key = lambda k: k[0])[len(x) // 2]
+		top = sorted(imports.items(), key = lambda k: k[1], reverse = True)[:10]
+		result[function] = {'total_us' : total, 'relative' : round(relative, 3), 'top' : dict(top)}
+
+	return result
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'measure the import time of the lambda functions')
+	parser.add_argument('--baseline', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'importtime.json'))
+	parser.add_argument('--repeat', type = int, default = 5)
+	parser.add_argument('--threshold', type = float, default = 0.25, help = 'allowed increase of the relative import time compared to the baseline')
+	parser.add_argument('--update', action = 'store_true', help = 'store the result as the new baseline')
+	args = parser.parse_args()
+
+	result = run(args.repeat)
+	baseline = {}
+
+	if os.path.exists(args.baseline):
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+
+	failed = False
+	print('%-10s %8.1f ms' % ('reference', result['reference_us'] / 1000))
+
+	for function, x in result.items():
+		if function == 'reference_us':
+			continue
+
+		line = '%-10s %8.1f ms %6.2fx reference' % (function, x['total_us'] / 1000, x['relative'])
+
+		# compare the time relative to the reference, so a slower or busier machine does not show up as a regression
+		if 'relative' in baseline.get(function, {}):
+			diff = (x['relative'] - baseline[function]['relative']) / baseline[function]['relative']
+			line += '  (%+.0f%% compared to baseline)' % (diff * 100)
+
+			if diff > args.threshold:
+				line += '  REGRESSION'
+				failed = True
+
+		print(line)
+
+		for module, us in x['top'].items():
+			print('    %-40s %8.1f ms' % (module, us / 1000))
+
+	if args.update:
+		with open(args.baseline, 'w') as f:
+			json.dump(result, f, indent = 1)
+
+		print('stored baseline in ' + args.baseline)
+
+	# exit with an error on a regression, so the check can run in a build pipeline
+	if failed:
+		sys.exit(1)
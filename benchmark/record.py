@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# record the feeds in 'feeds.txt' and their article pages into a local corpus for the benchmark harness
+# alternatively, generate a synthetic corpus with the same feeds if no network access is available
+
+import argparse, email.utils, feedparser, hashlib, json, os, random, requests, time
+
+firefox = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:79.0) Gecko/20100101 Firefox/79.0"
+
+words = "aws lambda serverless amazon dynamodb table stream function region service customer build deploy cost latency storage bucket cluster network security data model query index event queue topic".split()
+
+
+# read the blogsource and url values from the feeds file
+def read_feeds(feedsfile):
+	feeds = {}
+
+	with open(feedsfile) as fp:
+		for line in fp:
+			if ',' in line:
+				src, url = line.split(',')
+				feeds[src.strip()] = url.strip()
+
+	return feeds
+
+
+# store a downloaded or generated body in the corpus and add it to the index
+def store(corpus, index, url, body, contenttype):
+	fname = hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+	with open(os.path.join(corpus, 'files', fname), 'wb') as f:
+		f.write(body)
+
+	index[url] = {'file' : fname, 'type' : contenttype}
+
+
+# download the feeds and up to max_articles article pages per feed
+def record(feeds, corpus, index, max_articles):
+
+	for blogsource, url in feeds.items():
+		print('recording ' + blogsource + ' from ' + url)
+
+		try:
+			req = requests.get(url, headers = {'User-Agent' : firefox}, timeout = 30)
+			store(corpus, index, url, req.content, req.headers.get('Content-Type', 'application/rss+xml'))
+
+			for x in feedparser.parse(req.content)['entries'][:max_articles]:
+				page = requests.get(x['link'], headers = {'User-Agent' : firefox}, timeout = 30)
+				store(corpus, index, x['link'], page.content, 'text/html; charset=utf-8')
+
+		except Exception as e:
+			print('failed to record ' + blogsource + ' : ' + str(e))
+
+
+# generate a paragraph of random text
+def paragraph(rnd, length):
+	return ' '.join(rnd.choice(words).capitalize() if rnd.random() < 0.1 else rnd.choice(words) for x in range(length)) + '.'
+
+
+# generate an rss feed with entries spread over the last days and an article page per entry
+def synthesize(feeds, corpus, index, entries, paragraphs, seed):
+	rnd = random.Random(seed)
+	now = int(time.time())
+
+	for blogsource, url in feeds.items():
+		items = []
+
+		for i in range(entries):
+			link = 'https://aws.amazon.com/blogs/' + blogsource + '/post-' + str(i) + '/'
+			ts = now - (i * 3 * 3600) - rnd.randint(0, 3600)
+			title = paragraph(rnd, 8).rstrip('.')
+
+			items.append('<item><title>' + title + '</title><link>' + link + '</link><guid isPermaLink="false">' + blogsource + '-' + str(i) + '</guid>'
+				+ '<pubDate>' + email.utils.formatdate(ts, usegmt = True) + '</pubDate><dc:creator>Author ' + str(i % 5) + '</dc:creator>'
+				+ '<category>' + blogsource + '</category><description>' + paragraph(rnd, 40) + '</description></item>')
+
+			body = '<html><head><title>' + title + '</title></head><body><nav><a href="/">home</a></nav><article><h1>' + title + '</h1>'
+			body += ''.join('<p>' + paragraph(rnd, 80) + '</p>' for x in range(paragraphs))
+			body += '</article><footer>footer</footer></body></html>'
+
+			store(corpus, index, link, body.encode('utf-8'), 'text/html; charset=utf-8')
+
+		feed = '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"><channel><title>' + blogsource + '</title>'
+		feed += '<link>' + url + '</link>' + ''.join(items) + '</channel></rss>'
+
+		store(corpus, index, url, feed.encode('utf-8'), 'application/rss+xml; charset=utf-8')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'record or generate the benchmark corpus')
+	parser.add_argument('--feeds', default = os.path.join(os.path.dirname(__file__), '..', 'lambda-crawl', 'feeds.txt'))
+	parser.add_argument('--corpus', default = os.path.join(os.path.dirname(__file__), 'corpus'))
+	parser.add_argument('--max-articles', type = int, default = 10, help = 'articles to record per feed')
+	parser.add_argument('--synthetic', action = 'store_true', help = 'generate a synthetic corpus instead of recording')
+	parser.add_argument('--entries', type = int, default = 20, help = 'entries per synthetic feed')
+	parser.add_argument('--paragraphs', type = int, default = 30, help = 'paragraphs per synthetic article')
+	parser.add_argument('--seed', type = int, default = 1)
+	args = parser.parse_args()
+
+	os.makedirs(os.path.join(args.corpus, 'files'), exist_ok = True)
+	index = {}
+	feeds = read_feeds(args.feeds)
+
+	if args.synthetic:
+		synthesize(feeds, args.corpus, index, args.entries, args.paragraphs, args.seed)
+
+	else:
+		record(feeds, args.corpus, index, args.max_articles)
+
+	with open(os.path.join(args.corpus, 'index.json'), 'w') as f:
+		json.dump({'feeds' : feeds, 'urls' : index}, f, indent = 1)
+
+	print('stored ' + str(len(index)) + ' urls in ' + args.corpus)
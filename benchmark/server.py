@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# serve a recorded corpus over local http with injectable latency, urls are served as http://<host>:<port>/h/<original host and path>
+
+import hashlib, json, os, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# start a threaded http server for the corpus in the background and return it
+def start_server(corpus, latency = 0.0, jitter = 0.0, port = 0):
+
+	with open(os.path.join(corpus, 'index.json')) as f:
+		index = json.load(f)
+
+	server = ThreadingHTTPServer(('127.0.0.1', port), CorpusHandler)
+	server.daemon_threads = True
+	server.corpus = corpus
+	server.latency = latency
+	server.jitter = jitter
+	server.base = 'http://127.0.0.1:' + str(server.server_address[1]) + '/h/'
+	server.stats = {'requests' : 0, 'not_modified' : 0, 'bytes' : 0, 'connections' : 0}
+	server.lock = threading.Lock()
+
+	# map the local paths to the corpus files
+	server.paths = {}
+
+	for url, entry in index['urls'].items():
+		server.paths['/h/' + re.sub(r'^https?://', '', url)] = entry
+
+	server.feeds = {}
+
+	for blogsource, url in index['feeds'].items():
+		server.feeds[blogsource] = local_url(server, url)
+
+	t = threading.Thread(target = server.serve_forever)
+	t.daemon = True
+	t.start()
+
+	return server
+
+
+# rewrite an original url to the local server
+def local_url(server, url):
+	return re.sub(r'^https?://', server.base, url)
+
+
+class CorpusHandler(BaseHTTPRequestHandler):
+
+	# use http/1.1 so clients can keep connections alive
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	# count the connections, to measure connection reuse by the clients
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+
+		with self.server.lock:
+			self.server.stats['connections'] += 1
+
+	def do_GET(self):
+		server = self.server
+
+		# add the injected latency before answering
+		delay = server.latency + random.uniform(0, server.jitter)
+
+		if delay > 0:
+			time.sleep(delay)
+
+		entry = server.paths.get(self.path)
+
+		if entry is None:
+			self.send_response(404)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		with open(os.path.join(server.corpus, 'files', entry['file']), 'rb') as f:
+			body = f.read()
+
+		# rewrite the links in feeds and pages to the local server
+		body = re.sub(rb'https?://((?:aws\.amazon\.com|[a-z0-9.-]+\.[a-z]+)/[^"<\s]*)', lambda m: (server.base + m.group(1).decode('utf-8')).encode('utf-8') if ('/h/' + m.group(1).decode('utf-8')) in server.paths else m.group(0), body)
+		etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+		with server.lock:
+			server.stats['requests'] += 1
+
+		# answer with a 304 if the client sent the current etag
+		if self.headers.get('If-None-Match') == etag:
+			with server.lock:
+				server.stats['not_modified'] += 1
+
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		with server.lock:
+			server.stats['bytes'] += len(body)
+
+		self.send_response(200)
+		self.send_header('Content-Type', entry['type'])
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('ETag', etag)
+		self.end_headers()
+		self.wfile.write(body)
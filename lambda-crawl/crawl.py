@@ -2,52 +2,107 @@
 # @marekq
 # www.marek.rocks
 
-import base64, botocore, boto3, csv, feedparser
-import gzip, json, os, re, readability, requests
-import queue, sys, threading, time
+import boto3, functools, json, os
+import queue, threading, time
 
-from aws_lambda_powertools import Logger, Tracer
-from boto3.dynamodb.conditions import Key, Attr
-from datetime import date, datetime, timedelta
-from bs4 import BeautifulSoup
+from aws_lambda_powertools import Logger, Metrics, Tracer
+from aws_lambda_powertools.metrics import MetricUnit
 
 logger = Logger()
-modules_to_be_patched = ["botocore", "boto3", "requests"]
+modules_to_be_patched = ["botocore", "boto3"]
 tracer = Tracer(patch_modules = modules_to_be_patched)
 
-# establish a session with SES, DynamoDB and Comprehend
-ddb = boto3.resource('dynamodb', region_name = os.environ['dynamo_region'], config = botocore.client.Config(max_pool_connections = 50)).Table(os.environ['dynamo_table'])
-s3 = boto3.client('s3')
+# emit the metrics of an invocation in the cloudwatch embedded metric format, under the 'all' blogsource like the getfeed function
+metrics = Metrics(namespace = os.environ.get('POWERTOOLS_METRICS_NAMESPACE', 'rssblog'))
+metric_buffer = {}
+metric_lock = threading.Lock()
 
+# an optional function that receives the metrics when these are emitted, the benchmark uses it as a local sink
+metric_sink = None
 
-# create a queue for multiprocessing
-q1 = queue.Queue()
 
+# add a value to a metric, values of the same metric are summed per invocation
+def add_metric(name, unit, value):
+	with metric_lock:
+		x = metric_buffer.setdefault(name, {'unit' : unit, 'value' : 0})
+		x['value'] += value
 
-# get the blogpost guids that are already stored in DynamoDB table
-@tracer.capture_method(capture_response = False)
-def get_guids(ts):
-	guids = []
 
-	# get the guid values up to x days ago
-	queryres = ddb.query(ScanIndexForward = True, IndexName = 'visible', ProjectionExpression = 'guid', KeyConditionExpression = Key('visible').eq('y') & Key('timest').gt(ts))
+# count the aws api calls per service, the event is registered on every client that is created
+def count_api_call(model, **kwargs):
+	add_metric('ApiCalls' + model.service_model.service_name.capitalize(), MetricUnit.Count, 1)
+
+
+# emit the collected metrics at the end of every invocation, also if the invocation failed
+def log_metrics(handler):
+
+	@functools.wraps(handler)
+	def wrapper(event, context):
+		global metric_buffer
+		start = time.perf_counter()
+
+		try:
+			return handler(event, context)
+
+		finally:
+			add_metric('CrawlTime', MetricUnit.Milliseconds, 1000 * (time.perf_counter() - start))
+
+			with metric_lock:
+				buffer = metric_buffer
+				metric_buffer = {}
+
+			if metric_sink is not None:
+				metric_sink('all', buffer)
+
+			metrics.add_dimension(name = 'blogsource', value = 'all')
+
+			for name, x in sorted(buffer.items()):
+				metrics.add_metric(name = name, unit = x['unit'], value = x['value'])
+
+			metrics.flush_metrics()
+
+	return wrapper
+
+
+# create a boto3 client or resource on first use
+class LazyClient:
+
+	def __init__(self, factory):
+		self.factory = factory
+		self.client = None
+		self.lock = threading.Lock()
 
-	for x in queryres['Items']:
-		if 'guid' in x:
-			if x['guid'] not in guids:
-				guids.append(x['guid'])
+	def __getattr__(self, name):
+		if self.client is None:
+			with self.lock:
+				if self.client is None:
+					client = self.factory()
 
-	# paginate the query in case more than 100 results are returned
-	while 'LastEvaluatedKey' in queryres:
-		queryres = ddb.query(ExclusiveStartKey = queryres['LastEvaluatedKey'], ScanIndexForward = True, IndexName = 'visible', ProjectionExpression = 'guid', KeyConditionExpression = Key('visible').eq('y') & Key('timest').gt(ts))
+					# count the api calls of the client, a resource has its client under meta
+					events = client.meta.client.meta.events if hasattr(client.meta, 'client') else client.meta.events
+					events.register('before-call.*.*', count_api_call)
 
-		for x in queryres['Items']:
-			if 'guid' in x:
-				if x['guid'] not in guids:
-					guids.append(x['guid'])
+					self.client = client
 
-	print('guids found in last day : '+str(len(guids)))
-	return guids
+		return getattr(self.client, name)
+
+
+# establish a session with S3 and DynamoDB
+s3 = LazyClient(lambda: boto3.client('s3'))
+ddb = LazyClient(lambda: boto3.resource('dynamodb', region_name = os.environ['dynamo_region']).Table(os.environ['dynamo_table']))
+
+# set the maximum expected work per getfeed invocation, a feed weighs 1 plus the amount of new posts it had on its last update
+batch_weight = int(os.environ.get('batch_weight', 1))
+
+# set whether to only submit the feeds that are due according to the poll schedule the getfeed function stores per feed
+# every feed is still polled once per poll_max_interval seconds, and feeds that are due within poll_slack seconds are polled in this run
+poll_schedule = os.environ.get('poll_schedule', 'y')
+poll_max_interval = int(os.environ.get('poll_max_interval', 21600))
+poll_slack = int(os.environ.get('poll_slack', 60))
+
+
+# create a queue for multiprocessing
+q1 = queue.Queue()
 
 
 # read the url's from 'feeds.txt' stored in the lambda function
@@ -76,11 +131,17 @@ def read_feed():
 	# return the result and count value
 	return result, count
 
-# check if the s3 object exists by listing current s3 objects
+# get the published json files from the manifest written by the getfeed function, instead of listing the bucket
+@tracer.capture_method(capture_response = False)
 def get_s3_files():
-	s3list = s3.list_objects(Bucket = os.environ['s3_bucket'])
+	try:
+		s3obj = s3.get_object(Bucket = os.environ['s3_bucket'], Key = '_manifest.json')
+
+	except s3.exceptions.NoSuchKey:
+		print('could not find the manifest on s3')
+		return {}
 
-	return s3list
+	return json.loads(s3obj['Body'].read())['blogs']
 
 
 # get the contents of the dynamodb table for json object on S3
@@ -90,7 +151,7 @@ def get_feed(x):
 	blogsource = x[1]
 
 	# if the blog json is available on s3
-	if str(blogsource + '.json') in s3files:
+	if blogsource in s3files:
 		
 		ts_old = int(time.time()) - (days_to_retrieve * 1)
 
@@ -103,6 +164,73 @@ def get_feed(x):
 	print(ts_old, url, blogsource)
 	res.append({'ts': ts_old, 'url': url, 'blogsource': blogsource, 'daystoretrieve': days_to_retrieve})
 
+# get the feed state rows (guid: <blogsource>, timest: -1) written by the getfeed function
+@tracer.capture_method(capture_response = False)
+def get_feed_states(blogsources):
+	states = {}
+	keys = [{'guid': x, 'timest': -1} for x in blogsources]
+
+	for i in range(0, len(keys), 100):
+		reqs = {ddb.name: {'Keys': keys[i:i + 100], 'ProjectionExpression': 'guid, lastnew, checked, nextpoll'}}
+		attempt = 0
+
+		# retry unprocessed keys with an exponential backoff
+		while len(reqs) > 0 and attempt < 5:
+
+			if attempt > 0:
+				time.sleep(0.1 * (2 ** attempt))
+
+			res = ddb.meta.client.batch_get_item(RequestItems = reqs)
+
+			for x in res['Responses'].get(ddb.name, []):
+				states[x['guid']] = x
+
+			reqs = res.get('UnprocessedKeys', {})
+			attempt += 1
+
+		# the feeds without a state are polled, which is the same as for a new feed
+		if len(reqs) > 0:
+			print('failed to get the feed states of ' + ', '.join([x['guid'] for x in reqs[ddb.name]['Keys']]) + ' after ' + str(attempt) + ' attempts')
+
+	return states
+
+
+# check whether a feed is due for polling, new feeds without a poll schedule are always polled
+def is_due(msg, state, now):
+	if 'nextpoll' not in state:
+		return True
+
+	return int(state['nextpoll']) <= now + poll_slack or int(state.get('checked', 0)) <= now - poll_max_interval
+
+
+# get the expected work for a feed, capped so every feed fits in a batch
+def get_weight(state):
+	return min(1 + int(state.get('lastnew', 0)), batch_weight)
+
+
+# group the feeds in batches for the getfeed function, the heaviest feeds are placed first in the first batch with room left
+@tracer.capture_method(capture_response = False)
+def make_batches(feeds, states):
+	batches = []
+	weights = []
+
+	for msg in sorted(feeds, key = lambda x: get_weight(states.get(x['blogsource'], {})), reverse = True):
+		weight = get_weight(states.get(msg['blogsource'], {}))
+
+		for i in range(len(batches)):
+			if weights[i] + weight <= batch_weight:
+				batches[i].append(msg)
+				weights[i] += weight
+				break
+
+		else:
+			batches.append([msg])
+			weights.append(weight)
+
+	print('grouped ' + str(len(feeds)) + ' feeds in ' + str(len(batches)) + ' batches')
+
+	return batches
+
 # worker for queue jobs
 @tracer.capture_method(capture_response = False)
 def worker():
@@ -113,6 +241,7 @@ def worker():
 # lambda handler
 @logger.inject_lambda_context(log_event = True)
 @tracer.capture_lambda_handler
+@log_metrics
 def handler(event, context): 
 
 	# set a default value of 1 for 'days_to_retrieve'
@@ -134,6 +263,13 @@ def handler(event, context):
 		print('failed to get valid days input value from step function, proceeding with default value of 1')
 		print(e)
 
+	# check if the json files of the feeds should be rebuilt from dynamodb, with {"rebuild": "y"} as state machine input
+	rebuild = 'n'
+
+	if isinstance(event['msg'], dict) and event['msg'].get('rebuild') == 'y':
+		rebuild = 'y'
+		print('rebuilding the json files of all feeds based on state machine input')
+
 	# check if send email input value was given in step function
 	try:
 		if event['send_mail'] == 'y' or event['send_mail'] == 'yes':
@@ -154,12 +290,6 @@ def handler(event, context):
 	global s3files
 	s3files = get_s3_files()
 
-	# get the unix timestamp from days_to_retrieve days ago
-	ts_old = int(time.time()) - (86400 * days_to_retrieve)
-
-	# get post guids stored in dynamodb for days_to_retrieve
-	guids = get_guids(ts_old)
-
 	# get feed url's from local feeds.txt file
 	feeds, thr = read_feed()
 
@@ -174,10 +304,37 @@ def handler(event, context):
 		t.start()
 	q1.join()
 
-	# return results, guid and days to retrieve
+	add_metric('Feeds', MetricUnit.Count, len(res))
+	add_metric('FeedsWithoutJson', MetricUnit.Count, len([x for x in res if x['blogsource'] not in s3files]))
+
+	states = {}
+
+	if batch_weight > 1 or poll_schedule == 'y':
+		states = get_feed_states([x['blogsource'] for x in res])
+
+	# only submit the feeds that are due, a run with more days to retrieve polls every feed
+	feeds = res
+
+	if poll_schedule == 'y' and days_to_retrieve <= 1 and rebuild == 'n':
+		now = int(time.time())
+		feeds = [x for x in res if is_due(x, states.get(x['blogsource'], {}), now)]
+
+		print('polling ' + str(len(feeds)) + ' of ' + str(len(res)) + ' feeds that are due')
+
+	add_metric('FeedsDue', MetricUnit.Count, len(feeds))
+
+	# group the feeds in batches, a batch weight of 1 submits every feed separately
+	if batch_weight > 1:
+		results = make_batches(feeds, states)
+
+	else:
+		results = feeds
+
+	add_metric('Batches', MetricUnit.Count, len(results))
+
+	# return results and days to retrieve, the guids are checked per feed in the getfeed function
 	return {
-		'results': res, 
-		'guids': guids, 
+		'results': results, 
 		'daystoretrieve': str(days_to_retrieve),
 		'send_mail': send_mail,
 		'algolia_app': os.environ['algolia_app'],
@@ -190,5 +347,6 @@ def handler(event, context):
 		's3_bucket': os.environ['s3_bucket'],
 		'storepublics3': os.environ['storepublics3'],
 		'enable_algolia': os.environ['enable_algolia'],
-		'send_mail': os.environ['send_mail']
+		'mail_mode': os.environ.get('mail_mode', 'post'),
+		'rebuild': rebuild
 	}
@@ -2,52 +2,932 @@
 # @marekq
 # www.marek.rocks
 
-import base64, botocore, boto3, csv, feedparser
-import gzip, json, os, re, readability, requests
-import queue, sys, threading, time
-from algoliasearch.search_client import SearchClient
+import botocore, boto3, contextlib, email.utils, functools, hashlib, heapq, itertools, json, math, os
+import queue, random, re, requests, threading, time, urllib.parse, uuid, zlib
 
-from aws_lambda_powertools import Logger, Tracer
-from boto3.dynamodb.conditions import Key, Attr
-from datetime import date, datetime, timedelta
-from bs4 import BeautifulSoup
+from aws_lambda_powertools import Logger, Metrics, Tracer
+from aws_lambda_powertools.metrics import MetricUnit
+from boto3.dynamodb.conditions import Key
 
+# feedparser, readability, lxml, algoliasearch, gzip and brotli are imported on first use to reduce the cold start time
 modules_to_be_patched = [ "boto3", "requests" ]
 tracer = Tracer(patch_modules = modules_to_be_patched)
 
 logger = Logger()
-tracer = Tracer()
+
+# emit the metrics of an invocation in the cloudwatch embedded metric format, with a document per blogsource at the end of the invocation
+metrics = Metrics(namespace = os.environ.get('POWERTOOLS_METRICS_NAMESPACE', 'rssblog'))
+
+# collect the metrics per blogsource, the thread of a feed sets its blogsource so the stages and api calls below it are added to that feed
+# set metrics_per_blog to 'n' to add all metrics to the 'all' blogsource, as every blogsource dimension is a separate set of custom metrics
+metrics_per_blog = os.environ.get('metrics_per_blog', 'y')
+metric_buffer = {}
+metric_lock = threading.Lock()
+metric_context = threading.local()
+
+# an optional function that receives the metrics of every blogsource when these are emitted, the benchmark uses it as a local sink
+metric_sink = None
+
+
+# count a feed cache hit or miss of the invocation, the feeds of a batch are retrieved on several threads
+def count_cache(result):
+	with metric_lock:
+		cache_stats[result] += 1
+
+
+# add a value to a metric of the current blogsource, values of the same metric are summed per invocation
+def add_metric(name, unit, value):
+	blogsource = getattr(metric_context, 'blogsource', 'all') if metrics_per_blog == 'y' else 'all'
+
+	with metric_lock:
+		x = metric_buffer.setdefault(blogsource, {}).setdefault(name, {'unit' : unit, 'value' : 0})
+		x['value'] += value
+
+
+# set the blogsource of the metrics added by the current thread, the previous blogsource is restored afterwards
+@contextlib.contextmanager
+def metric_blogsource(blogsource):
+	previous = getattr(metric_context, 'blogsource', 'all')
+	metric_context.blogsource = blogsource
+
+	try:
+		yield
+
+	finally:
+		metric_context.blogsource = previous
+
+
+# record the duration in milliseconds and the amount of calls of a stage, as a decorator or a with statement
+@contextlib.contextmanager
+def timed_stage(stage):
+	start = time.perf_counter()
+
+	try:
+		yield
+
+	finally:
+		add_metric(stage + 'Time', MetricUnit.Milliseconds, 1000 * (time.perf_counter() - start))
+		add_metric(stage + 'Calls', MetricUnit.Count, 1)
+
+
+# count the aws api calls per service, the event is registered on every client that is created
+def count_api_call(model, **kwargs):
+	add_metric('ApiCalls' + model.service_model.service_name.capitalize(), MetricUnit.Count, 1)
+
+
+# emit the collected metrics as a document per blogsource and pass these to the local sink
+def flush_metrics():
+	global metric_buffer
+
+	with metric_lock:
+		buffer = metric_buffer
+		metric_buffer = {}
+
+	for blogsource, values in sorted(buffer.items()):
+		if metric_sink is not None:
+			metric_sink(blogsource, values)
+
+		metrics.add_dimension(name = 'blogsource', value = blogsource)
+
+		for name, x in sorted(values.items()):
+			metrics.add_metric(name = name, unit = x['unit'], value = x['value'])
+
+		metrics.flush_metrics()
+
+
+# emit the metrics at the end of every invocation, also if the invocation failed
+def log_metrics(handler):
+
+	@functools.wraps(handler)
+	def wrapper(event, context):
+		try:
+			return handler(event, context)
+
+		finally:
+			flush_metrics()
+
+	return wrapper
+
+
+# create a boto3 client or resource on first use, as many invocations never use comprehend, ses or s3
+class LazyClient:
+
+	def __init__(self, factory):
+		self.factory = factory
+		self.client = None
+		self.lock = threading.Lock()
+
+	def __getattr__(self, name):
+		if self.client is None:
+			with self.lock:
+				if self.client is None:
+					client = self.factory()
+
+					# count the api calls of the client, a resource has its client under meta
+					events = client.meta.client.meta.events if hasattr(client.meta, 'client') else client.meta.events
+					events.register('before-call.*.*', count_api_call)
+
+					self.client = client
+
+		return getattr(self.client, name)
 
 
 # establish a session with SES, DynamoDB and Comprehend
-ddb = boto3.resource('dynamodb', region_name = os.environ['AWS_REGION'], config = botocore.client.Config(max_pool_connections = 50)).Table(os.environ['dynamo_table'])
-com = boto3.client(service_name = 'comprehend', region_name = os.environ['AWS_REGION'])
-ses = boto3.client('ses')
-s3 = boto3.client('s3')
+ddb = LazyClient(lambda: boto3.resource('dynamodb', region_name = os.environ['AWS_REGION'], config = botocore.client.Config(max_pool_connections = 50, retries = {'mode' : 'adaptive', 'max_attempts' : 10})).Table(os.environ['dynamo_table']))
+com = LazyClient(lambda: boto3.client(service_name = 'comprehend', region_name = os.environ['AWS_REGION']))
+ses = LazyClient(lambda: boto3.client('ses'))
+s3 = LazyClient(lambda: boto3.client('s3'))
+
+# set the names of the global secondary indexes on the visible and blogsource keys, these change when the indexes are migrated
+index_visible = os.environ.get('index_visible', 'visible')
+index_blogsource = os.environ.get('index_blogsource', 'timest')
+
+# set the amount of shards of the visible key, the posts are spread over 'y#0' to 'y#<n-1>' by a hash of the guid so the index writes
+# and reads of all feeds do not land on a single partition, the counter rows keep the unsharded 'y' key
+visible_shards = int(os.environ.get('visible_shards', 8))
+
+# create the readability document class on first use
+extractor = None
+
+# set a "real" user agent
+firefox = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:79.0) Gecko/20100101 Firefox/79.0"
+
+# set the amount of blogposts to process concurrently and the timeout in seconds for article downloads
+article_threads = int(os.environ.get('article_threads', 5))
+article_timeout = int(os.environ.get('article_timeout', 10))
+
+# set the connect timeout in seconds, the maximum connections per host and the maximum response size for feed and article downloads
+http_connect_timeout = float(os.environ.get('http_connect_timeout', 3))
+http_pool_size = int(os.environ.get('http_pool_size', 10))
+http_max_bytes = int(os.environ.get('http_max_bytes', 5242880))
+
+# set whether to parse the feeds while they are downloaded, and the amount of entries older than the cutoff after which the download stops
+feed_stream = os.environ.get('feed_stream', 'y')
+feed_stream_margin = int(os.environ.get('feed_stream_margin', 5))
+
+# create the http session on first use, it is reused across warm invocations to keep connections alive
+http_session = None
+http_lock = threading.Lock()
+
+# collect the timings of the downloads, these are added to the trace by the handler as the worker threads have no trace segment
+fetch_buffer = []
+
+# set the amount of feeds of a batch that are polled concurrently
+feed_threads = int(os.environ.get('feed_threads', 4))
+
+# set the shortest and longest time in seconds between polls of a feed, the crawl function polls every feed at least once per longest interval
+poll_min_interval = int(os.environ.get('poll_min_interval', 900))
+poll_max_interval = int(os.environ.get('poll_max_interval', 21600))
+
+# create a buffer for the small records of the blogposts to index in algolia, the algolia index is created on first use
+algolia_buffer = []
+algolia_index = None
+algolia_batch_size = int(os.environ.get('algolia_batch_size', 1000))
+algolia_fields = ['objectID', 'timest', 'title', 'description', 'link', 'blogsource', 'author', 'guid']
+
+# create a buffer for the blogposts to merge into the public json files and set the retention window of these files
+publish_buffer = []
+json_retention_days = int(os.environ.get('json_retention_days', 365))
+
+# set the amount of attempts to update a json file or the manifest, as every map branch updates the all json file concurrently
+publish_attempts = int(os.environ.get('publish_attempts', 8))
+
+# create a buffer for the feed states of the feeds with blogposts to publish, these are stored once the json files were published
+state_buffer = []
+
+# set whether to publish pre-compressed json shards and the amount of posts in the 'latest' shard
+json_shards = os.environ.get('json_shards', 'n')
+json_latest_count = int(os.environ.get('json_latest_count', 25))
+
+# set how the rawhtml and fulltxt of a blogpost are stored; 'inline' as strings, 'zlib' as compressed binary attributes or 's3' to store
+# bodies above the threshold in bytes as a private s3 object, with smaller bodies compressed inline. duplicates of a stored post
+# are always stored with a reference to the record of that post ('ref') instead of a body
+body_storage = os.environ.get('body_storage', 'inline')
+body_s3_threshold = int(os.environ.get('body_s3_threshold', 65536))
+
+# create a buffer for the blogposts to mail and set the length of the text excerpt in the mails
+mail_buffer = []
+mail_excerpt_length = int(os.environ.get('mail_excerpt_length', 500))
+
+# set the ses templates for the mails, the template name contains a hash of the template so a changed template is created under a new name
+mail_templates = {
+	'post' : {
+		'SubjectPart' : '{{blogsource}} - {{title}}',
+		'HtmlPart' : '<html><body><br><i>Posted by {{author}} in {{blogsource}} blog on {{datestr}}</i><br><br><a href="{{link}}">view post here</a><br><br>{{excerpt}}<br></body></html>',
+		'TextPart' : 'Posted by {{author}} in {{blogsource}} blog on {{datestr}}\n\n{{link}}\n\n{{excerpt}}\n'
+	},
+	'digest' : {
+		'SubjectPart' : '{{count}} new blogposts',
+		'HtmlPart' : '<html><body>{{#each posts}}<br><b>{{blogsource}} - <a href="{{link}}">{{title}}</a></b><br><i>Posted by {{author}} on {{datestr}}</i><br><br>{{excerpt}}<br>{{/each}}</body></html>',
+		'TextPart' : '{{#each posts}}{{blogsource}} - {{title}}\nPosted by {{author}} on {{datestr}}\n{{link}}\n\n{{excerpt}}\n\n{{/each}}'
+	}
+}
+mail_created = set()
+
+# set the key of the manifest that maps every published blogsource to its publish timestamp, post count and etag
+# the manifest is read once per invocation and the updates of the invocation are written to it together at the end
+manifest_key = '_manifest.json'
+manifest = None
+manifest_etag = None
+manifest_updates = {}
+
+
+# get the blogpost guids of a blogsource that are already stored in DynamoDB, up to x days ago
+@tracer.capture_method(capture_response = False)
+@timed_stage('Dedup')
+def get_guids(blogsource, ts):
+	guids = set()
+
+	# get the guid values up to x days ago from the per blogsource index
+	queryres = ddb.query(ScanIndexForward = True, IndexName = index_blogsource, ProjectionExpression = 'guid', KeyConditionExpression = Key('blogsource').eq(blogsource) & Key('timest').gt(ts))
+
+	for x in queryres['Items']:
+		guids.add(x['guid'])
+
+	# paginate the query in case more than 1MB of results are returned
+	while 'LastEvaluatedKey' in queryres:
+		queryres = ddb.query(ExclusiveStartKey = queryres['LastEvaluatedKey'], ScanIndexForward = True, IndexName = index_blogsource, ProjectionExpression = 'guid', KeyConditionExpression = Key('blogsource').eq(blogsource) & Key('timest').gt(ts))
+
+		for x in queryres['Items']:
+			guids.add(x['guid'])
+
+	print('guids found for ' + blogsource + ' : ' + str(len(guids)))
+	return guids
+
+
+# get the records of a list of guid and timestamp keys from DynamoDB in batches of 100 keys, returns a dict per found key
+@tracer.capture_method(capture_response = False)
+def get_items(keys, projection):
+	stored = {}
+	keys = list(set(keys))
+
+	for i in range(0, len(keys), 100):
+		reqs = { ddb.name : { 'Keys' : [{ 'guid' : guid, 'timest' : timest } for guid, timest in keys[i:i + 100]], 'ProjectionExpression' : projection } }
+		attempt = 0
+
+		# retry unprocessed keys with an exponential backoff
+		while len(reqs) > 0:
+
+			if attempt > 0:
+				time.sleep(0.1 * (2 ** min(attempt, 5)))
+
+			res = ddb.meta.client.batch_get_item(RequestItems = reqs)
+
+			for x in res['Responses'].get(ddb.name, []):
+				stored[(x['guid'], int(x['timest']))] = x
+
+			reqs = res.get('UnprocessedKeys', {})
+			attempt += 1
+
+	return stored
+
+
+# check which guid and timestamp keys are already stored in DynamoDB, this catches posts that were stored through another feed
+@timed_stage('Dedup')
+def get_stored_keys(keys):
+	return set(get_items(keys, 'guid, timest').keys())
+
+
+# get the identity key of a blogpost link, the link is canonicalized so tracking parameters, the scheme or a trailing slash do not matter
+def get_link_key(link):
+	parts = urllib.parse.urlsplit(link.strip())
+	query = sorted([(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values = True) if not k.lower().startswith('utm_')])
+	canonical = urllib.parse.urlunsplit(('https', parts.netloc.lower(), parts.path.rstrip('/'), urllib.parse.urlencode(query), ''))
+
+	return 'link#' + hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+
+# get the identity key of a blogpost text, returns None for short texts as these are likely failed extractions
+def get_body_key(text):
+	text = ' '.join(text.lower().split())
+
+	if len(text) < 200:
+		return None
+
+	return 'body#' + hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+# split the blogposts in new posts and duplicates of a stored post, using the identity rows (guid: link#<hash> or body#<hash>, timest: -2)
+# the duplicates get the text and tags of the stored post, so they are not retrieved or tagged again
+@tracer.capture_method(capture_response = False)
+def get_duplicates(posts, field):
+	identities = get_items([(post[field], -2) for post in posts if post.get(field) is not None], 'guid, timest, srcguid, srctimest')
+	sources = get_items([(x['srcguid'], int(x['srctimest'])) for x in identities.values()], 'guid, timest, rawhtml, fulltxt, bodycodec, bodyref, srcguid, srctimest, tag')
+
+	new = []
+	dups = []
+
+	for post in posts:
+		x = identities.get((post.get(field), -2))
+		src = None
+
+		if x is not None:
+			src = sources.get((x['srcguid'], int(x['srctimest'])))
+
+		if src is None:
+			new.append(post)
+			continue
+
+		post['source'] = (src['guid'], int(src['timest']))
+		post['tags'] = src['tag']
+
+		if 'rawhtml' not in post:
+			post['rawhtml'], post['cleantxt'] = load_body(src)
+
+		dups.append(post)
+
+	if len(dups) > 0:
+		print('found ' + str(len(dups)) + ' blog entries that were stored before through another link or feed')
+
+	return new, dups
+
+
+# store the link and body identity rows of the written blogposts, new rows are written in batches of 25 items
+# for a duplicate the blogsource is added to the rows of the stored post, the first stored post remains the source
+@tracer.capture_method(capture_response = False)
+@timed_stage('Identity')
+def put_identities(posts):
+	rows = {}
+
+	for post in posts:
+		for key in [post.get('linkkey'), post.get('bodykey')]:
+			if key is None:
+				continue
+
+			if 'source' in post:
+				ddb.update_item(
+					Key = { "guid" : key, "timest" : -2 },
+					ExpressionAttributeValues = { ":srcguid" : post['source'][0], ":srctimest" : post['source'][1], ":blogsource" : set([post['blogsource']]) },
+					UpdateExpression = "SET srcguid = if_not_exists(srcguid, :srcguid), srctimest = if_not_exists(srctimest, :srctimest) ADD blogsources :blogsource"
+				)
+
+			elif key not in rows:
+				rows[key] = {'guid' : key, 'timest' : -2, 'srcguid' : post['guid'], 'srctimest' : post['timest'], 'blogsources' : set([post['blogsource']])}
+
+	rows = list(rows.values())
+
+	for i in range(0, len(rows), 25):
+		reqs = [{'PutRequest': {'Item': x}} for x in rows[i:i + 25]]
+		attempt = 0
+
+		while len(reqs) > 0 and attempt < 5:
+
+			if attempt > 0:
+				time.sleep(0.1 * (2 ** attempt))
+
+			res = ddb.meta.client.batch_write_item(RequestItems = { ddb.name : reqs })
+			reqs = res.get('UnprocessedItems', {}).get(ddb.name, [])
+			attempt += 1
+
+		# the blogposts are already stored, so a missing identity only means a later duplicate of these posts is retrieved again
+		if len(reqs) > 0:
+			print('failed to store identities ' + ', '.join([x['PutRequest']['Item']['guid'] for x in reqs]) + ' after ' + str(attempt) + ' attempts')
+			add_metric('IdentityWriteFailures', MetricUnit.Count, len(reqs))
+
+
+# get the shared http session with a connection pool per host
+def get_session():
+	global http_session
+
+	with http_lock:
+		if http_session is None:
+			session = requests.Session()
+
+			# block instead of opening extra connections if all pooled connections to a host are in use, and keep a pool for as many hosts
+			adapter = requests.adapters.HTTPAdapter(pool_connections = http_pool_size, pool_maxsize = http_pool_size, pool_block = True, max_retries = 1)
+			session.mount('http://', adapter)
+			session.mount('https://', adapter)
+
+			# only ask for brotli compression if urllib3 can decode it
+			encodings = 'gzip, deflate'
+
+			try:
+				import brotli
+				encodings += ', br'
+
+			except ImportError:
+				pass
+
+			session.headers.update({'User-Agent' : firefox, 'Accept-Encoding' : encodings})
+			http_session = session
+
+	return http_session
+
+
+# download a url through the shared session with connect and read timeouts, the download is aborted if the body is larger than http_max_bytes
+@tracer.capture_method(capture_response = False)
+def fetch(url, headers = None, reader = None):
+	start = time.time()
+	stopped = False
+
+	with get_session().get(url, headers = headers or {}, timeout = (http_connect_timeout, article_timeout), stream = True) as req:
+		ttfb = time.time() - start
+		body = bytearray()
+
+		# read the decompressed body in chunks
+		for chunk in req.iter_content(65536):
+			body += chunk
+
+			if len(body) > http_max_bytes:
+				raise Exception('response of ' + url + ' is larger than ' + str(http_max_bytes) + ' bytes')
+
+			# optionally, pass the chunk to a feed reader and stop the download once the reader has all the entries it needs
+			if reader is not None and req.status_code == 200 and not reader.feed(chunk):
+				stopped = True
+				break
+
+	add_metric('DownloadBytes', MetricUnit.Bytes, len(body))
+	add_metric('Downloads', MetricUnit.Count, 1)
+
+	# keep the timing of the request for the trace
+	with http_lock:
+		fetch_buffer.append({'url' : url, 'status' : req.status_code, 'bytes' : len(body), 'ttfb' : ttfb, 'seconds' : time.time() - start, 'stopped' : stopped})
+
+	return req, bytes(body)
+
+
+# add the timings of the downloads of this invocation to the trace, this runs on the handler thread which has the trace segment
+def trace_fetches():
+	global fetch_buffer
+
+	with http_lock:
+		fetches = fetch_buffer
+		fetch_buffer = []
+
+	tracer.put_annotation(key = 'fetches', value = len(fetches))
+	tracer.put_annotation(key = 'fetch_errors', value = len([x for x in fetches if x['status'] >= 400]))
+	tracer.put_metadata(key = 'fetches', value = fetches)
+
+
+# parse a feed date to a utc struct_time like feedparser, rss uses rfc 822 dates and atom uses iso 8601 dates
+def parse_feed_date(text):
+	m = re.match(r'(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?)?\s*(Z|[+-]\d{2}:?\d{2})?$', text.strip())
+
+	if m is not None:
+		ts = email.utils.mktime_tz(tuple([int(x or 0) for x in m.groups()[:6]]) + (0, 1, -1, 0))
+		offset = (m.group(7) or 'Z').replace(':', '')
+
+		if offset != 'Z':
+			ts -= (int(offset[0] + '1')) * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+
+		return time.gmtime(ts)
+
+	parsed = email.utils.parsedate_tz(text)
+
+	if parsed is None:
+		raise ValueError('could not parse date ' + text)
+
+	return time.gmtime(email.utils.mktime_tz(parsed))
+
+
+# parse rss and atom entries while the feed is downloaded, with the keys of the feedparser entries that are used in get_feed
+# as feeds list the newest entries first, the download stops once a margin of entries is older than the cutoff
+# the reader stops parsing on an error or an unknown format, the complete feed is then parsed with feedparser
+class FeedReader:
+
+	def __init__(self, cutoff):
+		import xml.etree.ElementTree
+
+		self.parser = xml.etree.ElementTree.XMLPullParser(events = ('start', 'end'))
+		self.cutoff = cutoff
+		self.entries = []
+		self.format = None
+		self.old = 0
+		self.sorted = True
+		self.done = False
+		self.error = None
+
+	# parse a chunk of the feed, returns False once the rest of the feed is not needed
+	def feed(self, chunk):
+		if self.error is not None:
+			return True
+
+		try:
+			self.parser.feed(chunk)
+
+			for event, elem in self.parser.read_events():
+				self.read_event(event, elem)
+
+				if self.done:
+					return False
+
+		except Exception as e:
+			self.error = str(e)
+
+		return True
+
+	# finish parsing the feed, returns True if the entries are complete and False if feedparser should parse the feed
+	def close(self):
+		if self.error is None and not self.done:
+			try:
+				self.parser.close()
+
+			except Exception as e:
+				self.error = str(e)
+
+		if self.error is None and self.format is None:
+			self.error = 'no feed found'
+
+		return self.error is None
+
+	def read_event(self, event, elem):
+		name = elem.tag.rsplit('}', 1)[-1]
+
+		# detect the feed format from the root element, other formats such as rss 1.0 are parsed by feedparser
+		if self.format is None:
+			if event == 'start' and name in ['rss', 'feed']:
+				self.format = name
+
+			elif event == 'start':
+				raise ValueError('unknown feed format ' + name)
+
+			return
+
+		if event != 'end' or name not in ['item', 'entry']:
+			return
+
+		entry = self.read_entry(elem)
+		elem.clear()
+
+		# the early stop is disabled for the rest of the feed if an entry is newer than the previous one
+		timest = time.mktime(entry['updated_parsed'])
+
+		if len(self.entries) > 0 and timest > time.mktime(self.entries[-1]['updated_parsed']):
+			self.sorted = False
+
+		self.entries.append(entry)
+
+		if timest < self.cutoff:
+			self.old += 1
+
+		else:
+			self.old = 0
+
+		if self.sorted and self.old >= feed_stream_margin:
+			self.done = True
+
+	def read_entry(self, elem):
+		entry = {'tags' : [], 'description' : ''}
+		dates = {}
+
+		for child in elem:
+			name = child.tag.rsplit('}', 1)[-1]
+			text = ''.join(child.itertext()).strip()
+
+			if name == 'title':
+				entry['title'] = text
+
+			elif name == 'link' and self.format == 'feed':
+				if child.get('rel', 'alternate') == 'alternate' and 'link' not in entry:
+					entry['link'] = child.get('href')
+
+			elif name == 'link':
+				entry['link'] = text
+
+			elif name in ['guid', 'id']:
+				entry['guid'] = text
+
+			elif name in ['pubDate', 'published', 'issued', 'updated', 'date', 'modified']:
+				dates[name] = text
+
+			elif name in ['description', 'summary'] or (name == 'content' and len(entry['description']) == 0):
+				entry['description'] = text
+
+			elif name in ['author', 'creator']:
+				entry['author'] = child.findtext('{*}name', text).strip()
+
+			elif name == 'category':
+				entry['tags'].append({'term' : child.get('term', text)})
+
+		# use the updated date if present, like the updated_parsed value of feedparser
+		for name in ['updated', 'modified', 'date', 'pubDate', 'published', 'issued']:
+			if name in dates:
+				entry['updated_parsed'] = parse_feed_date(dates[name])
+				break
+
+		else:
+			raise ValueError('entry without a date')
+
+		if 'guid' not in entry:
+			entry['guid'] = entry['link']
+
+		return entry
+
+
+# get the feed validators (etag, last-modified and body hash) stored in the guid: <blogsource>, timest: -1 row
+@tracer.capture_method(capture_response = False)
+def get_feed_state(blogsource):
+
+	res = ddb.get_item(Key = { "guid" : blogsource, "timest" : -1 })
+
+	if 'Item' in res:
+		return res['Item']
+
+	return {}
+
+
+# get the average time in seconds between the newest entries of a parsed feed, or None if the feed has too few dated entries
+def get_publish_gap(entries):
+	stamps = sorted([int(time.mktime(x['updated_parsed'])) for x in entries if x.get('updated_parsed')], reverse = True)[:10]
+
+	if len(stamps) < 2 or stamps[0] == stamps[-1]:
+		return None
+
+	return (stamps[0] - stamps[-1]) // (len(stamps) - 1)
+
+
+# get the poll schedule of a feed after a poll, the crawl function only submits the feed again once the next poll time passed
+# a feed with new posts is polled again after the shortest interval, a quiet feed backs off exponentially up to a quarter of its
+# average publish gap or the longest interval, and a failing feed backs off from the shortest interval
+def get_schedule(state, newposts, gap = None, error = False):
+	now = int(time.time())
+	interval = int(state.get('interval', poll_min_interval))
+	hitrate = int(state.get('hitrate', 0))
+	errors = int(state.get('errors', 0))
+
+	schedule = {'gap' : gap if gap is not None else int(state.get('gap', poll_max_interval))}
+
+	if error:
+		errors += 1
+		interval = poll_min_interval * (2 ** min(errors, 10))
+
+	else:
+		errors = 0
+
+		# keep the percentage of polls with new posts as a moving average of the recent polls
+		hitrate = (3 * hitrate + (100 if newposts > 0 else 0)) // 4
+
+		if newposts > 0 or hitrate >= 50:
+			interval = poll_min_interval
+
+		else:
+			interval = min(2 * interval, max(poll_min_interval, schedule['gap'] // 4))
+
+		if newposts > 0:
+			schedule['lastchange'] = now
+
+	schedule['interval'] = max(poll_min_interval, min(interval, poll_max_interval))
+	schedule['nextpoll'] = now + schedule['interval']
+	schedule['hitrate'] = hitrate
+	schedule['errors'] = errors
+
+	return schedule
+
+
+# store the poll schedule of a feed, and the feed validators if the feed was processed successfully
+@tracer.capture_method(capture_response = False)
+def put_feed_state(blogsource, validators, schedule, newposts = None, publishfrom = None):
+
+	values = { ":checked" : int(time.time()) }
+	names = {}
+	expression = "SET checked = :checked"
+
+	if validators is not None:
+		values.update({ ":etag" : validators['etag'], ":modified" : validators['modified'], ":bodyhash" : validators['bodyhash'] })
+		expression += ", etag = :etag, modified = :modified, bodyhash = :bodyhash"
+
+	# the schedule attributes are set through attribute names, as 'interval' is a reserved word
+	for k, v in schedule.items():
+		names['#' + k] = k
+		values[':' + k] = v
+		expression += ", #" + k + " = :" + k
+
+	# store the amount of new posts found in the parsed feed, the crawl function uses it to size the feed batches
+	if newposts is not None:
+		values[':lastnew'] = newposts
+		expression += ", lastnew = :lastnew"
 
+	# mark the blogposts written since publishfrom as unpublished, or clear the mark once these were published
+	if publishfrom is not None:
+		values[':publishfrom'] = publishfrom
+		expression += ", publishfrom = :publishfrom"
 
-# get the RSS feed through feedparser
+	else:
+		expression += " REMOVE publishfrom"
+
+	ddb.update_item(
+		Key = { "guid" : blogsource, "timest" : -1 },
+		ExpressionAttributeNames = names,
+		ExpressionAttributeValues = values,
+		UpdateExpression = expression
+	)
+
+
+# get the timestamp from which the written blogposts of a feed are published again if the json files are not updated
+# this is the cutoff of the current run, or the older cutoff of an earlier run that did not publish its blogposts either
+def get_publish_from(state):
+	cutoff = int(time.time()) - (86400 * days_to_retrieve)
+
+	return min(cutoff, int(state.get('publishfrom', cutoff)))
+
+
+# store the feed state now if the feed has no blogposts to publish, else store it once the json files were published
+# the validators of a feed are only stored after its blogposts were published, so a failed publish does not make the next fetch a cache hit
+def save_feed_state(state, blogsource, validators, schedule, newposts, pending):
+
+	if pending:
+		state_buffer.append({'state' : state, 'blogsource' : blogsource, 'validators' : validators, 'schedule' : schedule, 'newposts' : newposts, 'publishfrom' : get_publish_from(state)})
+
+	else:
+		put_feed_state(blogsource, validators, schedule, newposts)
+
+
+# store the feed states that waited for the json files, the feeds whose json files could not be updated keep their old validators
+# and are marked with the publishfrom timestamp, so the next run publishes their blogposts again from dynamodb
+@tracer.capture_method(capture_response = False)
+def flush_feed_states(failed):
+	global state_buffer
+
+	states = state_buffer
+	state_buffer = []
+
+	for x in states:
+		if x['blogsource'] in failed:
+			put_feed_state(x['blogsource'], None, get_schedule(x['state'], 0, error = True), publishfrom = x['publishfrom'])
+
+		else:
+			put_feed_state(x['blogsource'], x['validators'], x['schedule'], x['newposts'])
+
+
+# get the RSS feed through a conditional get, only parse it with feedparser if it changed since the last run
 @tracer.capture_method(capture_response = False)
-def get_rss(url):
-	return feedparser.parse(url)
+@timed_stage('FeedFetch')
+def get_rss(url, blogsource, state, cutoff):
+
+	headers = {}
+	reader = None
+
+	# add the stored validators to the request, so the server can answer with a 304 if nothing changed
+	if state.get('etag'):
+		headers['If-None-Match'] = state['etag']
+
+	if state.get('modified'):
+		headers['If-Modified-Since'] = state['modified']
+
+	# parse the feed while it is downloaded, so the download can stop once the entries are older than the cutoff
+	if feed_stream == 'y':
+		reader = FeedReader(cutoff)
 
+	req, body = fetch(url, headers, reader)
 
-# update the item count in dynamodb by 1
+	# the feed was not modified, return without parsing
+	if req.status_code == 304:
+		count_cache('hit')
+		add_metric('FeedNotModified', MetricUnit.Count, 1)
+		print('feed cache hit for ' + blogsource + ' (304 not modified)')
+
+		return None, None
+
+	req.raise_for_status()
+
+	# compare the body hash with the stored one, as not all servers support etag or last-modified headers
+	# if the download stopped early the hash covers the downloaded part, which contains all the entries within the cutoff
+	validators = {
+		'etag' : req.headers.get('ETag', ''),
+		'modified' : req.headers.get('Last-Modified', ''),
+		'bodyhash' : hashlib.sha256(body).hexdigest()
+	}
+
+	if state.get('bodyhash') == validators['bodyhash']:
+		count_cache('hit')
+		add_metric('FeedNotModified', MetricUnit.Count, 1)
+		print('feed cache hit for ' + blogsource + ' (body hash unchanged)')
+
+		return None, validators
+
+	count_cache('miss')
+	print('feed cache miss for ' + blogsource)
+
+	if reader is not None and reader.close():
+		print('parsed ' + str(len(reader.entries)) + ' entries of ' + blogsource + ' from ' + str(len(body)) + ' bytes' + (', stopped at the cutoff' if reader.done else ''))
+
+		return {'entries' : reader.entries}, validators
+
+	if reader is not None:
+		print('parsing ' + blogsource + ' with feedparser : ' + str(reader.error))
+
+	import feedparser
+
+	return feedparser.parse(body, response_headers = req.headers), validators
+
+
+# update the item count in dynamodb by the amount of blogposts written
 @tracer.capture_method(capture_response = False)
-def update_itemcount(blogsource):
+def update_itemcount(blogsource, count):
 	
 	# update guid: <blogsource>, timest: 0
 	ddb.update_item(
 		Key = { "guid" : blogsource, "timest" : 0 },
-		ExpressionAttributeValues = { ":inc" : 1 },
+		ExpressionAttributeValues = { ":inc" : count },
 		UpdateExpression = "ADD articlecount :inc"
 	)
 
-	print('incremented ' + blogsource + ' count by 1')
+	print('incremented ' + blogsource + ' count by ' + str(count))
+
+
+# update the item count for all blogs and add the blogsources to the set used by the pagecount function
+@tracer.capture_method(capture_response = False)
+def update_allcount(blogsources, count):
+
+	# update guid: all, timest: 0
+	ddb.update_item(
+		Key = { "guid" : 'all', "timest" : 0 },
+		ExpressionAttributeValues = { ":inc" : count, ":bs" : set(blogsources) },
+		UpdateExpression = "ADD articlecount :inc, blogsources :bs"
+	)
+
+
+# write the blogpost records of a feed to DynamoDB in batches of 25 items and return the records that were written
+@tracer.capture_method(capture_response = False)
+@timed_stage('DynamoWrite')
+def flush_dynamo(records, failed):
+
+	# remove duplicate keys from the records, as a batch write can not contain the same key twice
+	items = list({ (x['guid'], x['timest']) : x for x in records }.values())
+	written = []
+
+	for i in range(0, len(items), 25):
+		batch = items[i:i + 25]
+		reqs = [{'PutRequest': {'Item': x}} for x in batch]
+		attempt = 0
+
+		# retry unprocessed items with an exponential backoff
+		while len(reqs) > 0 and attempt < 5:
+
+			if attempt > 0:
+				time.sleep(0.1 * (2 ** attempt))
+
+			res = ddb.meta.client.batch_write_item(RequestItems = { ddb.name : reqs })
+			reqs = res.get('UnprocessedItems', {}).get(ddb.name, [])
+			attempt += 1
+
+		# mark items that could not be written as failed, so they are retried on the next run
+		unprocessed = [x['PutRequest']['Item']['guid'] for x in reqs]
+
+		for x in batch:
+			if x['guid'] in unprocessed:
+				print('failed to write ' + x['guid'] + ' to dynamodb after ' + str(attempt) + ' attempts')
+				failed.append(x['guid'])
+
+			else:
+				written.append(x)
+
+	# sum the counter increments per blogsource, so every counter row is only updated once
+	counts = {}
+
+	for x in written:
+		counts[x['blogsource']] = counts.get(x['blogsource'], 0) + 1
+
+	for blogsource, count in counts.items():
+		update_itemcount(blogsource, count)
+
+	if len(written) > 0:
+		update_allcount(counts.keys(), len(written))
+		print('incremented all count by ' + str(len(written)))
+
+	add_metric('PostsWritten', MetricUnit.Count, len(written))
+	print('wrote ' + str(len(written)) + ' blog entries to dynamodb')
+
+	return written
+
+
+# get the algolia index, the client is created once and reused across warm invocations
+def get_algolia_index(event):
+	global algolia_index
+
+	if algolia_index is None or algolia_index.name != event['algolia_index']:
+		from algoliasearch.search_client import SearchClient
+
+		client = SearchClient.create(event['algolia_app'], event['algolia_apikey'])
+		algolia_index = client.init_index(event['algolia_index'])
+
+	return algolia_index
+
+
+# put the small records of the written blogposts in your Algolia search DB in batches
+@tracer.capture_method(capture_response = False)
+@timed_stage('Algolia')
+def flush_algolia(event):
+	global algolia_buffer
+
+	objects = algolia_buffer
+	algolia_buffer = []
+
+	for i in range(0, len(objects), algolia_batch_size):
+		batch = objects[i:i + algolia_batch_size]
+
+		# report indexing failures without failing the run, as the records are already stored in dynamodb
+		try:
+			get_algolia_index(event).save_objects(batch)
+			print('indexed ' + str(len(batch)) + ' blog entries in algolia')
+
+		except Exception as e:
+			print('failed to index ' + str(len(batch)) + ' blog entries in algolia : ' + str(e))
 
 
 # write the blogpost record into DynamoDB
 @tracer.capture_method(capture_response = False)
+@timed_stage('Record')
 def put_dynamo(timest_post, title, cleantxt, rawhtml, description, link, blogsource, author, guid, tags, category, datestr_post, table, event):
 
 	# if no description was submitted, put a dummy value to prevent issues parsing the output
@@ -66,150 +946,429 @@ def put_dynamo(timest_post, title, cleantxt, rawhtml, description, link, blogsou
 		'guid' : guid					# store the blogpost guid as a unique key
 	} 
 
-	# add additional attributes for dynamodb record
-	extraitem = {
-		'category' : category,
-		'datestr' : datestr_post,		# store the human friendly timestamp of the post
-		'fulltxt': cleantxt,			# store the "clean" text of the blogpost, using \n as a line delimiter
-		'lower-tag' : tags.lower(),		# convert the tags to lowercase, which makes it easier to search or match these
-		'rawhtml': rawhtml,				# store the raw html output of the readability plugin, in order to include the blog content with text markup
-		'tag' : tags,					# set the comprehend tags
-		'visible' : 'y'					# set the blogpost to visible by default - this "hack" allows for a simple query on a static primary key
-	}
+	# add additional attributes for dynamodb record
+	extraitem = {
+		'category' : category,
+		'datestr' : datestr_post,		# store the human friendly timestamp of the post
+		'fulltxt': cleantxt,			# store the "clean" text of the blogpost, using \n as a line delimiter
+		'lower-tag' : tags.lower(),		# convert the tags to lowercase, which makes it easier to search or match these
+		'rawhtml': rawhtml,				# store the raw html output of the readability plugin, in order to include the blog content with text markup
+		'tag' : tags,					# set the comprehend tags
+		'visible' : get_visible_key(guid)	# set the blogpost to visible by default, on a shard of the visible key to spread the index writes
+	}
+
+	# merge small and extra item for dynamodb
+	def Merge(dict1, dict2):
+		res = {**dict1, **dict2}
+		return res
+
+	# create fullitem for dynamodb
+	fullitem = Merge(smallitem, extraitem)
+
+	# return the full record, it is written to dynamodb together with the other records of the feed
+	return fullitem
+
+
+# get the record of a duplicate blogpost, which references the record of the stored post instead of storing the same body again
+def get_ref_record(item, source):
+	record = { k : v for k, v in item.items() if k not in ['rawhtml', 'fulltxt'] }
+	record['bodycodec'] = 'ref'
+	record['srcguid'] = source[0]
+	record['srctimest'] = source[1]
+
+	return record
+
+
+# get the record to store for a blogpost, with the rawhtml and fulltxt encoded for the configured body storage
+# the bodycodec attribute is only set for encoded bodies, so records without it are stored inline. with upload disabled the s3 object
+# is not written, which the migration tool uses for a dry run
+@tracer.capture_method(capture_response = False)
+@timed_stage('BodyStore')
+def store_body(item, bucket, source = None, upload = True):
+
+	if source is not None:
+		return get_ref_record(item, source)
+
+	if body_storage == 'inline':
+		return item
+
+	record = dict(item)
+	body = {'rawhtml' : item['rawhtml'], 'fulltxt' : item['fulltxt']}
+
+	if body_storage == 's3' and len(item['rawhtml'].encode('utf-8')) + len(item['fulltxt'].encode('utf-8')) > body_s3_threshold:
+		import gzip
+
+		# the key is based on the record key, so a retried write overwrites the same object
+		key = 'bodies/' + item['blogsource'] + '/' + hashlib.sha256((item['guid'] + '#' + str(item['timest'])).encode('utf-8')).hexdigest()[:32] + '.json.gz'
+		if upload:
+			s3.put_object(Bucket = bucket, Key = key, Body = gzip.compress(json.dumps(body).encode('utf-8')), ContentType = 'application/json', ContentEncoding = 'gzip')
+
+		del record['rawhtml'], record['fulltxt']
+		record['bodycodec'] = 's3'
+		record['bodyref'] = 's3://' + bucket + '/' + key
+
+	else:
+		record['rawhtml'] = zlib.compress(item['rawhtml'].encode('utf-8'))
+		record['fulltxt'] = zlib.compress(item['fulltxt'].encode('utf-8'))
+		record['bodycodec'] = 'zlib'
+
+	return record
+
+
+# get the rawhtml and fulltxt of a stored record, for any of the body storage options
+def load_body(item):
+	codec = item.get('bodycodec', 'inline')
+
+	if codec == 'zlib':
+		return zlib.decompress(bytes(item['rawhtml'])).decode('utf-8'), zlib.decompress(bytes(item['fulltxt'])).decode('utf-8')
+
+	if codec == 's3':
+		import gzip
+
+		bucket, key = item['bodyref'][5:].split('/', 1)
+		body = json.loads(gzip.decompress(s3.get_object(Bucket = bucket, Key = key)['Body'].read()))
+
+		return body['rawhtml'], body['fulltxt']
+
+	# a duplicate has no body of its own, so the body of the stored post is read
+	if codec == 'ref':
+		src = get_items([(item['srcguid'], int(item['srctimest']))], 'guid, timest, rawhtml, fulltxt, bodycodec, bodyref, srcguid, srctimest')
+
+		return load_body(src[(item['srcguid'], int(item['srctimest']))])
+
+	return item['rawhtml'], item['fulltxt']
+
+
+# get the readability document class that keeps the sanitized lxml tree of the summary, so the text can be read without parsing the html again
+def get_extractor():
+	global extractor
+
+	if extractor is None:
+		import readability
+
+		class Extractor(readability.Document):
+
+			def sanitize(self, node, *args, **kwargs):
+				self.node = node
+				return readability.Document.sanitize(self, node, *args, **kwargs)
+
+		extractor = Extractor
+
+	return extractor
+
+
+# extract the main text section of an html page using the readability module, returns the html and the text of the summary
+def extract_article(html):
+	doc = get_extractor()(html)
+	rawhtml = doc.summary(html_partial = True)
+
+	# read the text from the tree readability used for the summary, fall back to parsing the summary if no tree was kept
+	if hasattr(doc, 'node'):
+		cleantext = doc.node.text_content()
+
+	else:
+		import lxml.html
+
+		# the sanitize override of the extractor was not called, which happens if readability-lxml changed its internals
+		print('readability did not keep the summary tree, parsing the summary again')
+		add_metric('ReadabilityFallback', MetricUnit.Count, 1)
+		cleantext = lxml.html.fromstring(rawhtml).text_content()
+
+	return rawhtml, cleantext.strip('\n')
+
+
+# retrieve the url of a blogpost
+@tracer.capture_method(capture_response = False)
+def retrieve_url(url):
+
+	html = download_article(url)
+
+	# retrieve the main text section from the html using the readability module
+	with timed_stage('Readability'):
+		return extract_article(html)
+
+
+# download the html of a blogpost, the html is decoded with the charset of the response
+# without a charset the bytes are returned, so readability detects the encoding from the html
+def download_article(url):
+
+	with timed_stage('ArticleFetch'):
+		req, body = fetch(url)
+		req.raise_for_status()
+
+	if 'charset' in req.headers.get('Content-Type', ''):
+		return body.decode(req.encoding, 'replace')
+
+	return body
+
+
+# cut down a text to the given amount of utf-8 bytes, without splitting a multibyte character
+def truncate_utf8(text, maxbytes):
+	return text.encode('utf-8')[:maxbytes].decode('utf-8', 'ignore')
+
+
+# check whether organization or title labels were found by Comprehend and return them as a tag string
+def get_tags(entities):
+	detections = []
+
+	for x in entities:
+		if x['Type'] == 'ORGANIZATION' or x['Type'] == 'TITLE' or x['Type'] == 'COMMERCIAL_ITEM' or x['Type'] == 'PERSON':
+			if x['Text'] not in detections:
+				detections.append(x['Text'])
+
+	# if no tags were retrieved, add a default tag
+	if len(detections) == 0:
+		return 'none'
+
+	return ', '.join(detections)
+
+
+# analyze the text of the new blogposts using the AWS Comprehend service, 25 posts per request
+@tracer.capture_method(capture_response = False)
+@timed_stage('Comprehend')
+def comprehend(posts, failed):
+	tagged = []
+
+	for i in range(0, len(posts), 25):
+		batch = posts[i:i + 25]
+
+		# cut down the text to less than 5000 bytes as this is the document limit for Comprehend
+		texts = []
+
+		for post in batch:
+			texts.append(truncate_utf8(post['title'] + ' ' + post['cleantxt'], 5000))
+
+		# comprehend bills every document in units of 100 characters, with a minimum of 3 units
+		add_metric('ComprehendCharacters', MetricUnit.Count, sum(100 * max(3, math.ceil(len(x) / 100)) for x in texts))
+
+		try:
+			res = com.batch_detect_entities(TextList = texts, LanguageCode = 'en')
+
+		except Exception as e:
+			print('failed to detect entities for ' + str(len(batch)) + ' blog entries : ' + str(e))
+
+			for post in batch:
+				failed.append(post['guid'])
+
+			continue
+
+		# map the tags back to the blogposts using the index in the batch
+		for x in res['ResultList']:
+			batch[x['Index']]['tags'] = get_tags(x['Entities'])
+
+		for x in res['ErrorList']:
+			print('failed to detect entities for ' + batch[x['Index']]['link'] + ' : ' + x['ErrorMessage'])
+			failed.append(batch[x['Index']]['guid'])
+
+		for post in batch:
+			if 'tags' in post:
+				tagged.append(post)
+
+	print('tagged ' + str(len(tagged)) + ' blog entries in ' + str(len(range(0, len(posts), 25))) + ' comprehend requests')
+
+	return tagged
+
+
+# get the first characters of the blogpost text for a mail, cut at the last full word
+def get_excerpt(text):
+
+	text = ' '.join(str(text).split())
+
+	if len(text) <= mail_excerpt_length:
+		return text
+
+	return text[:mail_excerpt_length].rsplit(' ', 1)[0] + '...'
+
+
+# get the template data of a written blogpost, the mails contain an excerpt instead of the full blogpost html
+def get_mail_post(post):
+	return {'blogsource' : post['blogsource'].upper(), 'title' : post['title'], 'author' : post['author'], 'datestr' : post['datestr'], 'link' : post['link'], 'excerpt' : get_excerpt(post['fulltxt'])}
+
+
+# get the name of an ses template, the template is created on first use
+@tracer.capture_method(capture_response = False)
+def get_mail_template(mode):
+
+	template = dict(mail_templates[mode])
+	template['TemplateName'] = 'rssblog-' + mode + '-' + hashlib.sha256(json.dumps(template, sort_keys = True).encode('utf-8')).hexdigest()[:12]
+
+	if template['TemplateName'] not in mail_created:
+		try:
+			ses.create_template(Template = template)
+			print('created ses template ' + template['TemplateName'])
+
+		except ses.exceptions.AlreadyExistsException:
+			pass
+
+		mail_created.add(template['TemplateName'])
+
+	return template['TemplateName']
+
+
+# get the list of recipients, multiple addresses can be separated by a comma
+def get_recipients(event):
+	return [x.strip() for x in event['to_email'].split(',') if len(x.strip()) > 0]
+
 
-	# optionally, put the small record in your Algolia search DB if the API key is set
-	if event['enable_algolia'] == 'y':
+# send templated emails through the ses bulk api, which accepts up to 50 destinations per call
+@tracer.capture_method(capture_response = False)
+@timed_stage('Mail')
+def send_bulk(mode, destinations, event):
 
-		client = SearchClient.create(event['algolia_app'], event['algolia_apikey'])
-		index = client.init_index(event['algolia_index'])
-		index.save_objects([smallitem])
+	template = get_mail_template(mode)
+	sent = 0
 
-	# merge small and extra item for dynamodb
-	def Merge(dict1, dict2):
-		res = {**dict1, **dict2}
-		return res
+	for i in range(0, len(destinations), 50):
+		res = ses.send_bulk_templated_email(
+			Source = event['from_email'],
+			Template = template,
+			DefaultTemplateData = '{}',
+			Destinations = [{'Destination' : {'ToAddresses' : [recpt]}, 'ReplacementTemplateData' : json.dumps(data)} for recpt, data in destinations[i:i + 50]]
+		)
 
-	# create fullitem for dynamodb
-	fullitem = Merge(smallitem, extraitem)
+		# errors are reported per destination, a failed mail does not fail the run
+		for (recpt, data), status in zip(destinations[i:i + 50], res['Status']):
+			if 'MessageId' in status:
+				sent += 1
 
-	# put the full record into dynamodb
-	ddb.put_item(
-		TableName = table, 
-		Item = fullitem
-	)
+			else:
+				print('failed to send email to ' + recpt + ' : ' + str(status.get('Status')) + ' ' + str(status.get('Error', '')))
 
-	# increment dynamodb counter for blog category by 1
-	update_itemcount(blogsource)
+	print('sent ' + str(sent) + ' ' + mode + ' emails')
 
-	# increment dynamodb counter for all blogs by 1
-	update_itemcount('all')
+	return sent
 
 
-# retrieve the url of a blogpost
+# send a templated email per blogpost and recipient
 @tracer.capture_method(capture_response = False)
-def retrieve_url(url):
+def send_posts(posts, event):
+	return send_bulk('post', [(recpt, post) for post in posts for recpt in get_recipients(event)], event)
 
-	# set a "real" user agent
-	firefox = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:79.0) Gecko/20100101 Firefox/79.0"
 
-	# retrieve the main text section from the url using the readability module and using the Chrome user agent
-	req = requests.get(url, headers = {'User-Agent' : firefox})
-	doc = readability.Document(req.text)
-	rawhtml = doc.summary(html_partial = True)
+# store the digest entries of an invocation on s3 under the prefix of the run, as the map state output is limited to 256KB
+# the entries are stored before the invocation can fail, so the blogposts of a retried invocation are not missing in the digest
+@tracer.capture_method(capture_response = False)
+def put_digest_posts(posts, bucket, run):
 
-	# remove any html tags from output
-	soup = BeautifulSoup(rawhtml, 'html.parser')
-	cleantext = soup.get_text().strip('\n').encode('utf-8')
+	key = 'digest/' + run + '/' + uuid.uuid4().hex + '.json'
+	s3.put_object(Bucket = bucket, Key = key, Body = json.dumps(posts).encode('utf-8'), ContentType = 'application/json')
 
-	return str(rawhtml), str(cleantext)
+	return key
 
 
-# analyze the text of a blogpost using the AWS Comprehend service
+# send one digest email per recipient with the blogposts of all the feeds of a run, collected from the digest entries of the run on s3
 @tracer.capture_method(capture_response = False)
-def comprehend(cleantxt, title):
-	detections = []
-	found = False
+def send_digest(event):
 
-	fulltext = title + " " + cleantxt
+	keys = []
+	posts = []
 
-	# cut down the text to less than 5000 bytes as this is the file limit for Comprehend
-	strlen = sys.getsizeof(fulltext)
+	for page in s3.get_paginator('list_objects_v2').paginate(Bucket = event['s3_bucket'], Prefix = 'digest/' + event['digest_run'] + '/'):
+		keys.extend([x['Key'] for x in page.get('Contents', [])])
 
-	while strlen > 5000:
-		fulltext = fulltext[:-1]
-		strlen = sys.getsizeof(fulltext)
+	for key in keys:
+		posts.extend(json.loads(s3.get_object(Bucket = event['s3_bucket'], Key = key)['Body'].read()))
 
-	# check whether organization or title labels were found by Comprehend
-	for x in com.detect_entities(Text = fulltext, LanguageCode = 'en')['Entities']:
-		if x['Type'] == 'ORGANIZATION' or x['Type'] == 'TITLE' or x['Type'] == 'COMMERCIAL_ITEM' or x['Type'] == 'PERSON':
-			if x['Text'] not in detections:
-				detections.append(x['Text'])
-				found = True
+	if len(posts) == 0:
+		print('no new blogposts for the digest')
+		return 0
 
-	# if no tags were retrieved, add a default tag
-	if found:
-		tags = ', '.join(detections)
-		
-	else:
-		tags = 'none'
+	# list the newest blogposts first, which is the order of the json files
+	posts = sorted(posts, key = lambda k: time.strptime(k['datestr'], '%d-%m-%Y %H:%M'), reverse = True)
 
-	# return tag values	
-	return(tags)
+	sent = send_bulk('digest', [(recpt, {'count' : len(posts), 'posts' : posts}) for recpt in get_recipients(event)], event)
 
+	# remove the digest entries once the emails were sent, a lifecycle rule expires the entries of a failed run
+	for i in range(0, len(keys), 1000):
+		s3.delete_objects(Bucket = event['s3_bucket'], Delete = {'Objects' : [{'Key' : key} for key in keys[i:i + 1000]], 'Quiet' : True})
 
-# send an email out whenever a new blogpost was found - this feature is optional
-@tracer.capture_method(capture_response = False)
-def send_email(recpt, title, blogsource, author, rawhtml, link, datestr_post):
+	return sent
 
-	# create a simple html body for the email
-	mailmsg = '<html><body><br><i>Posted by '+str(author)+' in ' +str(blogsource) + ' blog on ' + str(datestr_post) + '</i><br><br>'
-	mailmsg += '<a href="' + link + '">view post here</a><br><br>' + str(rawhtml) + '<br></body></html>'
 
-	# send the email using SES
-	ses.send_email(
-		Source = event['from_email'],
-		Destination = {'ToAddresses': [recpt]},
-		Message = {
-			'Subject': {
-				'Data': blogsource.upper() + ' - ' + title
-			},
-			'Body': {
-				'Html': {
-					'Data': mailmsg
-				}
-			}
-		}
-	)
-	
-	print('sent email with subject ' + blogsource.upper() + ' - ' + title + ' to ' + recpt)
+# retrieve the article of a new blogpost
+@tracer.capture_method(capture_response = False)
+def fetch_entry(post):
 
+	# retrieve blogpost link
+	print('retrieving '+str(post['title'])+' in '+str(post['blogsource'])+' using url '+str(post['link'])+'\n')
+	post['rawhtml'], post['cleantxt'] = retrieve_url(post['link'])
 
-# main function to kick off collection of an rss feed
+
+# create the dynamodb record for a tagged blogpost
 @tracer.capture_method(capture_response = False)
-def get_feed(url, blogsource, guids, table, event):
+def store_entry(post, table, event):
 
-	# create a variable about blog update and list to store new blogs
-	blogupdate = False
-	newblogs = []
+	# create the record, it is written to dynamodb when the records of the feed are flushed
+	post['item'] = put_dynamo(post['timest'], post['title'], post['cleantxt'], post['rawhtml'], post['description'], post['link'], post['blogsource'], post['author'], post['guid'], post['tags'], post['category'], post['datestr'], table, event)
 
-	# get the rss feed
-	rssfeed = get_rss(url)
+	# encode the body of the record for storage, the plain record is kept for the json files, algolia and mails
+	post['record'] = store_body(post['item'], event['s3_bucket'], post.get('source'))
 
-	print('found ' + str(len(rssfeed['entries'])) + ' blog entries')
+
+# worker for queue jobs, errors are caught per blogpost so one failing article does not fail the whole feed
+def post_worker(q, func, args, failed, blogsource):
+	metric_context.blogsource = blogsource
+
+	while True:
+		try:
+			post = q.get_nowait()
+
+		except queue.Empty:
+			return
+
+		try:
+			func(post, *args)
+
+		except Exception as e:
+			print('failed to process ' + str(post['link']) + ' : ' + str(e))
+			failed.append(post['guid'])
+
+		q.task_done()
+
+
+# run a pipeline stage for all blogposts on a bounded number of threads and return the posts that succeeded
+def run_stage(func, posts, failed, *args):
+
+	# submit a job per blogpost to the queue
+	q2 = queue.Queue()
+
+	for post in posts:
+		q2.put(post)
+
+	# start a thread per job, up to the configured amount of threads
+	for x in range(min(article_threads, len(posts))):
+		t = threading.Thread(target = post_worker, args = (q2, func, args, failed, getattr(metric_context, 'blogsource', 'all')))
+		t.daemon = True
+		t.start()
+	q2.join()
+
+	done = []
+
+	for post in posts:
+		if post['guid'] not in failed:
+			done.append(post)
+
+	return done
+
+
+# get the blogposts of the feed entries that are not stored yet and were published after the cutoff timestamp
+def get_posts(entries, blogsource, guids, cutoff):
+
+	# create a list for the new blogposts
+	posts = []
 
 	# check all the retrieved articles for published dates
-	for x in rssfeed['entries']:
+	for x in entries:
 
 		# retrieve post guid
 		guid = str(x['guid'])
 		timest_post = int(time.mktime(x['updated_parsed']))
-		timest_now = int(time.time())
 
 		# retrieve blog date and description text
 		datestr_post = time.strftime('%d-%m-%Y %H:%M', x['updated_parsed'])
 
-		# if the post guid is not found in dynamodb and newer than the specified amount of days, retrieve the record
-		if guid not in guids and (timest_now < (timest_post + (86400 * days_to_retrieve))):
+		# if the post guid is not found in dynamodb and newer than the cutoff, retrieve the record
+		if guid not in guids and timest_post > cutoff:
 
 			# retrieve other blog post values, remove double quotes from title
 			link = str(x['link'])
@@ -218,15 +1377,8 @@ def get_feed(url, blogsource, guids, table, event):
 			# retrieve the blogpost author if available
 			author = 'blank'
 
-			if x.has_key('author'):
+			if 'author' in x:
 				author = str(x['author'])
-			
-			# retrieve blogpost link			
-			print('retrieving '+str(title)+' in '+str(blogsource)+' using url '+str(link)+'\n')
-			rawhtml, cleantxt = retrieve_url(link)
-
-			# discover tags with comprehend on html output
-			tags = comprehend(cleantxt, title)	
 
 			# clean up blog post description text and remove unwanted characters such as double quotes and spaces (this can be improved further)
 			des	= str(x['description'])
@@ -238,196 +1390,498 @@ def get_feed(url, blogsource, guids, table, event):
 			category = 'none'
 
 			# join category fields in one string
-			if x.has_key('tags'):
+			if 'tags' in x:
 				for tag in x['tags']:
 					category_tmp.append(str(tag['term']))
 	
 				category = str(', '.join(category_tmp))
 
-			# update the blogpost
-			blogupdate = True
+			# add the blogpost to the list
+			posts.append({'guid': guid, 'timest': timest_post, 'datestr': datestr_post, 'link': link, 'title': title, 'author': author, 'description': description, 'category': category, 'blogsource': blogsource})
+
+	return posts
+
+
+# main function to kick off collection of an rss feed
+@tracer.capture_method(capture_response = False)
+def get_feed(url, blogsource, table, event):
+
+	# create a variable about blog update and lists to store new and failed blogs
+	blogupdate = False
+	newblogs = []
+	failed = []
+
+	# only use the feed cache for regular runs, a run with more days to retrieve should always parse the full feed
+	usecache = days_to_retrieve <= 1
+
+	# get the feed state with the validators and the poll schedule
+	state = get_feed_state(blogsource)
+
+	# add the blogposts that an earlier run wrote to dynamodb but could not publish to the json files
+	recovered = []
+
+	if 'publishfrom' in state:
+		recovered = [get_json_item(x) for x in query_blogsource(blogsource, int(state['publishfrom']))]
+		publish_buffer.extend(recovered)
+		print('publishing ' + str(len(recovered)) + ' blog entries of ' + blogsource + ' that were not published before')
+
+	# get the rss feed, the validators are only sent for regular runs
+	rssfeed, validators = get_rss(url, blogsource, state if usecache else {}, int(time.time()) - (86400 * days_to_retrieve))
+
+	# if the feed did not change, return immediately
+	if rssfeed is None:
+
+		# store the poll schedule, and the new etag or last-modified value if only the body hash matched
+		save_feed_state(state, blogsource, validators, get_schedule(state, 0), None, len(recovered) > 0)
+
+		return blogupdate, newblogs
+
+	print('found ' + str(len(rssfeed['entries'])) + ' blog entries')
+	add_metric('EntriesParsed', MetricUnit.Count, len(rssfeed['entries']))
+
+	# get post guids stored in dynamodb for this blogsource for days_to_retrieve
+	guids = get_guids(blogsource, int(time.time()) - (86400 * days_to_retrieve))
+
+	# get the new blogposts of the feed within days_to_retrieve
+	posts = get_posts(rssfeed['entries'], blogsource, guids, int(time.time()) - (86400 * days_to_retrieve))
+
+	# skip blogposts that were already stored through another feed
+	stored = get_stored_keys([(post['guid'], post['timest']) for post in posts])
+	posts = list({ (post['guid'], post['timest']) : post for post in posts if (post['guid'], post['timest']) not in stored }.values())
 
-			# put record to dynamodb
-			put_dynamo(timest_post, title, cleantxt, rawhtml, description, link, blogsource, author, guid, tags, category, datestr_post, table, event)
+	# skip retrieval of blogposts that were stored before under another guid or feed with the same canonical link
+	for post in posts:
+		post['linkkey'] = get_link_key(post['link'])
 
-			# add blog to newblogs list
-			newblogs.append(str(blogsource) + ' ' + str(title) + ' ' + str(guid))
+	posts, dups = get_duplicates(posts, 'linkkey')
+	add_metric('EntriesNew', MetricUnit.Count, len(posts) + len(dups))
 
-			# if sendemails enabled, generate the email message body for ses and send email
-			if send_mail == 'y':
+	# retrieve the articles of the new blogposts concurrently
+	posts = run_stage(fetch_entry, posts, failed)
 
-				# get mail title and email recepient
-				title = blogsource.upper()+' - '+title
-				recpt = event['to_email']
+	# skip tagging of retrieved blogposts with the same text as a stored post
+	for post in posts + dups:
+		post['bodykey'] = get_body_key(post['cleantxt'])
 
-				# send the email
-				send_email(recpt, title, blogsource, author, rawhtml, link, datestr_post)
+	posts, bodydups = get_duplicates(posts, 'bodykey')
+
+	# tag all retrieved blogposts with comprehend in batches
+	posts = comprehend(posts, failed) + dups + bodydups
+
+	# create the records for the tagged blogposts and write them to dynamodb in batches
+	posts = run_stage(store_entry, posts, failed, table, event)
+	items = flush_dynamo([post['record'] for post in posts], failed)
+
+	# store the link and body identities of the written blogposts
+	written = set([(x['guid'], x['timest']) for x in items])
+	posts = list({ (post['guid'], post['timest']) : post for post in posts if (post['guid'], post['timest']) in written }.values())
+	put_identities(posts)
+	posts = [post['item'] for post in posts]
+
+	# add the written blogposts to the buffer for the public json files
+	publish_buffer.extend(posts)
+
+	# optionally, add the small records of the written blogposts to the algolia buffer if the API key is set
+	if event['enable_algolia'] == 'y':
+		for post in posts:
+			algolia_buffer.append({ k : post[k] for k in algolia_fields })
+
+	# if sendemails enabled, add the blogposts to the mail buffer, the mails are sent per invocation or per run in digest mode
+	if send_mail == 'y':
+		mail_buffer.extend([get_mail_post(post) for post in posts])
+
+	# add blogs to newblogs list
+	for post in posts:
+		newblogs.append(str(post['blogsource']) + ' ' + str(post['title']) + ' ' + str(post['guid']))
+
+	# update the blogpost if at least one new post was stored
+	if len(newblogs) > 0:
+		blogupdate = True
+
+	# store the feed validators once all entries were processed, failed entries will be retried on the next run
+	# the amount of new posts is only stored for regular runs, as a run with more days to retrieve is not representative for a poll
+	# the poll schedule is updated in both cases, a feed with failed entries is polled again soon like a failed feed
+	# if blogposts of the feed are published in this invocation, the state is stored after the json files were updated
+	gap = get_publish_gap(rssfeed['entries'])
+	pending = len(posts) + len(recovered) > 0
+
+	if len(failed) == 0:
+		save_feed_state(state, blogsource, validators, get_schedule(state, len(newblogs), gap), len(newblogs) if usecache else None, pending)
+
+	else:
+		print('failed to process ' + str(len(failed)) + ' blog entries, not updating the feed cache')
+		save_feed_state(state, blogsource, None, get_schedule(state, len(newblogs), gap, True), None, pending)
 
 	return blogupdate, newblogs
 
 
-# check if new items were uploaded to s3
+# worker for the feeds of a batch, errors are caught per feed so the other feeds of the batch are still stored and published
+def feed_worker(q, table, event, results):
+	while True:
+		try:
+			i, msg = q.get_nowait()
+
+		except queue.Empty:
+			return
+
+		result = {'blogsource': msg['blogsource'], 'url': msg['url'], 'newblogs': [], 'error': None}
+
+		try:
+			with metric_blogsource(msg['blogsource']), timed_stage('Feed'):
+				blogupdate, result['newblogs'] = get_feed(msg['url'], msg['blogsource'], table, event)
+
+		except Exception as e:
+			print('failed to retrieve feed ' + str(msg['url']) + ' : ' + str(e))
+			result['error'] = str(e)
+
+			with metric_blogsource(msg['blogsource']):
+				add_metric('FeedErrors', MetricUnit.Count, 1)
+
+			# back off the poll schedule of the failed feed, without failing the other feeds if the state can not be stored
+			# the feed may have written blogposts before it failed, so these are published again on the next run
+			try:
+				state = get_feed_state(msg['blogsource'])
+				put_feed_state(msg['blogsource'], None, get_schedule(state, 0, error = True), publishfrom = get_publish_from(state))
+
+			except Exception as e:
+				print('failed to store the poll schedule of ' + msg['blogsource'] + ' : ' + str(e))
+
+		results[i] = result
+		q.task_done()
+
+
+# poll all the feeds of a batch on a bounded number of threads and return a result per feed
+@tracer.capture_method(capture_response = False)
+def get_feeds(msgs, table, event):
+
+	# store the results in the order of the submitted feeds
+	q1 = queue.Queue()
+	results = [None] * len(msgs)
+
+	for i, msg in enumerate(msgs):
+		q1.put((i, msg))
+
+	for x in range(min(feed_threads, len(msgs))):
+		t = threading.Thread(target = feed_worker, args = (q1, table, event, results))
+		t.daemon = True
+		t.start()
+	q1.join()
+
+	return results
+
+
+# check if json files were published in the last 300 seconds using the manifest, instead of listing the bucket
 @tracer.capture_method(capture_response = False)
 def get_s3_json_age(bucket):
 
 	# set variable for s3 update operation
 	updateblog = False
+	nowtime = int(time.time())
+
+	for blogsource, x in get_manifest(bucket).items():
+		difftime = nowtime - int(x['ts'])
+
+		# if a json file was published in the last 300 seconds, update the blog feed
+		if difftime < 300:
+			updateblog = True
 
-	# list objects in s3
-	s3list = s3.list_objects_v2(Bucket = bucket)
+		print(str(difftime) + " " + blogsource + '.json')
 
-	print('get s3 list ' + str(s3list))
+	# return true/false about blog update status
+	return updateblog
 
-	# iterate over present files in s3
-	if 'Contents' in s3list:
-		for s3file in s3list['Contents']:
 
-			# get last modified time of item
-			s3time = s3file['LastModified']
+# read the manifest and its etag from s3, returns None for the etag if the manifest does not exist
+def read_manifest(bucket):
 
-			objtime = int(time.mktime(s3time.timetuple()))
-			nowtime = int(time.time())
-			difftime = nowtime - objtime
+	try:
+		s3obj = s3.get_object(Bucket = bucket, Key = manifest_key)
 
-			# if an s3 file was created in the last 300 seconds, update the blog feed
-			if difftime < 300:
-				updateblog = True
-		
-			print(str(difftime) + " " + str(s3file['Key']))
+	except s3.exceptions.NoSuchKey:
+		return {'updated' : 0, 'blogs' : {}}, None
 
-	# return true/false about blog update status
-	return updateblog
+	return json.loads(s3obj['Body'].read()), s3obj['ETag']
 
 
-# get the contents of the dynamodb table for json object on S3
+# get the published blogsources from the manifest, it is only read on the first call of an invocation
 @tracer.capture_method(capture_response = False)
-def get_table_json(blogsource, bucket):
+def get_manifest(bucket):
+	global manifest, manifest_etag
 
-	# create a list for found guids from json stored on s3
-	s3guids = []
+	if manifest is None:
+		manifest, manifest_etag = read_manifest(bucket)
 
-	# create a list for s3 objects that were found
-	s3files = []
+	return manifest['blogs']
 
-	# check if the s3 object exists by listing current s3 objects
-	s3list = s3.list_objects_v2(Bucket = bucket)
 
-	# set days_to_get value
-	days_to_get = int(days_to_retrieve)
+# write the publish updates of this invocation to the manifest, on a conflict the manifest is read again and the updates are merged
+@tracer.capture_method(capture_response = False)
+def put_manifest(bucket):
+	global manifest, manifest_etag
 
+	for attempt in range(publish_attempts):
 
-	# iterate over present files in s3
-	if 'Contents' in s3list:
+		if manifest is None:
+			manifest, manifest_etag = read_manifest(bucket)
 
-		for x in s3list['Contents']:
-			s3files.append(x['Key'])
+		# keep the entry of a concurrent invocation if it was published later
+		for blogsource, x in manifest_updates.items():
+			if x['ts'] >= manifest['blogs'].get(blogsource, {}).get('ts', 0):
+				manifest['blogs'][blogsource] = x
 
-	# if the blog json is available on s3
-	if str(blogsource + '.json') in s3files:
-		
-		# retrieve the object from s3
-		s3obj = s3.get_object(Bucket = bucket, Key = blogsource + '.json')
-		
-		# create list for results from json
-		res = json.loads(s3obj['Body'].read())
+		manifest['updated'] = int(time.time())
 
-		# add guids from json file to s3guids list
-		for s3file in res:
-			s3guids.append(s3file['guid'])
+		# only overwrite the manifest if it did not change since it was read
+		if manifest_etag is None:
+			condition = {'IfNoneMatch': '*'}
 
-	# if the blog json does not exist on s3
-	else:
+		else:
+			condition = {'IfMatch': manifest_etag}
 
-		# since the previous results can not be found, create an emptylist for results and get current time
-		res = []
+		try:
+			res = s3.put_object(
+				Bucket = bucket,
+				Body = json.dumps(manifest).encode('utf-8'),
+				Key = manifest_key,
+				ACL = 'public-read',
+				CacheControl = 'public, max-age=60',
+				ContentType = 'application/json',
+				**condition
+			)
 
-		print('could not find ' + blogsource + '.json file on s3')
+			manifest_etag = res['ETag']
+			print('updated manifest for ' + ', '.join(sorted(manifest_updates.keys())))
+			return
 
-	# get the current timestamp
-	now_ts = datetime.now()
+		except botocore.exceptions.ClientError as e:
+			if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+				raise
 
-	# get timestamp based on days_to_retrieve 
-	old_ts = now_ts - timedelta(days = days_to_get)
-	diff_ts = int(time.mktime(old_ts.timetuple()))
+			print('manifest was updated concurrently, retrying')
+			manifest = None
+			time.sleep(random.uniform(0, 0.1 * (2 ** attempt)))
 
-	if blogsource != 'all':
+	raise Exception('failed to update the manifest after ' + str(publish_attempts) + ' attempts')
+
+
+# convert a blogpost record to the json format used on s3
+def get_json_item(a):
+	return {'timest': str(a['timest']), 'blogsource': a['blogsource'], 'title': a['title'], 'datestr': a['datestr'], 'guid': a['guid'], 'link': a['link'], 'description': a['description'].strip(), 'author': a['author']}
+
+
+# get the visible key of a blogpost, which is a shard chosen by a hash of the guid
+def get_visible_key(guid):
+
+	if visible_shards < 1:
+		return 'y'
+
+	return 'y#' + str(zlib.crc32(guid.encode('utf-8')) % visible_shards)
+
+
+# query all shards of the visible index in parallel for the blogposts after timestamp ts and merge these in timestamp order
+# the unsharded 'y' key is queried too, as it holds the blogposts that were stored before the sharding and are not re-keyed yet
+# the resolver pages through the blogposts with a timestamp before which to start and the guids at that timestamp to skip
+@tracer.capture_method(capture_response = False)
+def query_visible(ts, projection = None, limit = None, ascending = True, before = None, skip = ()):
+	keys = ['y'] + ['y#' + str(x) for x in range(visible_shards)]
+	results = [[] for x in keys]
+	errors = []
+
+	if before is None:
+		condition = Key('timest').gt(ts)
 
-		# query the dynamodb table for blogposts of a specific category from up to 1 day ago
-		blogs = ddb.query(IndexName = "timest", ScanIndexForward = True, ProjectionExpression = 'blogsource, datestr, timest, title, author, description, link, guid', KeyConditionExpression = Key('blogsource').eq(blogsource) & Key('timest').gt(diff_ts))
-			
 	else:
+		condition = Key('timest').between(ts + 1, before)
 
-		# query the dynamodb table for all category blogposts from up to 1 day ago
-		blogs = ddb.query(IndexName = "visible", ScanIndexForward = True, ProjectionExpression = 'blogsource, datestr, timest, title, author, description, link, guid', KeyConditionExpression = Key('visible').eq('y') & Key('timest').gt(diff_ts))
+	def query_shard(i):
+		query = {'IndexName' : index_visible, 'ScanIndexForward' : ascending, 'KeyConditionExpression' : Key('visible').eq(keys[i]) & condition}
 
-	# iterate over the returned items
-	for a in blogs['Items']:
+		if projection is not None:
+			query['ProjectionExpression'] = projection
 
-		# if guid not present in s3 json file
-		if a['guid'] not in s3guids:
+		try:
+			while True:
 
-			b = {'timest': str(a['timest']), 'blogsource': a['blogsource'], 'title': a['title'], 'datestr': a['datestr'], 'guid': a['guid'], 'link': a['link'], 'description': a['description'].strip(), 'author': a['author']}
-			
-			# add the json object to the result list
-			res.append(b)
+				# a shard can hold all of the newest blogposts, so every shard is queried up to the limit
+				if limit is not None:
+					query['Limit'] = limit + len(skip) - len(results[i])
 
-		# retrieve additional items if lastevaluatedkey was found 
-		while 'LastEvaluatedKey' in blogs:
-			lastkey = blogs['LastEvaluatedKey']
+				res = ddb.query(**query)
+				results[i].extend(x for x in res['Items'] if x['guid'] not in skip)
 
-			if blogsource != 'all':
+				if 'LastEvaluatedKey' not in res or (limit is not None and len(results[i]) >= limit):
+					return
 
-				# query the dynamodb table for blogposts of a specific category 
-				blogs = ddb.query(IndexName = "timest", ScanIndexForward = True, ExclusiveStartKey = lastkey, ProjectionExpression = 'blogsource, datestr, timest, title, author, description, link, guid', KeyConditionExpression = Key('blogsource').eq(blogsource) & Key('timest').gt(diff_ts))
-			
-			else:
+				query['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+		except Exception as e:
+			errors.append(e)
+
+	threads = [threading.Thread(target = query_shard, args = (i, )) for i in range(len(keys))]
+
+	for t in threads:
+		t.start()
+
+	for t in threads:
+		t.join()
+
+	# fail the query if a shard failed, as the merged result would silently miss blogposts
+	if len(errors) > 0:
+		raise errors[0]
+
+	return list(itertools.islice(heapq.merge(*results, key = lambda x: x['timest'], reverse = not ascending), limit))
+
+
+# get the contents of the dynamodb table for json object on S3, this is only used to rebuild the full json file
+@tracer.capture_method(capture_response = False)
+def get_table_json(blogsource):
+
+	# create a list for the results
+	res = []
 
-				# query the dynamodb table for all category blogposts from up to 30 days old
-				blogs = ddb.query(IndexName = "visible", ScanIndexForward = True, ExclusiveStartKey = lastkey, ProjectionExpression = 'blogsource, datestr, timest, title, author, description, link, guid', KeyConditionExpression = Key('visible').eq('y') & Key('timest').gt(diff_ts))
+	# get timestamp based on the json retention window
+	diff_ts = int(time.time()) - (86400 * json_retention_days)
 
-			# add an entry per blog to the output list
-			for a in blogs['Items']:
-				
-				# if guid not present in s3 json file
-				if a['guid'] not in s3guids:
+	if blogsource == 'all':
 
-					b = {'timest': str(a['timest']), 'blogsource': a['blogsource'], 'title': a['title'], 'datestr': a['datestr'], 'guid': a['guid'], 'author': a['author'], 'link': a['link'], 'description': a['description'].strip()}
-					
-					# add the json object to the result list
-					res.append(b)
+		# query the shards of the visible index for all category blogposts within the retention window
+		for a in query_visible(diff_ts, 'blogsource, datestr, timest, title, author, description, link, guid'):
+			res.append(get_json_item(a))
+
+		return res
+
+	# query the dynamodb table for blogposts of a specific category within the retention window
+	for a in query_blogsource(blogsource, diff_ts):
+		res.append(get_json_item(a))
 
 	return res
 
 
-# copy the file to s3 with a public acl
+# get the blogposts of a blogsource after timestamp ts from the per blogsource index, with the attributes of the json files
+@tracer.capture_method(capture_response = False)
+def query_blogsource(blogsource, ts):
+	items = []
+	query = {'IndexName' : index_blogsource, 'ScanIndexForward' : True, 'ProjectionExpression' : 'blogsource, datestr, timest, title, author, description, link, guid', 'KeyConditionExpression' : Key('blogsource').eq(blogsource) & Key('timest').gt(ts)}
+
+	# retrieve additional items if lastevaluatedkey was found
+	while True:
+		blogs = ddb.query(**query)
+		items.extend(blogs['Items'])
+
+		if 'LastEvaluatedKey' not in blogs:
+			return items
+
+		query['ExclusiveStartKey'] = blogs['LastEvaluatedKey']
+
+
+# get the current json object and its etag from s3, returns None for the etag if the object does not exist
+@tracer.capture_method(capture_response = False)
+def get_json_s3(blogsource, bucket, usemanifest):
+
+	# skip the request if the manifest shows that the json file was not published yet
+	if usemanifest and blogsource not in get_manifest(bucket):
+		print('could not find ' + blogsource + '.json in the manifest')
+
+		return [], None
+
+	try:
+		s3obj = s3.get_object(Bucket = bucket, Key = blogsource + '.json')
+
+	except s3.exceptions.NoSuchKey:
+		print('could not find ' + blogsource + '.json file on s3')
+
+		return [], None
+
+	return json.loads(s3obj['Body'].read()), s3obj['ETag']
+
+
+# merge the blogposts written in this invocation into the existing json content
+def merge_json(content, posts):
+
+	# create a set of guids already present in the json content
+	s3guids = set(x['guid'] for x in content)
+
+	for post in posts:
+		if post['guid'] not in s3guids:
+			content.append(get_json_item(post))
+			s3guids.add(post['guid'])
+
+	return content
+
+
+# copy the file to s3 with a public acl, only overwrite the object if it did not change since it was read
 @tracer.capture_method(capture_response = False)
-def cp_s3(blogsource, bucket):
+def cp_s3(blogsource, bucket, etag):
+
+	# use if-match for an existing object and if-none-match for a new object, to avoid lost updates from concurrent map branches
+	if etag is None:
+		condition = {'IfNoneMatch': '*'}
+
+	else:
+		condition = {'IfMatch': etag}
 
-	# put object to s3
-	s3.put_object(
+	# put object to s3 and return the etag of the new object
+	res = s3.put_object(
 		Bucket = bucket, 
 		Body = open('/tmp/' + blogsource + '.json', 'rb'), 
 		Key = blogsource + '.json', 
 		ACL = 'public-read',
 		CacheControl = 'public',
-		ContentType = 'application/json'
+		ContentType = 'application/json',
+		**condition
 	)
 
+	return res['ETag']
 
-# update json objects on S3 for single page web apps
+
+# update json objects on S3 for single page web apps, either by merging the new blogposts or by rebuilding the file from dynamodb
 @tracer.capture_method(capture_response = False)
-def update_json_s3(blog, bucket):
+@timed_stage('Publish')
+def update_json_s3(blog, bucket, posts, rebuild):
+
+	print('updating json for ' + blog + ', rebuild ' + str(rebuild))
+
+	for attempt in range(publish_attempts):
+
+		# get the current json content and etag from s3, a retry always reads the object in case the manifest is outdated
+		content, etag = get_json_s3(blog, bucket, attempt == 0)
 
-	print('updating json for ' + blog)
+		# get the json content from DynamoDB if a rebuild was requested or no json file exists yet
+		if rebuild or etag is None:
+			content = get_table_json(blog)
 
-	# get the json content from DynamoDB
-	out = get_table_json(blog, bucket)
+		else:
+			content = merge_json(content, posts)
 
-	# create the json and return path
-	make_json(out, blog)
+		# create the json and return the sorted content
+		dumpfile = make_json(content, blog)
 
-	# upload the json to s3
-	cp_s3(blog, bucket)
+		# upload the json to s3, retry with the latest version if another invocation updated the object in the meantime
+		try:
+			newetag = cp_s3(blog, bucket, etag)
+
+		except botocore.exceptions.ClientError as e:
+			if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+				raise
+
+			print('json for ' + blog + ' was updated concurrently, retrying')
+
+			# wait a random part of the backoff, so the map branches that conflicted on the all json file do not retry in step
+			time.sleep(random.uniform(0, 0.1 * (2 ** attempt)))
+			continue
+
+		# add the publish timestamp, post count and etag to the manifest updates of this invocation
+		manifest_updates[blog] = {'ts' : int(time.time()), 'count' : len(dumpfile), 'etag' : newetag}
+		add_metric('PublishBytes', MetricUnit.Bytes, os.path.getsize('/tmp/' + blog + '.json'))
+		add_metric('PublishAttempts', MetricUnit.Count, attempt + 1)
+
+		# optionally, publish the pre-compressed shards of the json content, the version orders concurrent publishers
+		if json_shards == 'y':
+			publish_shards(blog, bucket, dumpfile, time.time_ns())
+
+		return
+
+	raise Exception('failed to update json for ' + blog + ' after ' + str(publish_attempts) + ' attempts')
 
 
 # create a json file from blog content
@@ -439,9 +1893,12 @@ def make_json(content, blogsource):
 	# create empty list for filteredcontent
 	filteredcontent = []
 
-	# filter blog posts for category
+	# get timestamp based on the json retention window
+	diff_ts = int(time.time()) - (86400 * json_retention_days)
+
+	# filter blog posts for category and remove posts outside of the retention window
 	for blog in content:
-		if blog['blogsource'] == blogsource or blogsource == 'all':
+		if (blog['blogsource'] == blogsource or blogsource == 'all') and int(blog['timest']) > diff_ts:
 			filteredcontent.append(blog)
 
 	# sort the keys by timestamp
@@ -452,10 +1909,162 @@ def make_json(content, blogsource):
 
 	print('wrote to ' + fpath)
 
+	return dumpfile
+
+
+# compress a json document with gzip and brotli, these are stored as separate objects with a content-encoding header
+def compress_json(body):
+	import brotli, gzip
+
+	return {
+		'gz' : ('gzip', gzip.compress(body, 9, mtime = 0)),
+		'br' : ('br', brotli.compress(body))
+	}
+
+
+# upload a json shard as pre-compressed objects, the key contains the content hash so the objects never change
+@tracer.capture_method(capture_response = False)
+def put_shard(bucket, key, body):
+
+	for ext, (encoding, data) in compress_json(body).items():
+		s3.put_object(
+			Bucket = bucket,
+			Body = data,
+			Key = key + '.json.' + ext,
+			ACL = 'public-read',
+			CacheControl = 'public, max-age=31536000, immutable',
+			ContentEncoding = encoding,
+			ContentType = 'application/json'
+		)
+
+
+# get the shard manifest of a blogsource and its etag from s3, returns None for the etag if the manifest does not exist
+def get_shard_manifest(blogsource, bucket):
+
+	try:
+		s3obj = s3.get_object(Bucket = bucket, Key = blogsource + '/manifest.json')
+
+	except s3.exceptions.NoSuchKey:
+		return {'version' : 0, 'latest' : {}, 'shards' : [], 'retired' : []}, None
+
+	return json.loads(s3obj['Body'].read()), s3obj['ETag']
+
+
+# publish the json content as a small 'latest' shard and monthly archive shards with a manifest, so a first page load only fetches a few KB
+@tracer.capture_method(capture_response = False)
+def publish_shards(blogsource, bucket, content, version):
+
+	# split the content in the latest posts and per month shards, the content is sorted by timestamp already
+	docs = {'latest' : content[:json_latest_count]}
+
+	for blog in content:
+		month = time.strftime('%Y-%m', time.gmtime(int(blog['timest'])))
+		docs.setdefault(month, []).append(blog)
+
+	nowmonth = time.strftime('%Y-%m', time.gmtime())
+
+	for attempt in range(publish_attempts):
+
+		# skip publishing if a newer version of the json content was published by another invocation
+		manifest, etag = get_shard_manifest(blogsource, bucket)
+
+		if manifest['version'] >= version:
+			print('newer shards for ' + blogsource + ' were already published')
+			return
+
+		# get the shards that were published before, so unchanged shards are not uploaded again, a new manifest has no latest shard yet
+		current = {}
+
+		for shard in [manifest['latest']] + manifest['shards']:
+			if shard.get('hash') is not None and shard.get('key') is not None:
+				current[shard['hash']] = shard['key']
+
+		shards = []
+		latest = {}
+
+		for name, doc in docs.items():
+			body = json.dumps(doc).encode('utf-8')
+			bodyhash = hashlib.sha256(body).hexdigest()[:16]
+			key = current.get(bodyhash, blogsource + '/' + name + '.' + bodyhash)
+
+			if bodyhash not in current:
+				put_shard(bucket, key, body)
+				print('uploaded shard ' + key + ' with ' + str(len(doc)) + ' posts')
+
+			shard = {'key' : key, 'hash' : bodyhash, 'count' : len(doc)}
+
+			if name == 'latest':
+				latest = shard
+
+			else:
+				shard['month'] = name
+				shard['closed'] = name < nowmonth
+				shards.append(shard)
+
+		# delete shards that were retired more than a day ago, as clients with a cached manifest may still request recently retired shards
+		inuse = set([latest['key']] + [x['key'] for x in shards])
+		retired = []
+
+		# a retired shard is in use again if the same content hashed to its key, so it is dropped from the retired list and never deleted
+		for x in manifest['retired']:
+			if x['key'] in inuse:
+				continue
+
+			if x['ts'] < int(time.time()) - 86400:
+				s3.delete_objects(Bucket = bucket, Delete = {'Objects' : [{'Key' : x['key'] + '.json.gz'}, {'Key' : x['key'] + '.json.br'}]})
+
+			else:
+				retired.append(x)
+
+		for key in set(current.values()):
+			if key not in inuse and key not in [x['key'] for x in retired]:
+				retired.append({'key' : key, 'ts' : int(time.time())})
+
+		newmanifest = {
+			'blogsource' : blogsource,
+			'version' : version,
+			'updated' : int(time.time()),
+			'encodings' : ['br', 'gz'],
+			'latest' : latest,
+			'shards' : sorted(shards, key = lambda k: k['month'], reverse = True),
+			'retired' : retired
+		}
+
+		# only overwrite the manifest if it did not change since it was read
+		if etag is None:
+			condition = {'IfNoneMatch': '*'}
+
+		else:
+			condition = {'IfMatch': etag}
+
+		try:
+			s3.put_object(
+				Bucket = bucket,
+				Body = json.dumps(newmanifest).encode('utf-8'),
+				Key = blogsource + '/manifest.json',
+				ACL = 'public-read',
+				CacheControl = 'public, max-age=60',
+				ContentType = 'application/json',
+				**condition
+			)
+
+			print('published ' + str(len(shards)) + ' shards for ' + blogsource)
+			return
+
+		except botocore.exceptions.ClientError as e:
+			if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+				raise
+
+			print('shard manifest for ' + blogsource + ' was updated concurrently, retrying')
+			time.sleep(random.uniform(0, 0.1 * (2 ** attempt)))
+
+	raise Exception('failed to publish shards for ' + blogsource + ' after ' + str(publish_attempts) + ' attempts')
+
 
 # lambda handler
 @logger.inject_lambda_context(log_event = True)
 @tracer.capture_lambda_handler
+@log_metrics
 def handler(event, context): 
 	
 	print('event ' + str(event))
@@ -468,7 +2077,31 @@ def handler(event, context):
 	global send_mail
 	send_mail = event['send_mail']
 	blogupdate = False
-	newblogs = ''
+	msgs = []
+	results = []
+
+	# reset the feed cache hit and miss counters for this run
+	global cache_stats
+	cache_stats = {'hit' : 0, 'miss' : 0}
+
+	# clear any records left in the buffers by a failed earlier invocation
+	global algolia_buffer, publish_buffer, mail_buffer, state_buffer
+	algolia_buffer = []
+	publish_buffer = []
+	mail_buffer = []
+	state_buffer = []
+
+	# send the digest email with the blogposts collected by the map state
+	if event['msg'] == 'digest':
+		return {'sent' : send_digest(event)}
+
+	# read the manifest again in every invocation, as other invocations may have published json files
+	global manifest, manifest_updates
+	manifest = None
+	manifest_updates = {}
+
+	# check if the json files on s3 should be rebuilt from dynamodb instead of updated incrementally
+	rebuild = event.get('rebuild', 'n') == 'y'
 
 	bucket = event['s3_bucket']
 	table = os.environ['dynamo_table']
@@ -482,19 +2115,88 @@ def handler(event, context):
 
 	else:
 
-		# get submitted values from blog to retrieve
-		url = event['msg']['url']
-		blogsource = event['msg']['blogsource']
-		guids = event['guids']
-		days_to_retrieve = int(event['msg']['daystoretrieve'])
-		send_mail = event['send_mail']
+		# get submitted values from the blog to retrieve, a batch of feeds can be submitted as a list
+		msgs = event['msg'] if isinstance(event['msg'], list) else [event['msg']]
+		blogsource = ', '.join([msg['blogsource'] for msg in msgs])
+		days_to_retrieve = int(msgs[0]['daystoretrieve'])
+
+		# get the feeds and the blogposts that were written to dynamodb
+		results = get_feeds(msgs, table, event)
+		blogupdate = len(publish_buffer) > 0 or rebuild
+		trace_fetches()
 
-		# get feed and boolean indicating if an update to s3 is required
-		blogupdate, newblogs = get_feed(url, blogsource, guids, table, event)
+	# index the written blogposts in algolia
+	if event['enable_algolia'] == 'y':
+		flush_algolia(event)
+
+	# if new blogposts found, create new json output on s3, the blogsources whose json files were not updated are collected per feed
+	publish_error = None
+	publish_failed = set()
 
-	# if new blogposts found, create new json output on s3
 	if blogupdate == True and event['storepublics3'] == 'y':
 		print('updating json output on s3 for ' + blogsource)
-		update_json_s3(blogsource,  bucket)
+		blogsources = sorted(set([post['blogsource'] for post in publish_buffer]))
+
+		# a rebuild also rewrites the json files of the feeds without new blogposts
+		if rebuild:
+			blogsources = sorted(set(blogsources + [msg['blogsource'] for msg in msgs]))
+
+		try:
+
+			# merge the written blogposts into the blog and all json files, the 'all' path and the rebuild option query dynamodb instead
+			if blogsource == 'all':
+				update_json_s3(blogsource, bucket, [], True)
+
+			else:
+				for x in blogsources:
+					try:
+						with metric_blogsource(x):
+							update_json_s3(x, bucket, [post for post in publish_buffer if post['blogsource'] == x], rebuild)
+
+					except Exception as e:
+						print('failed to update json output on s3 for ' + x + ' : ' + str(e))
+						publish_failed.add(x)
+
+				# the all json file is only updated once per batch, it holds the blogposts of every feed in the batch
+				# with a rebuild every batch queries the whole visible index for it, which costs a full read per batch
+				update_json_s3('all', bucket, publish_buffer, rebuild)
+
+			# write the published json files to the manifest
+			put_manifest(bucket)
+
+		except Exception as e:
+			print('failed to update json output on s3 for ' + blogsource + ' : ' + str(e))
+			publish_error = e
+			publish_failed.update(blogsources)
+
+	# store the feed states now the json files were updated, the feeds whose json files were not updated are published on the next run
+	flush_feed_states(publish_failed)
+
+	# report the feeds whose json files were not updated as failed, so only these are retried
+	for result in results:
+		if result['blogsource'] in publish_failed and result['error'] is None:
+			result['error'] = 'failed to update the json files'
+
+	# send the mails of the blogposts in this invocation, in digest mode the blogposts are stored on s3 for the digest of the run instead
+	mail_mode = event.get('mail_mode', 'post')
+
+	if len(mail_buffer) > 0 and mail_mode == 'post':
+		send_posts(mail_buffer, event)
+
+	elif len(mail_buffer) > 0 and mail_mode == 'digest':
+		put_digest_posts(mail_buffer, bucket, event['digest_run'])
+
+	print('feed cache hits: ' + str(cache_stats['hit']) + ', misses: ' + str(cache_stats['miss']))
+
+	# fail the invocation if the json files of the 'all' path were not updated, so the state machine retries it
+	if publish_error is not None and len(msgs) == 0:
+		raise publish_error
+
+	# return the failed feeds separately, so they can be retried without polling the other feeds of the batch again
+	retry = [msg for msg, result in zip(msgs, results) if result['error'] is not None]
+
+	# raise an error for a single feed or a retried batch, so the state machine retries the invocation
+	if len(retry) > 0 and (not isinstance(event['msg'], list) or event.get('raise_on_error', 'n') == 'y'):
+		raise Exception('failed to retrieve ' + ', '.join([msg['blogsource'] for msg in retry]))
 
-	return newblogs
+	return {'results': results, 'retry': retry}
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# resolve the appsync fields, the function is deployed from the getfeed folder so it decodes the bodies and queries the visible shards
+# with the same functions as getfeed stores them
+
+import base64, boto3, getfeed, json, os
+
+from aws_lambda_powertools import Logger, Tracer
+from boto3.dynamodb.conditions import Key
+
+logger = Logger()
+modules_to_be_patched = ["boto3"]
+tracer = Tracer(patch_modules = modules_to_be_patched)
+
+# establish a session with DynamoDB
+ddb = boto3.resource('dynamodb', region_name = os.environ['dynamo_region']).Table(os.environ['dynamo_table'])
+
+# set the names of the global secondary indexes on the visible and blogsource keys, these change when the indexes are migrated
+index_visible = os.environ.get('index_visible', 'visible')
+index_blogsource = os.environ.get('index_blogsource', 'timest')
+
+# set the amount of blogposts per page of the list fields
+page_size = int(os.environ.get('page_size', 25))
+
+
+# encode the last evaluated key of a query as the opaque nexttoken string of appsync
+def get_next_token(res):
+	if 'LastEvaluatedKey' not in res:
+		return None
+
+	key = {k : int(v) if k == 'timest' else v for k, v in res['LastEvaluatedKey'].items()}
+
+	return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('utf-8')
+
+
+# query an index with the nexttoken of the previous page as the start key
+def query_index(args, **query):
+	if args.get('nextToken'):
+		query['ExclusiveStartKey'] = json.loads(base64.urlsafe_b64decode(args['nextToken'].encode('utf-8')))
+
+	return ddb.query(**query)
+
+
+# get the listing fields of the blogposts in an index page
+def get_list_items(res):
+	return [{'blogsource': x['blogsource'], 'guid': x['guid'], 'timest': int(x['timest']), 'link': x.get('link'), 'author': x.get('author'), 'title': x.get('title')} for x in res['Items']]
+
+
+# get a page of the newest blogposts of a blogsource for the QueryDdbByBlogsourceAndTimest field
+@tracer.capture_method(capture_response = False)
+def get_by_blogsource(args):
+	res = query_index(args, IndexName = index_blogsource, Limit = page_size, ScanIndexForward = False, KeyConditionExpression = Key('blogsource').eq(args['blogsource']) & Key('timest').gt(args['timest']))
+
+	return {'items': get_list_items(res), 'nextToken': get_next_token(res)}
+
+
+# get a page of the newest blogposts of all blogsources for the QueryDdbByVisibleAndTimest field
+# the nexttoken holds the timestamp of the last blogpost and the guids with that timestamp, as the shards have no shared last evaluated key
+@tracer.capture_method(capture_response = False)
+def get_by_visible(args):
+
+	# query a single key of the visible index directly, such as a shard or a key of another 'visible' value
+	if args['visible'] != 'y':
+		res = query_index(args, IndexName = index_visible, Limit = page_size, ScanIndexForward = False, KeyConditionExpression = Key('visible').eq(args['visible']) & Key('timest').gt(args['timest']))
+
+		return {'items': get_list_items(res), 'nextToken': get_next_token(res)}
+
+	before = None
+	skip = set()
+
+	if args.get('nextToken'):
+		token = json.loads(base64.urlsafe_b64decode(args['nextToken'].encode('utf-8')))
+		before = token['timest']
+		skip = set(token['guids'])
+
+	# one blogpost more than the page size is retrieved to check whether there is a next page
+	items = getfeed.query_visible(args['timest'], limit = page_size + 1, ascending = False, before = before, skip = skip)
+	token = None
+
+	if len(items) > page_size:
+		items = items[:page_size]
+		last = int(items[-1]['timest'])
+		guids = [x['guid'] for x in items if int(x['timest']) == last]
+
+		# keep the skipped guids of the previous page if the page ends at the same timestamp
+		if last == before:
+			guids += list(skip)
+
+		token = base64.urlsafe_b64encode(json.dumps({'timest': last, 'guids': guids}).encode('utf-8')).decode('utf-8')
+
+	return {'items': get_list_items({'Items': items}), 'nextToken': token}
+
+
+# get the page count rows of all blogsources for the QueryDdbItemCountAll field
+@tracer.capture_method(capture_response = False)
+def get_item_count_all(args):
+	items = []
+	query = {'IndexName': index_visible, 'KeyConditionExpression': Key('visible').eq('y') & Key('timest').eq(0)}
+
+	while True:
+		res = ddb.query(**query)
+
+		for x in res['Items']:
+			items.append({'blogsource': x['blogsource'], 'timest': int(x['timest']), 'visible': x['visible'], 'articlecount': int(x.get('articlecount', 0))})
+
+		if 'LastEvaluatedKey' not in res:
+			return {'items': items}
+
+		query['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+
+# get a blogpost with its decoded body for the QueryDdbGetDetailText field
+@tracer.capture_method(capture_response = False)
+def get_detail_text(args):
+	items = []
+
+	res = ddb.query(KeyConditionExpression = Key('guid').eq(args['guid']), ProjectionExpression = 'blogsource, guid, timest, link, author, description, rawhtml, fulltxt, bodycodec, bodyref, srcguid, srctimest')
+
+	# skip the counter and feed state rows, which use the blogsource as guid
+	for x in res['Items']:
+		if x['timest'] > 0:
+			rawhtml, fulltxt = getfeed.load_body(x)
+			items.append({'blogsource': x['blogsource'], 'guid': x['guid'], 'timest': int(x['timest']), 'link': x['link'], 'author': x['author'], 'description': x['description'], 'rawhtml': rawhtml})
+
+	return {'items': items}
+
+
+# the graphql fields that are resolved by this function
+fields = {
+	'QueryDdbByBlogsourceAndTimest': get_by_blogsource,
+	'QueryDdbByVisibleAndTimest': get_by_visible,
+	'QueryDdbGetDetailText': get_detail_text,
+	'QueryDdbItemCountAll': get_item_count_all
+}
+
+
+# lambda handler, the appsync request template passes the field name and the arguments
+@logger.inject_lambda_context(log_event = True)
+@tracer.capture_lambda_handler
+def handler(event, context):
+
+	return fields[event['field']](event['arguments'])
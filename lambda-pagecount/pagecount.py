@@ -1,55 +1,160 @@
-import boto3, os
+import boto3, os, queue, threading, time
 from boto3.dynamodb.conditions import Key, Attr
 
 ddb = boto3.resource('dynamodb', region_name = os.environ['dynamo_region']).Table(os.environ['dynamo_table'])
 
-blogs = ["apn", "architecture", "big-data", "biz-prod", "cli", "cloudguru", "compute", "contact-center", "containers", "corey", "cost-mgmt", "database", "desktop", "developer", "devops", "enterprise-strat", "gamedev", "gametech", "governance", "industries", "infrastructure", "iot", "java", "jeremy", "management-tools", "marketplace", "media", "messaging", "ml", "mobile", "modernizing", "networking", "newsblog", "open-source", "public-sector", "quantum", "robotics", "sap", "security", "security-bulletins", "serverless", "startups", "storage", "training", "werner", "whats-new", "yan", "all"]
+# set the name of the global secondary index on the blogsource key, this changes when the indexes are migrated
+index_blogsource = os.environ.get('index_blogsource', 'timest')
 
-# get blogsource item count per category
-def getblog_count(blogsource):
+# set the amount of blogs to count concurrently
+count_threads = int(os.environ.get('count_threads', 10))
+
+# set the amount of days after which posts are considered settled, the incremental mode only recounts posts newer than this
+settle_days = int(os.environ.get('count_settle_days', 7))
+
+# get the blogsources to count, either from the lambda input or from the set stored on the 'all' counter row
+def get_blogs(event):
+
+    if 'blogs' in event:
+        return list(event['blogs'])
+
+    res = ddb.get_item(Key = {'guid': 'all', 'timest': 0}, ProjectionExpression = 'blogsources')
+
+    if 'blogsources' in res.get('Item', {}):
+        return sorted(res['Item']['blogsources'])
+
+    # the set is not stored yet, so scan the table once for the blogsources and store them on the 'all' counter row
+    blogs = set()
+    scan = ddb.scan(ProjectionExpression = 'blogsource', FilterExpression = Attr('timest').gt(1))
+
+    for x in scan['Items']:
+        blogs.add(x['blogsource'])
+
+    while 'LastEvaluatedKey' in scan:
+        scan = ddb.scan(ExclusiveStartKey = scan['LastEvaluatedKey'], ProjectionExpression = 'blogsource', FilterExpression = Attr('timest').gt(1))
+
+        for x in scan['Items']:
+            blogs.add(x['blogsource'])
+
+    if len(blogs) > 0:
+        ddb.update_item(Key = {'guid': 'all', 'timest': 0}, ExpressionAttributeValues = {':bs': blogs}, UpdateExpression = 'ADD blogsources :bs')
+
+    print('found ' + str(len(blogs)) + ' blogsources in table scan')
+
+    return sorted(blogs)
+
+# count the blogposts of a category with a timestamp after ts_from and up to ts_to, or without upper bound if ts_to is None
+def count_posts(blogsource, ts_from, ts_to):
 
     count = 0
 
-    if blogsource == 'all':
+    if ts_to is None:
+        condition = Key('blogsource').eq(blogsource) & Key('timest').gt(ts_from)
+
+    else:
+        condition = Key('blogsource').eq(blogsource) & Key('timest').between(ts_from + 1, ts_to)
+
+    # get a count of blogpost per category
+    blogs = ddb.query(IndexName = index_blogsource, Select = 'COUNT', KeyConditionExpression = condition)
+
+    count += int(blogs['Count'])
+
+    while 'LastEvaluatedKey' in blogs:
+        blogs = ddb.query(ExclusiveStartKey = blogs['LastEvaluatedKey'], IndexName = index_blogsource, Select = 'COUNT', KeyConditionExpression = condition)
 
-        # get all blogs with timestamp greater than 1
-        blogs = ddb.query(IndexName = "visible", Select = 'COUNT', KeyConditionExpression = Key('visible').eq('y') & Key('timest').gt(1))
-        
         count += int(blogs['Count'])
 
-        while 'LastEvaluatedKey' in blogs:
-            
-            blogs = ddb.query(ExclusiveStartKey = blogs['LastEvaluatedKey'], IndexName = "visible", Select = 'COUNT', KeyConditionExpression = Key('visible').eq('y') & Key('timest').gt(1))
+    return count
+
+# get blogsource item count per category, the incremental mode adds the posts since the stored watermark to the stored base count
+def getblog_count(blogsource, incremental):
+
+    now = int(time.time())
+    base_ts = now - (86400 * settle_days)
+    row = {}
 
-            count += int(blogs['Count'])
+    if incremental:
+        row = ddb.get_item(Key = {'guid': blogsource, 'timest': 0}).get('Item', {})
+
+    if 'base_ts' in row and 'base_count' in row and int(row['base_ts']) <= base_ts:
+
+        # add the posts that settled since the previous run to the base count
+        base_count = int(row['base_count']) + count_posts(blogsource, int(row['base_ts']), base_ts)
 
     else:
 
-        # get a count of blogpost per category
-        blogs = ddb.query(IndexName = "timest", Select = 'COUNT', KeyConditionExpression = Key('blogsource').eq(blogsource) & Key('timest').gt(1))
+        # count all settled posts, this happens on a full run or if no watermark is stored yet
+        base_count = count_posts(blogsource, 1, base_ts)
 
-        count += int(blogs['Count'])
+    # always recount the recent posts, as posts can be stored with a timestamp in the past
+    count = base_count + count_posts(blogsource, base_ts, None)
 
-        while 'LastEvaluatedKey' in blogs:
-            blogs = ddb.query(ExclusiveStartKey = blogs['LastEvaluatedKey'], IndexName = "timest", Select = 'COUNT', KeyConditionExpression = Key('blogsource').eq(blogsource) & Key('timest').gt(1))
-            
-            count += int(blogs['Count'])
-
-    # write the page count record to dynamodb
-    ddb.put_item(
-		TableName = os.environ['dynamo_table'], 
-		Item = {
-			'timest' : 0,
-            'guid': blogsource,
-			'blogsource' : blogsource,
-            'articlecount' : int(count),
-            'visible': 'y'
-		}
-	)
+    # write the page count record to dynamodb, updating the attributes keeps the blogsources set on the 'all' row
+    ddb.update_item(
+        Key = {'guid': blogsource, 'timest': 0},
+        ExpressionAttributeValues = {':bs': blogsource, ':count': count, ':base_count': base_count, ':base_ts': base_ts, ':visible': 'y'},
+        UpdateExpression = 'SET blogsource = :bs, articlecount = :count, base_count = :base_count, base_ts = :base_ts, visible = :visible'
+    )
 
     # print status
     print('updated ' + str(count) + ' page count for ' + blogsource)
 
+    return count
+
+# worker for queue jobs
+def worker(q, incremental, counts):
+    while True:
+        try:
+            blog = q.get_nowait()
+
+        except queue.Empty:
+            return
+
+        try:
+            counts[blog] = getblog_count(blog, incremental)
+
+        except Exception as e:
+            print('failed to count ' + blog + ' : ' + str(e))
+
+        q.task_done()
+
 def handler(event, context):
+
+    # check whether to only count the posts since the stored watermark
+    incremental = event.get('mode', 'full') == 'incremental'
+
+    blogs = get_blogs(event)
+    counts = {}
+
+    # submit a job per blog to the queue
+    q = queue.Queue()
+
     for blog in blogs:
-        getblog_count(blog)
+        q.put(blog)
+
+    # start a thread per job, up to the configured amount of threads
+    for x in range(min(count_threads, len(blogs))):
+        t = threading.Thread(target = worker, args = (q, incremental, counts))
+        t.daemon = True
+        t.start()
+    q.join()
+
+    # fail the invocation if a blog could not be counted, as the 'all' count would be incomplete
+    if len(counts) != len(blogs):
+        raise Exception('failed to count ' + str(len(blogs) - len(counts)) + ' blogs')
+
+    # the sum of a subset of the blogs is not the count for all blogs, so leave the 'all' row to the next full or incremental run
+    if 'blogs' in event:
+        print('skipped the page count for all, as only ' + str(len(blogs)) + ' blogs were counted')
+        return
+
+    # the count for all blogs is the sum of the per blog counts
+    total = sum(counts.values())
+
+    ddb.update_item(
+        Key = {'guid': 'all', 'timest': 0},
+        ExpressionAttributeValues = {':bs': 'all', ':count': total, ':visible': 'y'},
+        UpdateExpression = 'SET blogsource = :bs, articlecount = :count, visible = :visible'
+    )
+
+    print('updated ' + str(total) + ' page count for all')
@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# check that the article extractor of getfeed keeps the summary tree of readability, run with 'python -m pytest tests'
+# the extractor overrides the private sanitize method of readability.Document, so an upgrade of readability-lxml can silently
+# switch getfeed to the slower fallback that parses the summary again
+
+import os, sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'lambda-getfeed'))
+
+os.environ.setdefault('AWS_REGION', 'eu-west-1')
+os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'true')
+os.environ.setdefault('dynamo_table', 'rssbench')
+
+import getfeed
+
+article = '<html><head><title>Test post</title></head><body><div id="nav"><a href="/">Home</a></div><div class="post"><h1>Test post</h1>' + ''.join('<p>This is paragraph ' + str(x) + ' of the test post, with enough text for readability to pick it as the main content of the page.</p>' for x in range(10)) + '</div></body></html>'
+
+
+# the override must be called by readability, so the text is read from the kept tree
+def test_extractor_keeps_summary_tree():
+	doc = getfeed.get_extractor()(article)
+	doc.summary(html_partial = True)
+
+	assert hasattr(doc, 'node'), 'readability did not call the sanitize override, check the pinned readability-lxml version'
+
+
+# the text of the kept tree must match the text of the summary html
+def test_extract_article_text():
+	import lxml.html
+
+	rawhtml, cleantext = getfeed.extract_article(article)
+
+	assert 'paragraph 9 of the test post' in cleantext
+	assert cleantext == lxml.html.fromstring(rawhtml).text_content().strip('\n')
+	assert 'ReadabilityFallback' not in getfeed.metric_buffer.get('all', {})
@@ -0,0 +1,438 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# backfill the history of the feeds outside of lambda, with the feed parsing, article extraction, tagging and record functions of getfeed
+# the articles are downloaded on a thread pool with a rate limit per host and extracted with readability on a process pool
+# the records of every chunk of blogposts are written in bulk to dynamodb, or to a local sqlite database to run the backfill on a dev box
+#
+# the progress of every feed is stored in a checkpoint file, run the same command with --resume to skip the feeds that were completed
+# the written blogposts of an interrupted feed are found through their guids on the next run, so these are not retrieved again
+
+import argparse, concurrent.futures, json, multiprocessing, os, sqlite3, sys, threading, time, urllib.parse
+
+# import the getfeed function from its folder, it reads its settings from the environment when it is imported
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'lambda-getfeed'))
+
+
+# extract the text of an article on the process pool, returns the html and text of the summary and the cpu seconds used
+def extract(html):
+	import getfeed
+
+	start = time.process_time()
+	rawhtml, cleantxt = getfeed.extract_article(html)
+
+	return rawhtml, cleantxt, time.process_time() - start
+
+
+# import getfeed and readability once per worker process, instead of on the first article of every worker
+def init_worker():
+	import getfeed
+
+	getfeed.get_extractor()
+
+
+# read the blogsources and urls from a feeds.txt file like the crawl function
+def read_feeds(path):
+	feeds = {}
+
+	with open(path) as f:
+		for line in f:
+			if ',' in line:
+				src, url = line.split(',', 1)
+				feeds[src.strip()] = url.strip()
+
+	return feeds
+
+
+# get the name of the index on the blogsource key of the table, which depends on the IndexMigration stage of the stack
+def get_blogsource_index(region, table):
+	import boto3
+
+	indexes = [x['IndexName'] for x in boto3.client('dynamodb', region_name = region).describe_table(TableName = table)['Table'].get('GlobalSecondaryIndexes', [])]
+
+	return 'timest-list' if 'timest-list' in indexes else 'timest'
+
+
+# wait until the next request to the host of a url is allowed, the requests to every host are spaced out to the given rate per second
+class HostLimiter:
+
+	def __init__(self, rate):
+		self.rate = rate
+		self.lock = threading.Lock()
+		self.slots = {}
+
+	def wait(self, url):
+		if self.rate <= 0:
+			return
+
+		host = urllib.parse.urlsplit(url).netloc.lower()
+
+		with self.lock:
+			now = time.monotonic()
+			slot = max(now, self.slots.get(host, 0))
+			self.slots[host] = slot + 1 / self.rate
+
+		if slot > now:
+			time.sleep(slot - now)
+
+
+# store the progress of every feed in a checkpoint file
+class Progress:
+
+	def __init__(self, path, resume):
+		self.path = path
+		self.lock = threading.Lock()
+		self.feeds = {}
+
+		if resume and os.path.exists(path):
+			with open(path) as f:
+				self.feeds = json.load(f)['feeds']
+
+	def is_done(self, blogsource):
+		return self.feeds.get(blogsource, {}).get('done', False)
+
+	# add the written blogposts of a chunk to the feed, a feed is only done once all its blogposts were written
+	def update(self, blogsource, written, failed, done = False):
+		with self.lock:
+			x = self.feeds.setdefault(blogsource, {'written' : 0})
+			x['written'] += written
+			x['failed'] = failed
+			x['done'] = done
+
+			self.save()
+
+	# write the checkpoint to a temporary file first, so an interrupted write keeps the previous checkpoint
+	def save(self):
+		with open(self.path + '.tmp', 'w') as f:
+			json.dump({'feeds' : self.feeds}, f)
+
+		os.replace(self.path + '.tmp', self.path)
+
+
+# store the blogposts in the dynamodb table of the stack with the functions of getfeed
+class DynamoStore:
+
+	def __init__(self, getfeed, bucket):
+		self.getfeed = getfeed
+		self.bucket = bucket
+
+	def get_guids(self, blogsource, ts):
+		return self.getfeed.get_guids(blogsource, ts)
+
+	def get_stored_keys(self, keys):
+		return self.getfeed.get_stored_keys(keys)
+
+	def get_duplicates(self, posts, field):
+		return self.getfeed.get_duplicates(posts, field)
+
+	# encode the body of a record for the body storage option of the stack, a duplicate references the record of the stored post
+	def encode(self, item, source = None):
+		return self.getfeed.store_body(item, self.bucket, source)
+
+	# write the records in batches of 25 items and store the identities of the written blogposts
+	def write(self, posts, failed):
+		items = self.getfeed.flush_dynamo([post['record'] for post in posts], failed)
+		written = set([(x['guid'], x['timest']) for x in items])
+		posts = list({ (post['guid'], post['timest']) : post for post in posts if (post['guid'], post['timest']) in written }.values())
+		self.getfeed.put_identities(posts)
+
+		return posts
+
+	def close(self):
+		pass
+
+
+# store the blogposts in a local sqlite database with the same keys as the dynamodb table, the records are stored as json with inline bodies
+class SqliteStore:
+
+	def __init__(self, getfeed, path):
+		self.getfeed = getfeed
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread = False)
+
+		with self.lock, self.db:
+			self.db.execute('PRAGMA journal_mode = WAL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS posts (guid TEXT, timest INTEGER, blogsource TEXT, visible TEXT, item TEXT, PRIMARY KEY (guid, timest))')
+			self.db.execute('CREATE INDEX IF NOT EXISTS posts_blogsource ON posts (blogsource, timest)')
+			self.db.execute('CREATE TABLE IF NOT EXISTS identities (key TEXT PRIMARY KEY, srcguid TEXT, srctimest INTEGER)')
+			self.db.execute('CREATE TABLE IF NOT EXISTS counters (blogsource TEXT PRIMARY KEY, articlecount INTEGER)')
+
+	def get_guids(self, blogsource, ts):
+		with self.lock:
+			return set([x[0] for x in self.db.execute('SELECT guid FROM posts WHERE blogsource = ? AND timest > ?', (blogsource, ts))])
+
+	def get_stored_keys(self, keys):
+		with self.lock:
+			return set([x for x in keys if self.db.execute('SELECT 1 FROM posts WHERE guid = ? AND timest = ?', x).fetchone() is not None])
+
+	# split the blogposts in new posts and duplicates of a stored post, like the get_duplicates function of getfeed
+	def get_duplicates(self, posts, field):
+		new = []
+		dups = []
+
+		with self.lock:
+			for post in posts:
+				src = None
+
+				if post.get(field) is not None:
+					src = self.db.execute('SELECT p.guid, p.timest, p.item FROM identities i JOIN posts p ON p.guid = i.srcguid AND p.timest = i.srctimest WHERE i.key = ?', (post[field], )).fetchone()
+
+				if src is None:
+					new.append(post)
+					continue
+
+				item = json.loads(src[2])
+				post['source'] = (src[0], src[1])
+				post['tags'] = item['tag']
+
+				if 'rawhtml' not in post:
+					post['rawhtml'], post['cleantxt'] = item['rawhtml'], item['fulltxt']
+
+				dups.append(post)
+
+		return new, dups
+
+	def encode(self, item, source = None):
+		if source is None:
+			return item
+
+		return self.getfeed.get_ref_record(item, source)
+
+	# write the records, identities and counters of the blogposts in one transaction
+	def write(self, posts, failed):
+		posts = list({ (post['guid'], post['timest']) : post for post in posts }.values())
+		counts = {}
+
+		for post in posts:
+			counts[post['blogsource']] = counts.get(post['blogsource'], 0) + 1
+
+		if len(posts) > 0:
+			counts['all'] = len(posts)
+
+		with self.lock, self.db:
+			self.db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)', [(x['guid'], x['timest'], x['blogsource'], x['record']['visible'], json.dumps(x['record'])) for x in posts])
+			self.db.executemany('INSERT OR IGNORE INTO identities VALUES (?, ?, ?)', [(post[k], post['guid'], post['timest']) for post in posts if 'source' not in post for k in ['linkkey', 'bodykey'] if post.get(k) is not None])
+			self.db.executemany('INSERT INTO counters VALUES (?, ?) ON CONFLICT (blogsource) DO UPDATE SET articlecount = articlecount + excluded.articlecount', list(counts.items()))
+
+		print('wrote ' + str(len(posts)) + ' blog entries to sqlite')
+
+		return posts
+
+	def close(self):
+		self.db.close()
+
+
+# retrieve, tag and store the blogposts of the feeds
+class Backfill:
+
+	def __init__(self, args, getfeed, store, progress):
+		self.args = args
+		self.getfeed = getfeed
+		self.store = store
+		self.progress = progress
+		self.limiter = HostLimiter(args.rate)
+		self.io = concurrent.futures.ThreadPoolExecutor(max_workers = args.threads)
+
+		# spawn the worker processes, as forking a process with running threads can copy locks that are held
+		self.cpu = concurrent.futures.ProcessPoolExecutor(max_workers = args.processes, mp_context = multiprocessing.get_context('spawn'), initializer = init_worker)
+
+	def download(self, url):
+		self.limiter.wait(url)
+
+		return self.getfeed.download_article(url)
+
+	# download the articles on the thread pool and extract every article on the process pool as soon as it is downloaded
+	def retrieve(self, posts, failed):
+		downloads = { self.io.submit(self.download, post['link']) : post for post in posts }
+		extracts = {}
+
+		for f in concurrent.futures.as_completed(downloads):
+			post = downloads[f]
+
+			try:
+				extracts[self.cpu.submit(extract, f.result())] = post
+
+			except Exception as e:
+				print('failed to retrieve ' + post['link'] + ' : ' + str(e))
+				failed.append(post['guid'])
+
+		for f in concurrent.futures.as_completed(extracts):
+			post = extracts[f]
+
+			try:
+				post['rawhtml'], post['cleantxt'], seconds = f.result()
+				self.getfeed.add_metric('ReadabilityTime', self.getfeed.MetricUnit.Milliseconds, 1000 * seconds)
+				self.getfeed.add_metric('ReadabilityCalls', self.getfeed.MetricUnit.Count, 1)
+
+			except Exception as e:
+				print('failed to extract ' + post['link'] + ' : ' + str(e))
+				failed.append(post['guid'])
+
+		return [post for post in posts if 'cleantxt' in post]
+
+	# create the record of a blogpost with the body encoded for the store
+	def store_entry(self, post):
+		post['item'] = self.getfeed.put_dynamo(post['timest'], post['title'], post['cleantxt'], post['rawhtml'], post['description'], post['link'], post['blogsource'], post['author'], post['guid'], post['tags'], post['category'], post['datestr'], None, None)
+		post['record'] = self.store.encode(post['item'], post.get('source'))
+
+	# retrieve, tag and write a chunk of blogposts, like the get_feed function of getfeed, and return the written blogposts
+	def run_chunk(self, posts, failed):
+		for post in posts:
+			post['linkkey'] = self.getfeed.get_link_key(post['link'])
+
+		posts, dups = self.store.get_duplicates(posts, 'linkkey')
+		posts = self.retrieve(posts, failed)
+
+		for post in posts + dups:
+			post['bodykey'] = self.getfeed.get_body_key(post['cleantxt'])
+
+		posts, bodydups = self.store.get_duplicates(posts, 'bodykey')
+
+		if self.args.comprehend:
+			posts = self.getfeed.comprehend(posts, failed)
+
+		else:
+			for post in posts:
+				post['tags'] = 'none'
+
+		posts = posts + dups + bodydups
+
+		# the s3 body storage option uploads the bodies, so the records are created on the thread pool
+		for post, f in [(post, self.io.submit(self.store_entry, post)) for post in posts]:
+			try:
+				f.result()
+
+			except Exception as e:
+				print('failed to store ' + post['link'] + ' : ' + str(e))
+				failed.append(post['guid'])
+
+		return self.store.write([post for post in posts if post['guid'] not in failed], failed)
+
+	# backfill a feed in chunks, the progress is stored after every chunk
+	def run_feed(self, blogsource, url):
+		failed = []
+		cutoff = int(time.time()) - (86400 * self.args.days)
+
+		try:
+			self.limiter.wait(url)
+			rssfeed, validators = self.getfeed.get_rss(url, blogsource, {}, cutoff)
+			print('found ' + str(len(rssfeed['entries'])) + ' blog entries in ' + blogsource)
+
+			posts = self.getfeed.get_posts(rssfeed['entries'], blogsource, self.store.get_guids(blogsource, cutoff), cutoff)
+
+			# skip blogposts that were already stored through another feed
+			stored = self.store.get_stored_keys([(post['guid'], post['timest']) for post in posts])
+			posts = list({ (post['guid'], post['timest']) : post for post in posts if (post['guid'], post['timest']) not in stored }.values())
+
+			for i in range(0, len(posts), self.args.chunk):
+				written = self.run_chunk(posts[i:i + self.args.chunk], failed)
+				self.progress.update(blogsource, len(written), len(failed))
+
+				# clear the download timings that getfeed keeps for the trace, the tracer is disabled outside of lambda
+				self.getfeed.trace_fetches()
+
+		except Exception as e:
+			print('failed to backfill ' + blogsource + ' : ' + str(e))
+			failed.append(url)
+
+		self.progress.update(blogsource, 0, len(failed), len(failed) == 0)
+
+		return len(failed) == 0
+
+	def run(self, feeds):
+		with concurrent.futures.ThreadPoolExecutor(max_workers = self.args.feed_threads) as pool:
+			return list(pool.map(lambda x: self.run_feed(*x), feeds.items()))
+
+	def close(self):
+		self.io.shutdown()
+		self.cpu.shutdown()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'backfill the history of the rss feeds outside of lambda, into the dynamodb table or a local sqlite database')
+	parser.add_argument('--feeds', default = os.path.join(root, 'lambda-crawl', 'feeds.txt'), help = 'feeds.txt file with the blogsources and urls')
+	parser.add_argument('--blogsource', action = 'append', default = None, help = 'only backfill this blogsource, can be used several times')
+	parser.add_argument('--days', type = int, default = 365, help = 'days of history to retrieve, without the 90 day limit of the crawl function')
+	parser.add_argument('--store', default = 'dynamodb', choices = ['dynamodb', 'sqlite'])
+	parser.add_argument('--table', default = None, help = 'name of the dynamodb table')
+	parser.add_argument('--region', default = 'eu-west-1')
+	parser.add_argument('--index', default = None, help = 'index on the blogsource key, by default \'timest-list\' if the table has it and \'timest\' otherwise')
+	parser.add_argument('--visible-shards', type = int, default = 8, help = 'use the same value as the VisibleShards parameter')
+	parser.add_argument('--body-storage', default = 'inline', choices = ['inline', 'zlib', 's3'], help = 'use the same value as the BodyStorage parameter')
+	parser.add_argument('--bucket', default = None, help = 'bucket for the s3 body storage option, use the PublicJsonBucket of the stack')
+	parser.add_argument('--sqlite', default = 'backfill.db', help = 'database file of the sqlite store')
+	parser.add_argument('--feed-threads', type = int, default = 4, help = 'amount of feeds that are backfilled concurrently')
+	parser.add_argument('--threads', type = int, default = 16, help = 'amount of threads for the article downloads')
+	parser.add_argument('--processes', type = int, default = os.cpu_count(), help = 'amount of processes for the article extraction')
+	parser.add_argument('--rate', type = float, default = 2.0, help = 'maximum requests per second to a host, 0 for no limit')
+	parser.add_argument('--chunk', type = int, default = 100, help = 'amount of blogposts per bulk write and checkpoint')
+	parser.add_argument('--checkpoint', default = 'backfill.checkpoint', help = 'checkpoint file with the progress per feed')
+	parser.add_argument('--resume', action = 'store_true', help = 'skip the feeds that were completed according to the checkpoint file')
+	parser.add_argument('--no-comprehend', dest = 'comprehend', action = 'store_false', help = 'tag the blogposts with \'none\' instead of calling comprehend')
+	args = parser.parse_args()
+
+	if args.store == 'dynamodb' and args.table is None:
+		parser.error('--table is required for the dynamodb store')
+
+	if args.body_storage == 's3' and args.bucket is None:
+		parser.error('--bucket is required for the s3 body storage option')
+
+	if args.index is None:
+		args.index = get_blogsource_index(args.region, args.table) if args.store == 'dynamodb' else 'timest'
+
+	# set the environment of getfeed before it is imported, the worker processes inherit it
+	os.environ.update({
+		'AWS_REGION' : args.region,
+		'dynamo_table' : args.table or '',
+		'index_blogsource' : args.index,
+		'visible_shards' : str(args.visible_shards),
+		'body_storage' : args.body_storage,
+		'http_pool_size' : str(args.threads),
+		'metrics_per_blog' : 'n'
+	})
+	os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'true')
+	os.environ.setdefault('POWERTOOLS_SERVICE_NAME', 'rssbackfill')
+
+	import getfeed
+
+	getfeed.cache_stats = {'hit' : 0, 'miss' : 0}
+
+	feeds = read_feeds(args.feeds)
+
+	if args.blogsource is not None:
+		feeds = { k : v for k, v in feeds.items() if k in args.blogsource }
+
+	progress = Progress(args.checkpoint, args.resume)
+	feeds = { k : v for k, v in feeds.items() if not progress.is_done(k) }
+
+	if args.store == 'dynamodb':
+		store = DynamoStore(getfeed, args.bucket)
+
+	else:
+		store = SqliteStore(getfeed, args.sqlite)
+
+	start = time.time()
+	backfill = Backfill(args, getfeed, store, progress)
+
+	try:
+		results = backfill.run(feeds)
+
+	finally:
+		backfill.close()
+		store.close()
+
+	seconds = time.time() - start
+	written = sum(progress.feeds[k]['written'] for k in feeds)
+
+	# print the summed stage times and counters that getfeed collected, the stage times are summed over the threads and processes
+	print('\nbackfilled ' + str(written) + ' blogposts of ' + str(results.count(True)) + ' of ' + str(len(feeds)) + ' feeds in ' + '%.1f' % seconds + 's, ' + '%.1f' % (written / max(seconds, 0.001)) + ' blogposts per second')
+
+	with getfeed.metric_lock:
+		for name, x in sorted(getfeed.metric_buffer.get('all', {}).items()):
+			print('  %-28s %14.1f %s' % (name, x['value'], x['unit'].value))
+
+	if False in results:
+		print('failed to backfill ' + str(results.count(False)) + ' feeds, run the same command with --resume to continue')
+		raise SystemExit(1)
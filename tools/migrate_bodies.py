@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# convert the rawhtml and fulltxt of the stored blogposts to another body storage option of the getfeed function
+# the table is scanned in parallel segments and every record is only overwritten if its body codec did not change in the meantime
+
+import argparse, boto3, botocore, os, sys, threading
+
+from boto3.dynamodb.conditions import Attr
+
+# import the getfeed function from its folder for its body codecs, it reads the body storage settings from the environment when it is imported
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'lambda-getfeed'))
+
+
+# get the approximate size of a record in bytes, which is the sum of the attribute name and value sizes
+def item_size(item):
+	size = 0
+
+	for k, v in item.items():
+		if isinstance(v, str):
+			size += len(k) + len(v.encode('utf-8'))
+
+		elif hasattr(v, 'value') or isinstance(v, bytes):
+			size += len(k) + len(bytes(v))
+
+		else:
+			size += len(k) + len(str(v))
+
+	return size
+
+
+# convert the records of one scan segment
+def migrate_segment(args, getfeed, segment, stats, errors, lock):
+	ddb = boto3.resource('dynamodb', region_name = args.region).Table(args.table)
+	s3 = boto3.client('s3', region_name = args.region)
+
+	scan = {'Segment' : segment, 'TotalSegments' : args.segments, 'FilterExpression' : Attr('timest').gt(0)}
+	counts = {'scanned' : 0, 'converted' : 0, 'skipped' : 0, 'conflicts' : 0, 'bytes_before' : 0, 'bytes_after' : 0}
+	status = 'done'
+
+	# a failed segment keeps the counts of the records it processed, the records are skipped when the tool runs again
+	try:
+		while True:
+			res = ddb.scan(**scan)
+
+			for item in res['Items']:
+				counts['scanned'] += 1
+				codec = item.get('bodycodec', 'inline')
+
+				# skip records without a body, like the duplicates that reference the record of the stored post, and records that already use the target option
+				if codec == args.mode or ('rawhtml' not in item and 'bodyref' not in item):
+					counts['skipped'] += 1
+					continue
+
+				# decode the body and encode it again with the store_body function of getfeed, which uses the target option
+				record = { k : v for k, v in item.items() if k not in ['rawhtml', 'fulltxt', 'bodycodec', 'bodyref'] }
+				record['rawhtml'], record['fulltxt'] = getfeed.load_body(item)
+				record = getfeed.store_body(record, args.bucket, upload = not args.dry_run)
+
+				# small bodies are compressed inline with the s3 option, so these do not change if they were compressed already
+				if record.get('bodycodec', 'inline') == codec:
+					counts['skipped'] += 1
+					continue
+
+				counts['bytes_before'] += item_size(item)
+				counts['bytes_after'] += item_size(record)
+
+				if args.dry_run:
+					counts['converted'] += 1
+					continue
+
+				# only overwrite the record if getfeed or another migration did not change the body in the meantime
+				if codec == 'inline':
+					condition = Attr('bodycodec').not_exists()
+
+				else:
+					condition = Attr('bodycodec').eq(codec)
+
+				try:
+					ddb.put_item(Item = record, ConditionExpression = condition)
+					counts['converted'] += 1
+
+				except botocore.exceptions.ClientError as e:
+					if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+						raise
+
+					counts['conflicts'] += 1
+					continue
+
+				# remove the s3 object of a body that is now stored in the record
+				if codec == 's3' and record.get('bodyref') != item['bodyref']:
+					bucket, key = item['bodyref'][5:].split('/', 1)
+					s3.delete_object(Bucket = bucket, Key = key)
+
+			if 'LastEvaluatedKey' not in res:
+				break
+
+			scan['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+	except Exception as e:
+		status = 'failed'
+
+		with lock:
+			errors.append('segment ' + str(segment) + ' : ' + str(e))
+
+	with lock:
+		for k, v in counts.items():
+			stats[k] = stats.get(k, 0) + v
+
+		print('segment ' + str(segment) + ' ' + status + ', ' + str(counts['converted']) + ' of ' + str(counts['scanned']) + ' records converted')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'convert the stored blogpost bodies to another body storage option')
+	parser.add_argument('--table', required = True, help = 'name of the dynamodb table')
+	parser.add_argument('--region', default = 'eu-west-1')
+	parser.add_argument('--mode', required = True, choices = ['inline', 'zlib', 's3'], help = 'the body storage option to convert to, use the same value as the BodyStorage parameter')
+	parser.add_argument('--bucket', default = None, help = 'bucket for the s3 option, use the PublicJsonBucket of the stack')
+	parser.add_argument('--threshold', type = int, default = 65536, help = 'body size in bytes above which the s3 option stores the body on s3')
+	parser.add_argument('--segments', type = int, default = 4, help = 'amount of parallel scan segments')
+	parser.add_argument('--dry-run', action = 'store_true', help = 'only report the records that would be converted and the size difference')
+	args = parser.parse_args()
+
+	if args.mode == 's3' and args.bucket is None:
+		parser.error('--bucket is required for the s3 option')
+
+	# set the environment of getfeed before it is imported, so its store_body function encodes the bodies for the target option
+	os.environ.update({
+		'AWS_REGION' : args.region,
+		'AWS_DEFAULT_REGION' : args.region,
+		'dynamo_table' : args.table,
+		'body_storage' : args.mode,
+		'body_s3_threshold' : str(args.threshold)
+	})
+	os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'true')
+	os.environ.setdefault('POWERTOOLS_SERVICE_NAME', 'rssmigrate')
+
+	import getfeed
+
+	stats = {}
+	errors = []
+	lock = threading.Lock()
+	threads = []
+
+	for segment in range(args.segments):
+		t = threading.Thread(target = migrate_segment, args = (args, getfeed, segment, stats, errors, lock))
+		t.start()
+		threads.append(t)
+
+	for t in threads:
+		t.join()
+
+	print('converted ' + str(stats.get('converted', 0)) + ' of ' + str(stats.get('scanned', 0)) + ' records to ' + args.mode + ', skipped ' + str(stats.get('skipped', 0)) + ', ' + str(stats.get('conflicts', 0)) + ' changed during the migration')
+	print('approximate record size before ' + str(stats.get('bytes_before', 0)) + ' bytes, after ' + str(stats.get('bytes_after', 0)) + ' bytes')
+
+	# fail if a segment did not complete, so the migration is not mistaken for a finished one
+	if len(errors) > 0:
+		print('\n'.join(['failed ' + x for x in errors]) + '\nrun the tool again to convert the remaining records')
+		raise SystemExit(1)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# re-key the visible attribute of the stored blogposts to the shards of the getfeed function, after deploying a new VisibleShards value
+# the table is scanned in parallel segments and every record is only updated if its visible key did not change in the meantime
+
+import argparse, boto3, botocore, os, sys, threading
+
+from boto3.dynamodb.conditions import Attr
+
+# import the getfeed function from its folder, so the blogposts get the same shard as getfeed assigns to new blogposts
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'lambda-getfeed'))
+
+
+# re-key the blogposts of one scan segment
+def reshard_segment(args, getfeed, segment, stats, errors, lock):
+	ddb = boto3.resource('dynamodb', region_name = args.region).Table(args.table)
+
+	# the counter rows keep the unsharded 'y' key, so only the blogposts with a positive timestamp are scanned
+	scan = {'Segment' : segment, 'TotalSegments' : args.segments, 'ProjectionExpression' : 'guid, timest, visible', 'FilterExpression' : Attr('timest').gt(0) & Attr('visible').begins_with('y')}
+	counts = {'scanned' : 0, 'rekeyed' : 0, 'skipped' : 0, 'conflicts' : 0}
+	status = 'done'
+
+	try:
+		while True:
+			res = ddb.scan(**scan)
+
+			for item in res['Items']:
+				counts['scanned'] += 1
+				key = getfeed.get_visible_key(item['guid'])
+
+				if item['visible'] == key:
+					counts['skipped'] += 1
+					continue
+
+				if args.dry_run:
+					counts['rekeyed'] += 1
+					continue
+
+				# only update the record if it still exists with the same visible key
+				try:
+					ddb.update_item(
+						Key = {'guid' : item['guid'], 'timest' : item['timest']},
+						UpdateExpression = 'SET visible = :new',
+						ConditionExpression = Attr('visible').eq(item['visible']),
+						ExpressionAttributeValues = {':new' : key}
+					)
+					counts['rekeyed'] += 1
+
+				except botocore.exceptions.ClientError as e:
+					if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+						raise
+
+					counts['conflicts'] += 1
+
+			if 'LastEvaluatedKey' not in res:
+				break
+
+			scan['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+	except Exception as e:
+		status = 'failed'
+
+		with lock:
+			errors.append('segment ' + str(segment) + ' : ' + str(e))
+
+	with lock:
+		for k, v in counts.items():
+			stats[k] = stats.get(k, 0) + v
+
+		print('segment ' + str(segment) + ' ' + status + ', ' + str(counts['rekeyed']) + ' of ' + str(counts['scanned']) + ' records re-keyed')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 're-key the visible attribute of the stored blogposts to the shards of the visible index')
+	parser.add_argument('--table', required = True, help = 'name of the dynamodb table')
+	parser.add_argument('--region', default = 'eu-west-1')
+	parser.add_argument('--shards', type = int, required = True, help = 'amount of shards, use the same value as the VisibleShards parameter')
+	parser.add_argument('--segments', type = int, default = 4, help = 'amount of parallel scan segments')
+	parser.add_argument('--dry-run', action = 'store_true', help = 'only report the records that would be re-keyed')
+	args = parser.parse_args()
+
+	# set the environment of getfeed before it is imported, it reads the amount of shards when it is imported
+	os.environ.update({
+		'AWS_REGION' : args.region,
+		'dynamo_table' : args.table,
+		'visible_shards' : str(args.shards)
+	})
+	os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'true')
+	os.environ.setdefault('POWERTOOLS_SERVICE_NAME', 'rssreshard')
+
+	import getfeed
+
+	stats = {}
+	errors = []
+	lock = threading.Lock()
+	threads = []
+
+	for segment in range(args.segments):
+		t = threading.Thread(target = reshard_segment, args = (args, getfeed, segment, stats, errors, lock))
+		t.start()
+		threads.append(t)
+
+	for t in threads:
+		t.join()
+
+	print('re-keyed ' + str(stats.get('rekeyed', 0)) + ' of ' + str(stats.get('scanned', 0)) + ' records to ' + str(args.shards) + ' shards, skipped ' + str(stats.get('skipped', 0)) + ', ' + str(stats.get('conflicts', 0)) + ' changed during the re-keying')
+
+	if len(errors) > 0:
+		print('\n'.join(['failed ' + x for x in errors]) + '\nrun the tool again to re-key the remaining records')
+		raise SystemExit(1)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# @marekq
+# www.marek.rocks
+
+# migrate the global secondary indexes of a deployed stack from the indexes with all attributes to the '-list' indexes with the listing attributes only
+# the stack is updated one stage at a time, as dynamodb and cloudformation only add or remove one global secondary index per table update
+# the readers switch to the new indexes only after these are backfilled and hold the same amount of items as the old indexes
+
+import argparse, boto3, threading, time
+
+
+# the stages of the IndexMigration parameter in the order of the migration
+stages = ['legacy', 'build-visible', 'build-timest', 'switch', 'drop-visible', 'slim']
+
+# the old and new index names per index key
+index_pairs = [('visible', 'visible-list'), ('timest', 'timest-list')]
+
+
+# get the current parameters and the table name of the stack
+def get_stack(cfn, stack):
+	res = cfn.describe_stacks(StackName = stack)['Stacks'][0]
+	params = {x['ParameterKey'] : x['ParameterValue'] for x in res.get('Parameters', [])}
+	table = cfn.describe_stack_resource(StackName = stack, LogicalResourceId = 'rssfeed')['StackResourceDetail']['PhysicalResourceId']
+
+	# the serverless transform of the previous template needs the auto expand capability
+	return params, table, sorted(set(res.get('Capabilities', ['CAPABILITY_IAM'])) | {'CAPABILITY_AUTO_EXPAND'})
+
+
+# wait until the table and all its indexes are active and no index is backfilling
+def wait_indexes(ddb, table):
+	while True:
+		res = ddb.describe_table(TableName = table)['Table']
+		busy = [x['IndexName'] for x in res.get('GlobalSecondaryIndexes', []) if x['IndexStatus'] != 'ACTIVE' or x.get('Backfilling', False)]
+
+		if res['TableStatus'] == 'ACTIVE' and len(busy) == 0:
+			return [x['IndexName'] for x in res.get('GlobalSecondaryIndexes', [])]
+
+		print('waiting for indexes ' + ', '.join(busy) + ' to become active')
+		time.sleep(30)
+
+
+# count the items of an index with a parallel scan
+def count_index(ddb, table, index, segments):
+	counts = [0] * segments
+
+	def count_segment(segment):
+		scan = {'TableName' : table, 'IndexName' : index, 'Select' : 'COUNT', 'Segment' : segment, 'TotalSegments' : segments}
+
+		while True:
+			res = ddb.scan(**scan)
+			counts[segment] += res['Count']
+
+			if 'LastEvaluatedKey' not in res:
+				return
+
+			scan['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+	threads = [threading.Thread(target = count_segment, args = (x, )) for x in range(segments)]
+
+	for t in threads:
+		t.start()
+
+	for t in threads:
+		t.join()
+
+	return sum(counts)
+
+
+# check that every new index holds the same amount of items as the old index, retry a few times as posts can be written while counting
+def verify_indexes(ddb, table, segments, attempts, tolerance):
+	for old, new in index_pairs:
+		for attempt in range(attempts):
+			old_count = count_index(ddb, table, old, segments)
+			new_count = count_index(ddb, table, new, segments)
+
+			print('index ' + old + ' has ' + str(old_count) + ' items, index ' + new + ' has ' + str(new_count) + ' items')
+
+			if abs(old_count - new_count) <= tolerance:
+				break
+
+			time.sleep(30)
+
+		else:
+			raise Exception('index ' + new + ' does not hold the same items as ' + old + ', the readers were not switched')
+
+
+# update the stack to the next stage with the previous template and parameters, so only the IndexMigration parameter changes
+def update_stage(cfn, stack, params, capabilities, stage):
+	parameters = [{'ParameterKey' : k, 'UsePreviousValue' : True} for k in params if k != 'IndexMigration']
+	parameters.append({'ParameterKey' : 'IndexMigration', 'ParameterValue' : stage})
+
+	cfn.update_stack(StackName = stack, UsePreviousTemplate = True, Parameters = parameters, Capabilities = capabilities)
+	print('updating stack ' + stack + ' to index stage ' + stage)
+
+	# creating an index on a large table can take a long time, so wait up to 6 hours for the stack update
+	cfn.get_waiter('stack_update_complete').wait(StackName = stack, WaiterConfig = {'Delay' : 30, 'MaxAttempts' : 720})
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'migrate the global secondary indexes of the stack to the indexes with the listing attributes only')
+	parser.add_argument('--stack', required = True, help = 'name of the cloudformation stack')
+	parser.add_argument('--region', default = 'eu-west-1')
+	parser.add_argument('--target', default = 'slim', choices = stages, help = 'the stage to migrate to, use \'switch\' to keep the old indexes until the readers are checked')
+	parser.add_argument('--segments', type = int, default = 4, help = 'amount of parallel scan segments to count the index items')
+	parser.add_argument('--attempts', type = int, default = 5, help = 'amount of times to count the index items before the migration is stopped')
+	parser.add_argument('--tolerance', type = int, default = 0, help = 'allowed difference of the index item counts, for tables with many concurrent writes')
+	parser.add_argument('--dry-run', action = 'store_true', help = 'only print the stages that would be deployed')
+	args = parser.parse_args()
+
+	cfn = boto3.client('cloudformation', region_name = args.region)
+	ddb = boto3.client('dynamodb', region_name = args.region)
+
+	params, table, capabilities = get_stack(cfn, args.stack)
+
+	if 'IndexMigration' not in params:
+		parser.error('stack ' + args.stack + ' has no IndexMigration parameter, deploy the template with IndexMigration=legacy first')
+
+	current = stages.index(params['IndexMigration'])
+	target = stages.index(args.target)
+
+	if target < current:
+		parser.error('stack ' + args.stack + ' is at stage ' + params['IndexMigration'] + ', the migration only moves forward')
+
+	for stage in stages[current + 1 : target + 1]:
+		if args.dry_run:
+			print('would update stack ' + args.stack + ' to index stage ' + stage)
+			continue
+
+		# only point the readers at the new indexes once these hold all items
+		if stage == 'switch':
+			wait_indexes(ddb, table)
+			verify_indexes(ddb, table, args.segments, args.attempts, args.tolerance)
+
+		update_stage(cfn, args.stack, params, capabilities, stage)
+		print('stack ' + args.stack + ' is at index stage ' + stage + ', indexes ' + ', '.join(wait_indexes(ddb, table)))
+
+	print('deploy the stack with IndexMigration=' + args.target + ' from now on, so the next deploy keeps the migrated indexes')